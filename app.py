@@ -1,11 +1,34 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response, has_request_context, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import bisect
+import copy
+import math
+import queue
+import sqlite3
+import uuid
+import itertools
+import re
+import unicodedata
+import time
+import threading
 from supabase import create_client, Client
 from web3 import Web3
+from web3.middleware import Web3Middleware
+from decimal import Decimal
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from array import array
+
+# NumPy es opcional: si está instalado se usa para valorar portfolios en lote
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # ✅ Cargar variables del entorno (.env)
 load_dotenv()
@@ -24,8 +47,127 @@ PRIVATE_KEY = os.getenv("PRIVATE_KEY", "")  # Private key para firmar transaccio
 NETWORK = os.getenv("NETWORK", "scroll-sepolia")
 CHAIN_ID = int(os.getenv("CHAIN_ID", "534351"))  # Scroll Sepolia Chain ID
 
+# ==========================
+# 🌐 Sesiones HTTP salientes (keep-alive)
+# ==========================
+
+# Modo de servicio (ver gunicorn.conf.py): con gevent las peticiones en vuelo por worker
+# son GUNICORN_WORKER_CONNECTIONS en vez de GUNICORN_THREADS
+ASYNC_SERVING = os.getenv("GUNICORN_WORKER_CLASS", "gthread") == "gevent"
+WORKER_CONCURRENCY = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000")) if ASYNC_SERVING else int(os.getenv("GUNICORN_THREADS", "8"))
+
+# Peticiones concurrentes por worker: dimensiona los pools de conexiones
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", WORKER_CONCURRENCY))
+
+
+def _timeout_from_env(prefix, connect, read):
+    """Timeout (connect, read) de un upstream, configurable con <PREFIX>_CONNECT_TIMEOUT y <PREFIX>_READ_TIMEOUT."""
+    return (
+        float(os.getenv(f"{prefix}_CONNECT_TIMEOUT", connect)),
+        float(os.getenv(f"{prefix}_READ_TIMEOUT", read))
+    )
+
+
+DEEPSEEK_TIMEOUT = _timeout_from_env("DEEPSEEK", 5, 30)
+HERMES_TIMEOUT = _timeout_from_env("HERMES", 3, 10)
+RPC_TIMEOUT = _timeout_from_env("RPC", 3, 15)
+WEBHOOK_TIMEOUT = _timeout_from_env("WEBHOOK", 3, 5)
+
+
+def create_http_session(pool_size):
+    """Sesión de requests con pool de conexiones keep-alive reutilizables por host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Una sesión por upstream: el handshake TCP+TLS se paga una vez por conexión, no por petición
+deepseek_session = create_http_session(HTTP_POOL_SIZE)
+# Hermes suma los hilos de fondo (streaming, poller SSE, alertas, catálogo)
+hermes_session = create_http_session(HTTP_POOL_SIZE + 4)
+rpc_session = create_http_session(HTTP_POOL_SIZE)
+webhook_session = create_http_session(2)
+
+
+# ==========================
+# ⚡ Single-flight de llamadas salientes
+# ==========================
+
+class SingleFlight:
+    """Colapsa llamadas idénticas en vuelo: la primera va al upstream y las demás esperan su resultado.
+
+    No guarda nada una vez terminada la llamada, así que no agrega obsolescencia.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+                self.executed += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["event"].set()
+
+    def stats(self):
+        return {"executed": self.executed, "shared": self.shared}
+
+
+# Métodos RPC de solo lectura que se pueden compartir entre peticiones concurrentes
+SINGLE_FLIGHT_RPC_METHODS = {
+    "eth_getBalance", "eth_call", "eth_blockNumber", "eth_gasPrice", "eth_chainId",
+    "eth_estimateGas", "eth_getTransactionCount", "eth_getTransactionReceipt",
+    "eth_getTransactionByHash", "eth_getCode", "eth_feeHistory", "net_version"
+}
+
+rpc_flight = SingleFlight()
+
+
+class SingleFlightMiddleware(Web3Middleware):
+    """Middleware de Web3 que agrupa peticiones JSON-RPC idénticas (método + params) en vuelo."""
+
+    def wrap_make_request(self, make_request):
+        def middleware(method, params):
+            if method not in SINGLE_FLIGHT_RPC_METHODS:
+                return make_request(method, params)
+
+            key = (method, json.dumps(params, sort_keys=True, default=str))
+            response = rpc_flight.do(key, lambda: make_request(method, params))
+            # Cada llamador recibe su propia copia de la respuesta compartida
+            return copy.deepcopy(response)
+
+        return middleware
+
+
 # Inicializar Web3
-w3 = Web3(Web3.HTTPProvider(SCROLL_RPC_URL))
+w3 = Web3(Web3.HTTPProvider(SCROLL_RPC_URL, request_kwargs={"timeout": RPC_TIMEOUT}, session=rpc_session))
+w3.middleware_onion.add(SingleFlightMiddleware, "single_flight")
 
 # ABI del contrato STXTransfer
 CONTRACT_ABI = [
@@ -97,7 +239,7 @@ contract = w3.eth.contract(address=Web3.to_checksum_address(CONTRACT_ADDRESS), a
 
 # DeepSeek API
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-DEEPSEEK_URL = "https://api.deepseek.com/v1/chat/completions"
+DEEPSEEK_URL = os.getenv("DEEPSEEK_URL", "https://api.deepseek.com/v1/chat/completions")
 
 # Supabase Configuration
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -113,444 +255,2833 @@ if SUPABASE_URL and SUPABASE_KEY:
         print(f"⚠️ Error al conectar con Supabase: {e}")
 
 # ==========================
-# 🏠 Rutas del backend
+# ⛓️ Cabeza de la cadena y caché por bloque
 # ==========================
 
-@app.route("/", methods=["GET"])
-def home():
-    """Verifica que el servidor esté en funcionamiento."""
-    return jsonify({"status": "ok", "message": "✅ Backend Flask funcionando correctamente"})
+# Con BLOCK_CACHE=false todas las lecturas van al nodo
+BLOCK_CACHE = os.getenv("BLOCK_CACHE", "true").lower() == "true"
+# Intervalo de sondeo de eth_blockNumber (Scroll produce un bloque cada ~3 s)
+BLOCK_POLL_INTERVAL = float(os.getenv("BLOCK_POLL_INTERVAL", "1"))
+# Sin un sondeo correcto en este tiempo la cabeza se considera desconocida y no se usa la caché
+BLOCK_STALE_AFTER = float(os.getenv("BLOCK_STALE_AFTER", "10"))
+BLOCK_CACHE_SIZE = int(os.getenv("BLOCK_CACHE_SIZE", "20000"))
 
 
-# ======================================
-# 📊 Obtener información de la red
-# ======================================
-@app.route("/network-info", methods=["GET"])
-def network_info():
-    """Obtiene información sobre la red Scroll Sepolia."""
-    try:
-        is_connected = w3.is_connected()
-        latest_block = w3.eth.block_number if is_connected else None
-        
-        return jsonify({
-            "network": NETWORK,
-            "chain_id": CHAIN_ID,
-            "rpc_url": SCROLL_RPC_URL,
-            "contract_address": CONTRACT_ADDRESS,
-            "is_connected": is_connected,
-            "latest_block": latest_block,
-            "explorer_url": f"https://sepolia.scrollscan.com/address/{CONTRACT_ADDRESS}"
-        })
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+class BlockHeadTracker:
+    """Hilo daemon que sondea eth_blockNumber y mantiene el último bloque conocido.
 
+    Arranca con la primera lectura (los procesos que no leen la cadena no sondean).
+    current() devuelve None si el último sondeo correcto es más antiguo que
+    stale_after: en ese caso quien llama lee directamente del nodo.
+    """
 
-# ======================================
-# 🤖 Endpoint de chat con DeepSeek
-# ======================================
-@app.route("/chat", methods=["POST"])
-def chat():
-    """Interpreta comandos del usuario con IA y responde en formato JSON."""
-    try:
-        data = request.get_json()
-        user_message = data.get("message", "")
-        sender_wallet = data.get("sender_wallet", "")  # Wallet del usuario conectado
+    def __init__(self, poll_interval, stale_after):
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.head = None
+        self.last_update = None
+        self.last_error = None
+        self.polls = 0
+        self.advances = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
 
-        if not user_message:
-            return jsonify({"action": "none", "message": "No se envió ningún mensaje."}), 400
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="block-head-tracker", daemon=True)
+            self._thread.start()
 
-        # Headers y body para DeepSeek
-        headers = {
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-            "Content-Type": "application/json"
-        }
+    def stop(self):
+        self._stop.set()
 
-        body = {
-            "model": "deepseek-chat",
-            "messages": [
-                {
-                    "role": "system",
-                    "content": (
-                        "Eres un asistente inteligente para interpretar comandos hacia contratos inteligentes "
-                        "en la blockchain de Scroll Sepolia (una red compatible con Ethereum) y gestionar usuarios en la base de datos. "
-                        f"La wallet del usuario conectado es: {sender_wallet if sender_wallet else 'NO PROPORCIONADA'}. "
-                        "Analiza los comandos del usuario y extrae información relevante. "
-                        "Devuelve SIEMPRE una respuesta JSON con las siguientes claves:\n\n"
-                        
-                        "ACCIONES DISPONIBLES:\n"
-                        "- 'transfer': Transferir ETH a una wallet directamente (direcciones que empiezan con 0x)\n"
-                        "- 'transfer_to_contact': Transferir ETH a un contacto por su nombre\n"
-                        "- 'balance': Consultar balance de una wallet\n"
-                        "- 'network_info': Obtener información de la red Scroll Sepolia\n"
-                        "- 'list_users': Listar todos los usuarios\n"
-                        "- 'get_user': Obtener info de un usuario específico\n"
-                        "- 'create_user': Crear un nuevo usuario\n"
-                        "- 'get_contacts': Obtener contactos de un usuario\n"
-                        "- 'create_contact': Crear un nuevo contacto\n"
-                        "- 'none': Ninguna acción específica\n\n"
-                        
-                        "ESTRUCTURA DE RESPUESTA:\n"
-                        "- 'action': una de las acciones listadas arriba\n"
-                        "- 'message': explicación breve de lo que se hará\n"
-                        "- Campos adicionales según la acción:\n\n"
-                        
-                        "EJEMPLOS:\n\n"
-                        
-                        "1. Transferencia ETH (por wallet):\n"
-                        "Usuario: 'Transfiere 0.5 ETH a 0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb'\n"
-                        "Respuesta: {\"action\": \"transfer\", \"recipient\": \"0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb\", \"amount\": 0.5, \"message\": \"Transferir 0.5 ETH\"}\n\n"
-                        
-                        "1b. Transferencia ETH (por nombre de contacto):\n"
-                        "Usuario: 'Envía 0.1 ETH a Andrés'\n"
-                        "Respuesta: {\"action\": \"transfer_to_contact\", \"contact_name\": \"Andrés\", \"amount\": 0.1, \"sender_wallet\": \"0x123...\", \"message\": \"Buscar contacto Andrés y transferir 0.1 ETH\"}\n"
-                        "IMPORTANTE: Para esta acción, SIEMPRE incluye el sender_wallet que viene en el contexto del mensaje.\n\n"
-                        
-                        "2. Balance:\n"
-                        "Usuario: '¿Cuál es el balance de 0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb?'\n"
-                        "Respuesta: {\"action\": \"balance\", \"address\": \"0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb\", \"message\": \"Consultando balance\"}\n\n"
-                        
-                        "3. Listar usuarios:\n"
-                        "Usuario: 'Muéstrame todos los usuarios' o '¿Cuántos usuarios hay?'\n"
-                        "Respuesta: {\"action\": \"list_users\", \"message\": \"Obteniendo lista de usuarios\"}\n\n"
-                        
-                        "4. Buscar usuario:\n"
-                        "Usuario: 'Busca el usuario con wallet 0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb'\n"
-                        "Respuesta: {\"action\": \"get_user\", \"wallet_address\": \"0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb\", \"message\": \"Buscando usuario\"}\n\n"
-                        
-                        "5. Crear usuario:\n"
-                        "Usuario: 'Registra un usuario llamado Juan con wallet 0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb'\n"
-                        "Respuesta: {\"action\": \"create_user\", \"username\": \"Juan\", \"wallet_address\": \"0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb\", \"message\": \"Creando usuario Juan\"}\n\n"
-                        
-                        "6. Ver contactos:\n"
-                        "Usuario: 'Muéstrame los contactos del usuario 123e4567-e89b-12d3-a456-426614174000'\n"
-                        "Respuesta: {\"action\": \"get_contacts\", \"user_id\": \"123e4567-e89b-12d3-a456-426614174000\", \"message\": \"Obteniendo contactos\"}\n\n"
-                        
-                        "7. Crear contacto:\n"
-                        "Usuario: 'Agrega a María con wallet 0x742d35... como contacto del usuario 123e4567...'\n"
-                        "Respuesta: {\"action\": \"create_contact\", \"user_id\": \"123e4567...\", \"nombre\": \"María\", \"wallet_address\": \"0x742d35...\", \"message\": \"Agregando contacto\"}\n\n"
-                        
-                        "IMPORTANTE: Las direcciones Ethereum siempre empiezan con '0x' seguido de 40 caracteres hexadecimales."
-                    )
-                },
-                {"role": "user", "content": user_message}
-            ]
+    def current(self):
+        if self._thread is None:
+            self.start()
+        if self.last_update is None or time.monotonic() - self.last_update > self.stale_after:
+            return None
+        return self.head
+
+    def status(self):
+        return {
+            "head": self.head,
+            "stale": self.last_update is None or time.monotonic() - self.last_update > self.stale_after,
+            "seconds_since_update": round(time.monotonic() - self.last_update, 3) if self.last_update else None,
+            "polls": self.polls,
+            "advances": self.advances,
+            "last_error": self.last_error
         }
 
-        # Petición a DeepSeek
-        response = requests.post(DEEPSEEK_URL, headers=headers, json=body)
-        result = response.json()
-
-        # --------------------------
-        # 🔍 Extraer texto de la IA
-        # --------------------------
-        ia_text = None
-        if "choices" in result:
-            ia_text = result["choices"][0]["message"]["content"]
-        elif "output_text" in result:
-            ia_text = result["output_text"]
-        elif "data" in result and "output_text" in result["data"]:
-            ia_text = result["data"]["output_text"]
-        else:
-            ia_text = str(result)
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                head = w3.eth.block_number
+                if self.head is None or head > self.head:
+                    self.head = head
+                    self.advances += 1
+                self.last_update = time.monotonic()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+            self.polls += 1
+            self._stop.wait(self.poll_interval)
 
-        # --------------------------
-        # 🧹 Limpiar y parsear JSON
-        # --------------------------
-        ia_text = ia_text.strip()
-        if ia_text.startswith("```"):
-            ia_text = ia_text.replace("```json", "").replace("```", "").strip()
 
-        try:
-            ia_json = json.loads(ia_text)
-        except Exception:
-            # Si no es JSON, intentar deducir la acción
-            action = "none"
-            msg_lower = user_message.lower()
-            
-            # Detectar si menciona "enviar" o "transferir" con un nombre (no una wallet)
-            if ("transferir" in msg_lower or "transfiere" in msg_lower or 
-                "enviar" in msg_lower or "envía" in msg_lower or "envia" in msg_lower):
-                # Si NO contiene una wallet address Ethereum (0x...)
-                if "0x" not in user_message.lower():
-                    action = "transfer_to_contact"
-                else:
-                    action = "transfer"
-            elif "balance" in msg_lower or "saldo" in msg_lower:
-                action = "balance"
-            elif "red" in msg_lower or "network" in msg_lower or "info" in msg_lower:
-                action = "network_info"
-            elif "usuarios" in msg_lower or "listar usuarios" in msg_lower or "ver usuarios" in msg_lower:
-                action = "list_users"
-            elif "crear usuario" in msg_lower or "registrar usuario" in msg_lower or "nuevo usuario" in msg_lower:
-                action = "create_user"
-            elif "contactos" in msg_lower or "ver contactos" in msg_lower:
-                action = "get_contacts"
-            elif "crear contacto" in msg_lower or "agregar contacto" in msg_lower or "nuevo contacto" in msg_lower:
-                action = "create_contact"
-            elif "buscar usuario" in msg_lower or "encontrar usuario" in msg_lower:
-                action = "get_user"
-
-            ia_json = {"action": action, "message": ia_text}
+class BlockScopedCache:
+    """Caché de lecturas de la cadena válidas mientras no avance la cabeza.
 
-        # Asegurar que sender_wallet esté presente si fue proporcionado
-        if sender_wallet and "sender_wallet" not in ia_json:
-            ia_json["sender_wallet"] = sender_wallet
+    Las entradas pertenecen al bloque en que se leyeron y se descartan todas
+    juntas cuando el tracker ve un bloque nuevo. Si la cabeza es desconocida
+    (tracker caído o desactivado) no se cachea nada. Los valores se comparten
+    entre peticiones: quien los recibe no debe modificarlos.
+    """
 
-        # ========================================
-        # 🤖 EJECUTAR ACCIONES DE BASE DE DATOS
-        # ========================================
-        action = ia_json.get("action")
-        
-        # ==========================================
-        # 💸 TRANSFERENCIA A CONTACTO POR NOMBRE
-        # ==========================================
-        if action == "transfer_to_contact":
-            contact_name = ia_json.get("contact_name")
-            amount = ia_json.get("amount")
-            sender_wallet_from_json = ia_json.get("sender_wallet")
-            
-            # Usar sender_wallet del request si no viene en el JSON de la IA
-            if not sender_wallet_from_json and sender_wallet:
-                sender_wallet_from_json = sender_wallet
-            
-            if not sender_wallet_from_json:
-                ia_json["error"] = "Se requiere la wallet del remitente (sender_wallet)"
-                ia_json["message"] = "❌ Debes proporcionar tu wallet conectada para buscar tus contactos"
-            elif not contact_name:
-                ia_json["error"] = "No se pudo identificar el nombre del contacto"
-                ia_json["message"] = "❌ Por favor especifica el nombre del contacto"
-            elif not amount or amount <= 0:
-                ia_json["error"] = "No se pudo identificar la cantidad a transferir"
-                ia_json["message"] = "❌ Por favor especifica una cantidad válida de STX"
-            elif supabase:
-                try:
-                    # 1. Buscar el usuario por su wallet
-                    user_response = supabase.table("users").select("id, username").eq("wallet_address", sender_wallet_from_json).execute()
-                    
-                    if not user_response.data:
-                        ia_json["error"] = "No se encontró un usuario con esa wallet"
-                        ia_json["message"] = f"❌ Tu wallet {sender_wallet_from_json} no está registrada. Regístrate primero."
-                    else:
-                        user_id = user_response.data[0]["id"]
-                        username = user_response.data[0]["username"]
-                        
-                        # 2. Buscar el contacto por nombre (case-insensitive)
-                        contacts_response = supabase.table("contacts").select("*").eq("user_id", user_id).execute()
-                        
-                        if not contacts_response.data:
-                            ia_json["error"] = "No tienes contactos registrados"
-                            ia_json["message"] = f"❌ {username}, aún no tienes contactos. Agrega algunos primero."
-                        else:
-                            # Buscar contacto por nombre (ignorando mayúsculas/minúsculas y espacios)
-                            contact_found = None
-                            search_name = contact_name.strip().lower()
-                            
-                            for contact in contacts_response.data:
-                                if contact["nombre"].strip().lower() == search_name:
-                                    contact_found = contact
-                                    break
-                            
-                            if not contact_found:
-                                # Intentar búsqueda parcial
-                                for contact in contacts_response.data:
-                                    if search_name in contact["nombre"].strip().lower():
-                                        contact_found = contact
-                                        break
-                            
-                            if contact_found:
-                                # ✅ Contacto encontrado, preparar transferencia
-                                ia_json["action"] = "transfer"  # Cambiar a acción de transferencia
-                                ia_json["recipient"] = contact_found["wallet_address"]
-                                ia_json["recipient_name"] = contact_found["nombre"]
-                                ia_json["amount"] = amount
-                                ia_json["sender"] = sender_wallet_from_json
-                                ia_json["contact_id"] = contact_found["id"]
-                                ia_json["message"] = f"✅ Contacto '{contact_found['nombre']}' encontrado. Preparando transferencia de {amount} STX a {contact_found['wallet_address']}"
-                                ia_json["success"] = True
-                            else:
-                                # Listar contactos disponibles
-                                available_contacts = [c["nombre"] for c in contacts_response.data]
-                                ia_json["error"] = f"Contacto '{contact_name}' no encontrado"
-                                ia_json["message"] = f"❌ No encontré a '{contact_name}' en tus contactos."
-                                ia_json["available_contacts"] = available_contacts
-                                ia_json["suggestion"] = f"Contactos disponibles: {', '.join(available_contacts)}"
-                
-                except Exception as e:
-                    ia_json["error"] = f"Error al buscar contacto: {str(e)}"
-                    ia_json["message"] = "❌ Hubo un error al buscar en tus contactos"
+    def __init__(self, tracker, max_size, enabled=True):
+        self.tracker = tracker
+        self.max_size = max_size
+        self.enabled = enabled
+        self._block = None
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def head(self):
+        """Bloque actual si la caché está activa y la cabeza es conocida; None en otro caso."""
+        return self.tracker.current() if self.enabled else None
+
+    def get(self, kind, key, head):
+        if head is None:
+            self.bypassed += 1
+            return None
+        with self._lock:
+            value = self._entries.get((kind, key)) if self._block == head else None
+            if value is None:
+                self.misses += 1
             else:
-                ia_json["error"] = "Supabase no está configurado"
-                ia_json["message"] = "❌ La base de datos no está disponible"
-        
-        # Listar usuarios
-        elif action == "list_users":
-            try:
-                if supabase:
-                    response = supabase.table("users").select("*").execute()
-                    ia_json["users"] = response.data
-                    ia_json["count"] = len(response.data)
-                    ia_json["message"] = f"Se encontraron {len(response.data)} usuarios registrados"
-                else:
-                    ia_json["error"] = "Supabase no está configurado"
-            except Exception as e:
-                ia_json["error"] = f"Error al obtener usuarios: {str(e)}"
-        
-        # Buscar usuario por wallet
-        elif action == "get_user":
-            wallet = ia_json.get("wallet_address")
-            if wallet and supabase:
-                try:
-                    response = supabase.table("users").select("*").eq("wallet_address", wallet).execute()
-                    if response.data:
-                        ia_json["user"] = response.data[0]
-                        ia_json["message"] = f"Usuario encontrado: {response.data[0].get('username')}"
-                    else:
-                        ia_json["message"] = "No se encontró ningún usuario con esa wallet"
-                except Exception as e:
-                    ia_json["error"] = f"Error al buscar usuario: {str(e)}"
-        
-        # Crear usuario
-        elif action == "create_user":
-            username = ia_json.get("username")
-            wallet = ia_json.get("wallet_address")
-            if username and wallet and supabase:
-                try:
-                    response = supabase.table("users").insert({
-                        "username": username,
-                        "wallet_address": wallet
-                    }).execute()
-                    ia_json["user"] = response.data[0]
-                    ia_json["message"] = f"✅ Usuario '{username}' creado exitosamente"
-                except Exception as e:
-                    error_msg = str(e)
-                    if "duplicate" in error_msg.lower():
-                        ia_json["error"] = "Esta wallet ya está registrada"
-                    else:
-                        ia_json["error"] = f"Error al crear usuario: {error_msg}"
-        
-        # Obtener contactos de un usuario
-        elif action == "get_contacts":
-            user_id = ia_json.get("user_id")
-            if user_id and supabase:
-                try:
-                    response = supabase.table("contacts").select("*").eq("user_id", user_id).execute()
-                    ia_json["contacts"] = response.data
-                    ia_json["count"] = len(response.data)
-                    ia_json["message"] = f"Se encontraron {len(response.data)} contactos"
-                except Exception as e:
-                    ia_json["error"] = f"Error al obtener contactos: {str(e)}"
-        
-        # Crear contacto
-        elif action == "create_contact":
-            user_id = ia_json.get("user_id")
-            nombre = ia_json.get("nombre")
-            wallet = ia_json.get("wallet_address")
-            if user_id and nombre and wallet and supabase:
+                self.hits += 1
+            return value
+
+    def put(self, kind, key, head, value):
+        if head is None or value is None:
+            return
+        with self._lock:
+            if self._block is None or head > self._block:
+                self._block = head
+                self._entries = {}
+            if head != self._block or len(self._entries) >= self.max_size:
+                return
+            self._entries[(kind, key)] = value
+
+    def get_or_load(self, kind, key, loader):
+        head = self.head()
+        value = self.get(kind, key, head)
+        if value is None:
+            value = loader()
+            self.put(kind, key, head, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "block": self._block,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None
+            }
+
+
+block_head = BlockHeadTracker(BLOCK_POLL_INTERVAL, BLOCK_STALE_AFTER)
+block_cache = BlockScopedCache(block_head, BLOCK_CACHE_SIZE, enabled=BLOCK_CACHE)
+
+
+def chain_gas_price():
+    """gasPrice del nodo, cacheado hasta el siguiente bloque."""
+    return block_cache.get_or_load("gas_price", None, lambda: w3.eth.gas_price)
+
+
+# ==========================
+# ⛽ Oráculo de comisiones EIP-1559 (eth_feeHistory)
+# ==========================
+
+# Con FEE_ORACLE=false las transferencias usan gasPrice legacy como antes
+FEE_ORACLE = os.getenv("FEE_ORACLE", "true").lower() == "true"
+# Bloques de historial por consulta y cada cuántos segundos se refresca (solo si hay bloque nuevo)
+FEE_HISTORY_BLOCKS = int(os.getenv("FEE_HISTORY_BLOCKS", "20"))
+FEE_ORACLE_REFRESH = float(os.getenv("FEE_ORACLE_REFRESH", "3"))
+# Con un historial más antiguo que esto las cotizaciones no se usan (se vuelve a gasPrice)
+FEE_ORACLE_MAX_AGE = float(os.getenv("FEE_ORACLE_MAX_AGE", "60"))
+
+# Por velocidad: percentil de la propina pagada en los últimos bloques y margen sobre el base fee siguiente
+FEE_TIERS = {
+    "slow": {"percentile": 10, "base_fee_multiplier": 1.125},
+    "standard": {"percentile": 50, "base_fee_multiplier": 1.25},
+    "fast": {"percentile": 90, "base_fee_multiplier": 2.0}
+}
+DEFAULT_FEE_SPEED = os.getenv("DEFAULT_FEE_SPEED", "standard")
+
+
+def _percentile(values, percentile):
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class FeeOracle:
+    """Cotizaciones EIP-1559 (slow/standard/fast) a partir de eth_feeHistory.
+
+    Un hilo daemon pide el historial de los últimos FEE_HISTORY_BLOCKS bloques
+    cuando la cabeza avanza (como mucho cada FEE_ORACLE_REFRESH segundos) y
+    guarda en memoria el base fee del siguiente bloque, los percentiles del
+    base fee reciente y la mediana por bloque de cada percentil de propina.
+    quote() responde sin ir al nodo; devuelve None si no hay historial reciente.
+    """
+
+    def __init__(self, tiers, history_blocks, refresh_interval, max_age):
+        self.tiers = tiers
+        self.history_blocks = history_blocks
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.quotes = None
+        self.base_fee_percentiles = None
+        self.block = None
+        self.last_update = None
+        self.last_error = None
+        self.refreshes = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="fee-oracle", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def refresh(self):
+        percentiles = sorted({tier["percentile"] for tier in self.tiers.values()})
+        history = w3.eth.fee_history(self.history_blocks, "latest", percentiles)
+        base_fees = list(history["baseFeePerGas"])
+        rewards = [row for row in (history.get("reward") or []) if row]
+        next_base_fee = base_fees[-1]
+
+        quotes = {}
+        for speed, tier in self.tiers.items():
+            column = percentiles.index(tier["percentile"])
+            priority_fee = _percentile([row[column] for row in rewards], 50)
+            max_fee = int(next_base_fee * tier["base_fee_multiplier"]) + priority_fee
+            quotes[speed] = {
+                "max_fee_per_gas": max_fee,
+                "max_priority_fee_per_gas": priority_fee,
+                # Lo que se espera pagar si el base fee no sube
+                "expected_gas_price": next_base_fee + priority_fee
+            }
+
+        with self._lock:
+            self.quotes = quotes
+            self.base_fee_percentiles = {
+                "next": next_base_fee,
+                **{f"p{p}": _percentile(base_fees[:-1] or base_fees, p) for p in (10, 50, 90)}
+            }
+            self.block = history["oldestBlock"] + len(base_fees) - 2
+            self.last_update = time.monotonic()
+            self.last_error = None
+            self.refreshes += 1
+
+    def quote(self, speed=DEFAULT_FEE_SPEED):
+        if self._thread is None:
+            self.start()
+        if self.last_update is None or time.monotonic() - self.last_update > self.max_age:
+            return None
+        return (self.quotes or {}).get(speed)
+
+    def status(self):
+        return {
+            "block": self.block,
+            "stale": self.last_update is None or time.monotonic() - self.last_update > self.max_age,
+            "seconds_since_update": round(time.monotonic() - self.last_update, 3) if self.last_update else None,
+            "refreshes": self.refreshes,
+            "base_fee": self.base_fee_percentiles,
+            "quotes": self.quotes,
+            "last_error": self.last_error
+        }
+
+    def _run(self):
+        while not self._stop.is_set():
+            head = block_head.current()
+            if head is None or head != self.block:
                 try:
-                    response = supabase.table("contacts").insert({
-                        "user_id": user_id,
-                        "nombre": nombre,
-                        "wallet_address": wallet
-                    }).execute()
-                    ia_json["contact"] = response.data[0]
-                    ia_json["message"] = f"✅ Contacto '{nombre}' agregado exitosamente"
+                    self.refresh()
                 except Exception as e:
-                    error_msg = str(e)
-                    if "duplicate" in error_msg.lower():
-                        ia_json["error"] = "Este contacto ya existe"
-                    else:
-                        ia_json["error"] = f"Error al crear contacto: {error_msg}"
+                    self.last_error = str(e)
+            self._stop.wait(self.refresh_interval)
 
-        return jsonify(ia_json)
 
-    except Exception as e:
-        return jsonify({"action": "none", "message": f"Error: {str(e)}"}), 500
+fee_oracle = FeeOracle(FEE_TIERS, FEE_HISTORY_BLOCKS, FEE_ORACLE_REFRESH, FEE_ORACLE_MAX_AGE)
 
 
-# ======================================
-# 💰 Verificar balance de una wallet
-# ======================================
-@app.route("/api/balance/<address>", methods=["GET"])
-def get_balance(address):
-    """Consulta el balance de ETH de una dirección en Scroll Sepolia."""
-    try:
-        if not address:
-            return jsonify({"error": "Se requiere una dirección"}), 400
-        
-        # Validar formato de dirección Ethereum
-        if not Web3.is_address(address):
-            return jsonify({"error": "Dirección inválida. Debe ser una dirección Ethereum válida"}), 400
-        
-        # Convertir a checksum address
-        checksum_address = Web3.to_checksum_address(address)
-        
-        # Obtener balance nativo (ETH)
-        balance_wei = w3.eth.get_balance(checksum_address)
-        balance_eth = w3.from_wei(balance_wei, 'ether')
-        
-        # Obtener balance según el contrato (si es diferente)
+# ==========================
+# 📐 Caché de estimaciones de gas
+# ==========================
+
+# Con GAS_ESTIMATE_CACHE=false cada cotización llama a eth_estimateGas
+GAS_ESTIMATE_CACHE = os.getenv("GAS_ESTIMATE_CACHE", "true").lower() == "true"
+# Margen de seguridad sobre la mayor estimación observada para la entrada
+GAS_ESTIMATE_MARGIN = float(os.getenv("GAS_ESTIMATE_MARGIN", "0.1"))
+# Revalidar con una estimación real cada N usos o cada tantos segundos (lo que llegue antes)
+GAS_ESTIMATE_REVALIDATE_USES = int(os.getenv("GAS_ESTIMATE_REVALIDATE_USES", "100"))
+GAS_ESTIMATE_REVALIDATE_SECONDS = float(os.getenv("GAS_ESTIMATE_REVALIDATE_SECONDS", "300"))
+# Direcciones cuyo "tiene código" se recuerda y durante cuánto tiempo
+GAS_CODE_CACHE_SIZE = int(os.getenv("GAS_CODE_CACHE_SIZE", "10000"))
+GAS_CODE_CACHE_TTL = float(os.getenv("GAS_CODE_CACHE_TTL", "3600"))
+
+
+class GasEstimateCache:
+    """Estimaciones de gas memorizadas por (función, destinatario es contrato, orden de magnitud del valor).
+
+    El gas de transferSTX apenas varía entre destinatarios y montos, salvo si el
+    destinatario es un contrato (ejecuta su receive). En un fallo se piden al nodo
+    eth_getCode y eth_estimateGas en un solo lote; en un acierto se devuelve la
+    mayor estimación observada más GAS_ESTIMATE_MARGIN, y cada cierto número de
+    usos o de segundos se revalida en segundo plano con una estimación real.
+    """
+
+    def __init__(self, margin, revalidate_uses, revalidate_seconds, code_cache_size, code_cache_ttl, enabled=True):
+        self.margin = margin
+        self.revalidate_uses = revalidate_uses
+        self.revalidate_seconds = revalidate_seconds
+        self.code_cache_size = code_cache_size
+        self.code_cache_ttl = code_cache_ttl
+        self.enabled = enabled
+        self._entries = {}
+        self._has_code = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.drift = 0
+
+    @staticmethod
+    def value_bucket(value_wei):
+        return len(str(value_wei)) if value_wei > 0 else 0
+
+    def _cached_has_code(self, address):
+        with self._lock:
+            cached = self._has_code.get(address)
+            if cached is None or time.monotonic() - cached[1] > self.code_cache_ttl:
+                return None
+            self._has_code.move_to_end(address)
+            return cached[0]
+
+    def _remember_code(self, address, has_code):
+        with self._lock:
+            self._has_code[address] = (has_code, time.monotonic())
+            self._has_code.move_to_end(address)
+            while len(self._has_code) > self.code_cache_size:
+                self._has_code.popitem(last=False)
+
+    def _live(self, function_name, sender, recipient, value_wei, include_code):
+        """(gas, tiene_código) desde el nodo en un lote; gas es RPCError si la estimación falla."""
+        tx = {
+            "from": sender,
+            "to": contract.address,
+            "value": hex(value_wei),
+            "data": contract.encode_abi(function_name, args=[recipient])
+        }
+        calls = [("eth_estimateGas", [tx])]
+        if include_code:
+            calls.append(("eth_getCode", [recipient, "latest"]))
+        results = rpc_batch(calls)
+        gas = results[0] if isinstance(results[0], Exception) else int(results[0], 16)
+        has_code = None
+        if include_code and not isinstance(results[1], Exception):
+            has_code = results[1] not in (None, "0x", "0x0")
+            self._remember_code(recipient, has_code)
+        return gas, has_code
+
+    def _store(self, key, gas):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = {"gas": gas, "uses": 0, "validated_at": now, "revalidating": False}
+                return
+            if gas > entry["gas"]:
+                self.drift += 1
+            entry["gas"] = max(entry["gas"], gas)
+            entry["uses"] = 0
+            entry["validated_at"] = now
+            entry["revalidating"] = False
+
+    def _revalidate(self, key, function_name, sender, recipient, value_wei):
         try:
-            contract_balance_wei = contract.functions.getBalance(checksum_address).call()
-            contract_balance_eth = w3.from_wei(contract_balance_wei, 'ether')
-        except:
-            contract_balance_wei = balance_wei
-            contract_balance_eth = balance_eth
-        
-        return jsonify({
-            "address": checksum_address,
-            "balance": float(balance_eth),
-            "balance_wei": str(balance_wei),
-            "contract_balance": float(contract_balance_eth),
-            "contract_balance_wei": str(contract_balance_wei),
-            "message": f"Balance: {balance_eth} ETH",
-            "network": NETWORK,
-            "chain_id": CHAIN_ID
-        })
-        
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+            gas, _ = self._live(function_name, sender, recipient, value_wei, include_code=False)
+            if isinstance(gas, Exception):
+                raise gas
+            self._store(key, gas)
+            self.revalidations += 1
+        except Exception:
+            with self._lock:
+                if key in self._entries:
+                    self._entries[key]["revalidating"] = False
 
+    def estimate(self, function_name, sender, recipient, value_wei):
+        """Devuelve (gas, origen) con origen "cache" o "live". Lanza si la estimación real falla."""
+        if not self.enabled:
+            gas, _ = self._live(function_name, sender, recipient, value_wei, include_code=False)
+            if isinstance(gas, Exception):
+                raise gas
+            return gas, "live"
 
-# Ruta alternativa POST para compatibilidad
-@app.route("/get-balance", methods=["POST"])
-def get_balance_post():
-    """Consulta el balance de ETH (versión POST)."""
-    try:
-        data = request.get_json()
-        address = data.get("address", "")
-        
-        if not address:
-            return jsonify({"error": "Se requiere una dirección"}), 400
-        
-        # Redirigir a la función principal
-        return get_balance(address)
-        
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        has_code = self._cached_has_code(recipient)
+        if has_code is not None:
+            key = (function_name, has_code, self.value_bucket(value_wei))
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    entry["uses"] += 1
+                    due = entry["uses"] >= self.revalidate_uses or time.monotonic() - entry["validated_at"] > self.revalidate_seconds
+                    if due and not entry["revalidating"]:
+                        entry["revalidating"] = True
+                        rpc_batch_executor.submit(self._revalidate, key, function_name, sender, recipient, value_wei)
+                    return math.ceil(round(entry["gas"] * (1 + self.margin), 6)), "cache"
 
+        with self._lock:
+            self.misses += 1
+        gas, live_has_code = self._live(function_name, sender, recipient, value_wei, include_code=has_code is None)
+        if isinstance(gas, Exception):
+            raise gas
+        has_code = has_code if has_code is not None else live_has_code
+        if has_code is not None:
+            self._store((function_name, has_code, self.value_bucket(value_wei)), gas)
+        return gas, "live"
 
-# ======================================
-# 💸 Preparar transacción de transferencia
-# ======================================
-@app.route("/prepare-transfer", methods=["POST"])
-def prepare_transfer():
-    """Prepara los datos para una transferencia de ETH en Scroll Sepolia."""
-    try:
-        data = request.get_json()
-        recipient = data.get("recipient", "")
-        amount = data.get("amount", 0)
-        sender = data.get("sender", "")
-        
-        # Validaciones
-        if not recipient or not sender:
-            return jsonify({
-                "error": "Se requieren las direcciones del remitente y destinatario"
-            }), 400
-        
-        if not Web3.is_address(recipient) or not Web3.is_address(sender):
-            return jsonify({
-                "error": "Dirección inválida. Deben ser direcciones Ethereum válidas"
-            }), 400
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": {f"{name}:{'contract' if has_code else 'eoa'}:1e{bucket}": entry["gas"] for (name, has_code, bucket), entry in self._entries.items()},
+                "known_addresses": len(self._has_code),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "revalidations": self.revalidations,
+                "drift": self.drift,
+                "margin": self.margin
+            }
+
+
+gas_estimates = GasEstimateCache(
+    GAS_ESTIMATE_MARGIN,
+    GAS_ESTIMATE_REVALIDATE_USES,
+    GAS_ESTIMATE_REVALIDATE_SECONDS,
+    GAS_CODE_CACHE_SIZE,
+    GAS_CODE_CACHE_TTL,
+    enabled=GAS_ESTIMATE_CACHE
+)
+
+
+# ==========================
+# 🗄️ Bloqueos de SQLite con gevent
+# ==========================
+
+# El busy timeout de sqlite3 espera en C y, con gevent, bloquea todo el worker. En ese modo
+# las conexiones usan un timeout corto y la espera se hace reintentando con time.sleep,
+# que cede el control a los demás greenlets
+SQLITE_COOPERATIVE_BUSY_TIMEOUT = float(os.getenv("SQLITE_COOPERATIVE_BUSY_TIMEOUT", "0.05"))
+
+
+def sqlite_busy_timeout(timeout):
+    """Timeout para sqlite3.connect: el completo con hilos, uno corto con gevent."""
+    return min(timeout, SQLITE_COOPERATIVE_BUSY_TIMEOUT) if ASYNC_SERVING else timeout
+
+
+def sqlite_retry_locked(operation, timeout):
+    """Ejecuta operation() (una transacción completa) y, con gevent, la reintenta mientras la base esté bloqueada."""
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    while True:
+        try:
+            return operation()
+        except sqlite3.OperationalError as e:
+            if not ASYNC_SERVING or "locked" not in str(e) or time.monotonic() >= deadline:
+                raise
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+
+
+# ==========================
+# 🔢 Gestor de nonces de la cuenta del servidor
+# ==========================
+
+# Estado compartido entre workers: SQLite con bloqueo de escritura (BEGIN IMMEDIATE)
+NONCE_DB = os.getenv("NONCE_DB", "nonces.db")
+NONCE_LOCK_TIMEOUT = float(os.getenv("NONCE_LOCK_TIMEOUT", "10"))
+# Cada cuánto se contrasta el nonce local con el pending count de la cadena
+NONCE_RECONCILE_SECONDS = float(os.getenv("NONCE_RECONCILE_SECONDS", "30"))
+# Si el nonce local sigue por delante de la cadena este tiempo, se asume un hueco (tx descartada)
+NONCE_GAP_TIMEOUT = float(os.getenv("NONCE_GAP_TIMEOUT", "120"))
+
+NONCE_ERROR_MARKERS = ("nonce too low", "nonce too high", "invalid nonce", "already known", "replacement transaction underpriced")
+
+
+def is_nonce_error(error):
+    message = str(error).lower()
+    return any(marker in message for marker in NONCE_ERROR_MARKERS)
+
+
+def is_unknown_send_outcome(error):
+    """True si un envío que falló pudo llegar al nodo igualmente (timeout o conexión cortada)."""
+    return isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError))
+
+
+class NonceManager:
+    """Reparte nonces para las transacciones firmadas por el servidor.
+
+    El estado de cada cuenta vive en SQLite (creado en la primera reserva) y
+    cada reserva es una transacción BEGIN IMMEDIATE, así que hilos y workers de
+    gunicorn en la misma máquina nunca reciben el mismo nonce. Los nonces cuyo
+    envío falló van a una lista libre y se reparten (el menor primero) antes que
+    `next_nonce`, que solo avanza: al reconciliar con el pending count del nodo
+    pasa a max(next_nonce, pending) y se descartan los libres que el nodo ya
+    tiene. El pending count se pide antes de tomar los bloqueos, cuando toca:
+    la primera vez en cada proceso, cada `reconcile_seconds` y tras un error de
+    nonce. Si el nodo sigue por detrás más de `gap_timeout`, su pending count se
+    da por hueco (tx descartada) y pasa a la lista libre.
+    """
+
+    def __init__(self, db_path, lock_timeout, reconcile_seconds, gap_timeout):
+        self.db_path = db_path
+        self.lock_timeout = lock_timeout
+        self.reconcile_seconds = reconcile_seconds
+        self.gap_timeout = gap_timeout
+        self._lock = threading.Lock()
+        self._db_ready = False
+        self._reconciled = set()
+        self.reserved = 0
+        self.released = 0
+        self.reused = 0
+        self.reconciles = 0
+        self.gaps = 0
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=sqlite_busy_timeout(self.lock_timeout), isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        if not self._db_ready:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS nonces (
+                    address TEXT PRIMARY KEY,
+                    next_nonce INTEGER NOT NULL,
+                    free TEXT NOT NULL DEFAULT '[]',
+                    reconcile INTEGER NOT NULL DEFAULT 0,
+                    ahead_since REAL,
+                    reconciled_at REAL NOT NULL
+                )
+            """)
+            self._db_ready = True
+        return connection
+
+    @staticmethod
+    def _state(row):
+        return dict(row, free=json.loads(row["free"])) if row else None
+
+    def _read(self, address):
+        """Lee el estado sin bloqueo, para decidir si hay que pedir el pending count."""
+        def read():
+            connection = self._connect()
+            try:
+                return self._state(connection.execute("SELECT * FROM nonces WHERE address = ?", (address,)).fetchone())
+            finally:
+                connection.close()
+
+        return sqlite_retry_locked(read, self.lock_timeout)
+
+    def _locked(self, address, update):
+        """Ejecuta update(fila) con el bloqueo del proceso y el de SQLite (entre procesos) y guarda la fila.
+
+        update devuelve (resultado, fila_nueva); con fila_nueva None no se escribe nada.
+        """
+        def transaction():
+            connection = self._connect()
+            try:
+                connection.execute("BEGIN IMMEDIATE")
+                state = self._state(connection.execute("SELECT * FROM nonces WHERE address = ?", (address,)).fetchone())
+                result, state = update(state)
+                if state is not None:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO nonces (address, next_nonce, free, reconcile, ahead_since, reconciled_at) VALUES (?, ?, ?, ?, ?, ?)",
+                        (address, state["next_nonce"], json.dumps(sorted(state["free"])), state["reconcile"], state["ahead_since"], state["reconciled_at"])
+                    )
+                connection.execute("COMMIT")
+                return result
+            except Exception:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                raise
+            finally:
+                connection.close()
+
+        with self._lock:
+            return sqlite_retry_locked(transaction, self.lock_timeout)
+
+    def _needs_reconcile(self, address, state, now):
+        return (
+            state is None
+            or state["reconcile"]
+            or address not in self._reconciled
+            or now - state["reconciled_at"] > self.reconcile_seconds
+        )
+
+    def _reconcile(self, address, state, pending, now):
+        self.reconciles += 1
+        self._reconciled.add(address)
+        if state is None:
+            return {"next_nonce": pending, "free": [], "reconcile": 0, "ahead_since": None, "reconciled_at": now}
+
+        # Solo hacia delante: lo que el nodo ya tiene no se vuelve a repartir
+        state = dict(
+            state,
+            next_nonce=max(state["next_nonce"], pending),
+            free=[nonce for nonce in state["free"] if nonce >= pending],
+            reconcile=0,
+            reconciled_at=now
+        )
+        if pending >= state["next_nonce"]:
+            state["ahead_since"] = None
+        else:
+            # Por delante del nodo es normal con transacciones en vuelo; si dura, falta su pending count
+            state["ahead_since"] = state["ahead_since"] or now
+            if now - state["ahead_since"] > self.gap_timeout:
+                if pending not in state["free"]:
+                    state["free"].append(pending)
+                    self.gaps += 1
+                state["ahead_since"] = now
+        return state
+
+    def reserve(self, address):
+        """Reserva y devuelve un nonce de la cuenta: el menor libre o el siguiente."""
+        while True:
+            # El RPC va fuera de los bloqueos: un nodo lento no retiene a los demás workers
+            pending = None
+            if self._needs_reconcile(address, self._read(address), time.time()):
+                pending = w3.eth.get_transaction_count(address, "pending")
+
+            def update(state):
+                now = time.time()
+                if self._needs_reconcile(address, state, now):
+                    if pending is None:
+                        # Otro hilo marcó la cuenta entre la lectura y el bloqueo
+                        return None, None
+                    state = self._reconcile(address, state, pending, now)
+                if state["free"]:
+                    nonce = min(state["free"])
+                    self.reused += 1
+                    return nonce, dict(state, free=[free for free in state["free"] if free != nonce])
+                nonce = state["next_nonce"]
+                return nonce, dict(state, next_nonce=nonce + 1)
+
+            nonce = self._locked(address, update)
+            if nonce is not None:
+                self.reserved += 1
+                return nonce
+
+    def release(self, address, nonce, error=None, sent=False):
+        """Devuelve un nonce reservado cuya transacción no se envió.
+
+        Pasa a la lista libre y se reparte en la siguiente reserva. Con un error
+        de nonce el nodo ya lo tiene (o va por delante), y con `sent` y un timeout
+        o una conexión cortada puede tenerlo: no se reutiliza y la siguiente
+        reserva se reconcilia con el pending count del nodo.
+        """
+        def update(state):
+            if state is None:
+                return None, None
+            if is_nonce_error(error) or (sent and is_unknown_send_outcome(error)):
+                return None, dict(state, reconcile=1)
+            if nonce < state["next_nonce"] and nonce not in state["free"]:
+                return None, dict(state, free=state["free"] + [nonce])
+            return None, None
+
+        self._locked(address, update)
+        self.released += 1
+
+    def stats(self):
+        return {
+            "reserved": self.reserved,
+            "released": self.released,
+            "reused": self.reused,
+            "reconciles": self.reconciles,
+            "gaps": self.gaps
+        }
+
+
+nonce_manager = NonceManager(NONCE_DB, NONCE_LOCK_TIMEOUT, NONCE_RECONCILE_SECONDS, NONCE_GAP_TIMEOUT)
+
+
+def transaction_fees(speed=DEFAULT_FEE_SPEED):
+    """Campos de comisión para una transacción: EIP-1559 con el oráculo, o gasPrice legacy si no hay cotización.
+
+    Devuelve (campos_para_build_transaction, precio_de_gas_esperado).
+    """
+    quote = fee_oracle.quote(speed) if FEE_ORACLE else None
+    if quote is None:
+        gas_price = chain_gas_price()
+        return {"gasPrice": gas_price}, gas_price
+    return {
+        "maxFeePerGas": quote["max_fee_per_gas"],
+        "maxPriorityFeePerGas": quote["max_priority_fee_per_gas"]
+    }, quote["expected_gas_price"]
+
+
+# ==========================
+# 🧺 Lecturas JSON-RPC por lotes
+# ==========================
+
+# Peticiones por lote JSON-RPC (muchos proveedores limitan a 100-1000) y lotes en paralelo
+RPC_BATCH_SIZE = int(os.getenv("RPC_BATCH_SIZE", "100"))
+RPC_BATCH_CONCURRENCY = int(os.getenv("RPC_BATCH_CONCURRENCY", "4"))
+BALANCES_MAX_ADDRESSES = int(os.getenv("BALANCES_MAX_ADDRESSES", "500"))
+
+rpc_batch_executor = ThreadPoolExecutor(max_workers=RPC_BATCH_CONCURRENCY, thread_name_prefix="rpc-batch")
+
+
+class RPCError(Exception):
+    """Error devuelto por el nodo para una petición de un lote JSON-RPC."""
+
+
+def _post_rpc_batch(calls):
+    body = [{"jsonrpc": "2.0", "id": i, "method": method, "params": params} for i, (method, params) in enumerate(calls)]
+    response = rpc_session.post(SCROLL_RPC_URL, json=body, timeout=RPC_TIMEOUT)
+    response.raise_for_status()
+    replies = response.json()
+    if not isinstance(replies, list):
+        # Nodos sin soporte de lotes responden con un único error
+        raise RPCError((replies.get("error") or {}).get("message", "batch request rejected") if isinstance(replies, dict) else "invalid batch response")
+    by_id = {reply.get("id"): reply for reply in replies}
+    results = []
+    for i in range(len(calls)):
+        reply = by_id.get(i) or {"error": {"message": "missing response"}}
+        if "error" in reply:
+            results.append(RPCError(reply["error"].get("message", "rpc error")))
+        else:
+            results.append(reply.get("result"))
+    return results
+
+
+def rpc_batch(calls):
+    """Envía [(method, params), ...] como lotes JSON-RPC y devuelve los resultados en el mismo orden.
+
+    Hasta RPC_BATCH_SIZE peticiones por POST; si hay varios lotes se envían en
+    paralelo, así la latencia total es cercana a un solo round trip. Un error de
+    una petición se devuelve como RPCError en su posición (no lanza); un fallo
+    del POST completo sí lanza.
+    """
+    chunks = [calls[i:i + RPC_BATCH_SIZE] for i in range(0, len(calls), RPC_BATCH_SIZE)]
+    if len(chunks) <= 1:
+        return _post_rpc_batch(calls) if calls else []
+    results = []
+    for chunk_results in rpc_batch_executor.map(_post_rpc_batch, chunks):
+        results.extend(chunk_results)
+    return results
+
+
+def fetch_balances(checksum_addresses):
+    """Balance nativo y balance según el contrato (getBalance) de cada dirección en un solo lote JSON-RPC.
+
+    Devuelve una lista de dicts en el mismo orden. Si falla la llamada al
+    contrato, el balance del contrato es el nativo (como en /api/balance).
+    Las direcciones ya leídas en el bloque actual salen de block_cache.
+    """
+    head = block_cache.head()
+    balances = {address: block_cache.get("balance", address, head) for address in checksum_addresses}
+    missing = [address for address, balance in balances.items() if balance is None]
+
+    calls = []
+    for address in missing:
+        calls.append(("eth_getBalance", [address, "latest"]))
+        calls.append(("eth_call", [{"to": contract.address, "data": contract.encode_abi("getBalance", args=[address])}, "latest"]))
+    results = rpc_batch(calls)
+
+    for i, address in enumerate(missing):
+        native, contract_result = results[2 * i], results[2 * i + 1]
+        if isinstance(native, Exception):
+            balances[address] = {"address": address, "error": str(native)}
+            continue
+        balance_wei = int(native, 16)
+        try:
+            contract_balance_wei = int(contract_result, 16)
+        except (TypeError, ValueError):
+            # RPCError o respuesta vacía ("0x") del contrato
+            contract_balance_wei = balance_wei
+        balances[address] = {
+            "address": address,
+            "balance": float(w3.from_wei(balance_wei, 'ether')),
+            "balance_wei": str(balance_wei),
+            "contract_balance": float(w3.from_wei(contract_balance_wei, 'ether')),
+            "contract_balance_wei": str(contract_balance_wei)
+        }
+        block_cache.put("balance", address, head, balances[address])
+    return [balances[address] for address in checksum_addresses]
+
+
+# ==========================
+# 🔌 Circuit breaker de DeepSeek
+# ==========================
+
+# Ventana de las últimas N llamadas y mínimo de llamadas para evaluar el circuito
+DEEPSEEK_BREAKER_WINDOW = int(os.getenv("DEEPSEEK_BREAKER_WINDOW", "20"))
+DEEPSEEK_BREAKER_MIN_CALLS = int(os.getenv("DEEPSEEK_BREAKER_MIN_CALLS", "5"))
+# Proporción de llamadas fallidas o lentas que abre el circuito
+DEEPSEEK_BREAKER_FAILURE_RATE = float(os.getenv("DEEPSEEK_BREAKER_FAILURE_RATE", "0.5"))
+# Segundos a partir de los cuales una llamada cuenta como lenta
+DEEPSEEK_BREAKER_SLOW_CALL = float(os.getenv("DEEPSEEK_BREAKER_SLOW_CALL", "12"))
+# Segundos abierto antes de dejar pasar llamadas de prueba (half-open)
+DEEPSEEK_BREAKER_OPEN_SECONDS = float(os.getenv("DEEPSEEK_BREAKER_OPEN_SECONDS", "30"))
+DEEPSEEK_BREAKER_HALF_OPEN_CALLS = int(os.getenv("DEEPSEEK_BREAKER_HALF_OPEN_CALLS", "1"))
+
+
+class CircuitOpenError(Exception):
+    """La llamada no se hizo porque el circuito del upstream está abierto."""
+
+
+class CircuitBreaker:
+    """Circuit breaker por latencia y tasa de error sobre una ventana de las últimas llamadas.
+
+    closed: las llamadas pasan y se registran; si la proporción de fallos o de
+    llamadas lentas supera el umbral, el circuito se abre. open: las llamadas se
+    rechazan (CircuitOpenError) durante open_seconds. half_open: pasan hasta
+    half_open_calls llamadas de prueba; si salen bien se cierra, si no se reabre.
+    """
+
+    def __init__(self, name, window, min_calls, failure_rate, slow_call_seconds, open_seconds, half_open_calls):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.state = "closed"
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.times_opened = 0
+
+    def _open(self, now):
+        self.state = "open"
+        self._opened_at = now
+        self._probes = 0
+        self.times_opened += 1
+
+    def is_open(self):
+        """True si el circuito rechaza llamadas ahora (cuenta como rechazo, sin consumir llamadas de prueba)."""
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self._opened_at < self.open_seconds:
+                self.rejected += 1
+                return True
+            return False
+
+    def allow(self):
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    self.rejected += 1
+                    return False
+                self.state = "half_open"
+                self._probes = 0
+            if self.state == "half_open":
+                if self._probes >= self.half_open_calls:
+                    self.rejected += 1
+                    return False
+                self._probes += 1
+            return True
+
+    def record(self, latency, error=False):
+        failed = error or latency > self.slow_call_seconds
+        now = time.monotonic()
+        with self._lock:
+            self._outcomes.append((failed, latency))
+            if self.state == "half_open":
+                if failed:
+                    self._open(now)
+                else:
+                    self.state = "closed"
+                    self._outcomes.clear()
+            elif self.state == "closed" and len(self._outcomes) >= self.min_calls:
+                failures = sum(1 for outcome_failed, _ in self._outcomes if outcome_failed)
+                if failures / len(self._outcomes) >= self.failure_rate:
+                    self._open(now)
+
+    def call(self, fn):
+        """Ejecuta fn() si el circuito lo permite y registra su latencia y resultado."""
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open")
+        started = time.monotonic()
+        try:
+            result = fn()
+        except Exception:
+            self.record(time.monotonic() - started, error=True)
+            raise
+        self.record(time.monotonic() - started)
+        return result
+
+    def status(self):
+        with self._lock:
+            latencies = sorted(latency for _, latency in self._outcomes)
+            failures = sum(1 for failed, _ in self._outcomes if failed)
+            open_remaining = self.open_seconds - (time.monotonic() - self._opened_at) if self.state == "open" else 0
+            return {
+                "state": self.state,
+                "window_calls": len(self._outcomes),
+                "failure_rate": round(failures / len(self._outcomes), 4) if self._outcomes else None,
+                "avg_latency": round(sum(latencies) / len(latencies), 3) if latencies else None,
+                "p95_latency": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3) if latencies else None,
+                "rejected_calls": self.rejected,
+                "times_opened": self.times_opened,
+                "retry_in": round(max(open_remaining, 0), 1)
+            }
+
+
+deepseek_breaker = CircuitBreaker(
+    "deepseek",
+    DEEPSEEK_BREAKER_WINDOW,
+    DEEPSEEK_BREAKER_MIN_CALLS,
+    DEEPSEEK_BREAKER_FAILURE_RATE,
+    DEEPSEEK_BREAKER_SLOW_CALL,
+    DEEPSEEK_BREAKER_OPEN_SECONDS,
+    DEEPSEEK_BREAKER_HALF_OPEN_CALLS
+)
+
+
+# ==========================
+# 📈 Métricas por llamada a DeepSeek
+# ==========================
+
+# Reintentos opcionales ante errores de conexión o 429/5xx transitorios (0 = sin reintentos)
+DEEPSEEK_RETRIES = int(os.getenv("DEEPSEEK_RETRIES", "0"))
+DEEPSEEK_RETRY_BACKOFF = float(os.getenv("DEEPSEEK_RETRY_BACKOFF", "0.25"))
+DEEPSEEK_RETRY_STATUS = {429, 502, 503, 504}
+# Precio en USD por millón de tokens, para estimar el coste acumulado
+DEEPSEEK_PRICE_INPUT_PER_M = float(os.getenv("DEEPSEEK_PRICE_INPUT_PER_M", "0.28"))
+DEEPSEEK_PRICE_CACHE_HIT_PER_M = float(os.getenv("DEEPSEEK_PRICE_CACHE_HIT_PER_M", "0.028"))
+DEEPSEEK_PRICE_OUTPUT_PER_M = float(os.getenv("DEEPSEEK_PRICE_OUTPUT_PER_M", "0.42"))
+LLM_METRICS_LATENCY_SAMPLES = int(os.getenv("LLM_METRICS_LATENCY_SAMPLES", "1000"))
+
+
+class LLMCallMetrics:
+    """Registro en memoria de cada llamada a DeepSeek, agrupado por endpoint y plantilla de prompt.
+
+    Por grupo guarda llamadas, errores, rechazos del circuit breaker, reintentos,
+    tokens y latencias (las últimas LLM_METRICS_LATENCY_SAMPLES para p50/p95).
+    Aparte cuenta mensajes por endpoint (para saber cuántas llamadas dispara
+    cada mensaje) y, por plantilla de intención, las respuestas que no se
+    pudieron parsear como JSON y las acciones devueltas.
+    """
+
+    def __init__(self, latency_samples):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._latency_samples = latency_samples
+        self._calls = {}
+        self._messages = {}
+        self._parses = {}
+        self.started_at = time.time()
+
+    def scope(self, endpoint):
+        """Context manager: las llamadas del hilo actual se atribuyen a `endpoint`."""
+        metrics = self
+
+        class _Scope:
+            def __enter__(self):
+                self.previous = getattr(metrics._local, "endpoint", None)
+                metrics._local.endpoint = endpoint
+
+            def __exit__(self, *exc):
+                metrics._local.endpoint = self.previous
+
+        return _Scope()
+
+    def current_endpoint(self, endpoint=None):
+        if endpoint:
+            return endpoint
+        scoped = getattr(self._local, "endpoint", None)
+        if scoped:
+            return scoped
+        return request.path if has_request_context() else "background"
+
+    def count_message(self, endpoint):
+        with self._lock:
+            self._messages[endpoint] = self._messages.get(endpoint, 0) + 1
+
+    def record_call(self, endpoint, template, latency, usage=None, error=None, retries=0, streamed=False):
+        """Registra una llamada terminada. error: None, "rejected" (circuito abierto) o el tipo de excepción."""
+        usage = usage or {}
+        with self._lock:
+            entry = self._calls.get((endpoint, template))
+            if entry is None:
+                entry = self._calls[(endpoint, template)] = {
+                    "calls": 0, "errors": 0, "rejected": 0, "retries": 0, "streamed": 0,
+                    "prompt_tokens": 0, "prompt_cache_hit_tokens": 0, "completion_tokens": 0,
+                    "latency_total": 0.0, "latencies": deque(maxlen=self._latency_samples), "error_types": {}
+                }
+            entry["calls"] += 1
+            entry["retries"] += retries
+            entry["streamed"] += 1 if streamed else 0
+            if error == "rejected":
+                entry["rejected"] += 1
+                return
+            if error:
+                entry["errors"] += 1
+                entry["error_types"][error] = entry["error_types"].get(error, 0) + 1
+            entry["latency_total"] += latency
+            entry["latencies"].append(latency)
+            for field in ("prompt_tokens", "prompt_cache_hit_tokens", "completion_tokens"):
+                entry[field] += usage.get(field) or 0
+
+    def record_parse(self, template, action, ok):
+        """Resultado de parsear la respuesta de una plantilla de intención."""
+        with self._lock:
+            entry = self._parses.setdefault(template, {"parsed": 0, "parse_failures": 0, "actions": {}})
+            entry["parsed" if ok else "parse_failures"] += 1
+            entry["actions"][action] = entry["actions"].get(action, 0) + 1
+
+    @staticmethod
+    def _cost(prompt_tokens, cache_hit_tokens, completion_tokens):
+        return (
+            (prompt_tokens - cache_hit_tokens) * DEEPSEEK_PRICE_INPUT_PER_M
+            + cache_hit_tokens * DEEPSEEK_PRICE_CACHE_HIT_PER_M
+            + completion_tokens * DEEPSEEK_PRICE_OUTPUT_PER_M
+        ) / 1_000_000
+
+    def snapshot(self):
+        with self._lock:
+            calls = []
+            by_endpoint = {}
+            for (endpoint, template), entry in sorted(self._calls.items()):
+                latencies = sorted(entry["latencies"])
+                completed = entry["calls"] - entry["rejected"]
+                cost = self._cost(entry["prompt_tokens"], entry["prompt_cache_hit_tokens"], entry["completion_tokens"])
+                calls.append({
+                    "endpoint": endpoint,
+                    "template": template,
+                    **{field: entry[field] for field in (
+                        "calls", "errors", "rejected", "retries", "streamed",
+                        "prompt_tokens", "prompt_cache_hit_tokens", "completion_tokens"
+                    )},
+                    "error_types": dict(entry["error_types"]),
+                    "avg_latency": round(entry["latency_total"] / completed, 3) if completed else None,
+                    "p50_latency": round(latencies[len(latencies) // 2], 3) if latencies else None,
+                    "p95_latency": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3) if latencies else None,
+                    "max_latency": round(latencies[-1], 3) if latencies else None,
+                    "estimated_cost_usd": round(cost, 6)
+                })
+                totals = by_endpoint.setdefault(endpoint, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "estimated_cost_usd": 0.0})
+                totals["calls"] += entry["calls"]
+                totals["prompt_tokens"] += entry["prompt_tokens"]
+                totals["completion_tokens"] += entry["completion_tokens"]
+                totals["estimated_cost_usd"] += cost
+
+            for endpoint, messages in self._messages.items():
+                totals = by_endpoint.setdefault(endpoint, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "estimated_cost_usd": 0.0})
+                totals["messages"] = messages
+            for totals in by_endpoint.values():
+                messages = totals.setdefault("messages", 0)
+                totals["calls_per_message"] = round(totals["calls"] / messages, 3) if messages else None
+                totals["estimated_cost_usd"] = round(totals["estimated_cost_usd"], 6)
+
+            parses = {}
+            for template, entry in self._parses.items():
+                total = entry["parsed"] + entry["parse_failures"]
+                parses[template] = dict(
+                    entry,
+                    actions=dict(entry["actions"]),
+                    parse_failure_rate=round(entry["parse_failures"] / total, 4) if total else None
+                )
+
+            return {
+                "since": int(self.started_at),
+                "calls": calls,
+                "endpoints": by_endpoint,
+                "parsing": parses
+            }
+
+    def prometheus(self):
+        """Las mismas métricas en formato de texto de Prometheus."""
+        snapshot = self.snapshot()
+        lines = []
+        counters = (
+            ("calls", "llm_calls_total"), ("errors", "llm_call_errors_total"), ("rejected", "llm_calls_rejected_total"),
+            ("retries", "llm_call_retries_total"), ("prompt_tokens", "llm_prompt_tokens_total"),
+            ("prompt_cache_hit_tokens", "llm_prompt_cache_hit_tokens_total"), ("completion_tokens", "llm_completion_tokens_total")
+        )
+        for field, metric in counters:
+            lines.append(f"# TYPE {metric} counter")
+            for entry in snapshot["calls"]:
+                lines.append(f'{metric}{{endpoint="{entry["endpoint"]}",template="{entry["template"]}"}} {entry[field]}')
+        for quantile in ("p50", "p95"):
+            lines.append(f"# TYPE llm_call_latency_{quantile}_seconds gauge")
+            for entry in snapshot["calls"]:
+                if entry[f"{quantile}_latency"] is not None:
+                    lines.append(f'llm_call_latency_{quantile}_seconds{{endpoint="{entry["endpoint"]}",template="{entry["template"]}"}} {entry[f"{quantile}_latency"]}')
+        lines.append("# TYPE llm_messages_total counter")
+        for endpoint, totals in snapshot["endpoints"].items():
+            lines.append(f'llm_messages_total{{endpoint="{endpoint}"}} {totals["messages"]}')
+        lines.append("# TYPE llm_parse_failures_total counter")
+        for template, entry in snapshot["parsing"].items():
+            lines.append(f'llm_parse_failures_total{{template="{template}"}} {entry["parse_failures"]}')
+        return "\n".join(lines) + "\n"
+
+
+llm_metrics = LLMCallMetrics(LLM_METRICS_LATENCY_SAMPLES)
+
+
+def post_deepseek(payload, headers=None, endpoint=None):
+    """POST a DeepSeek a través del circuit breaker. Lanza CircuitOpenError si está abierto.
+
+    Reintenta errores transitorios (DEEPSEEK_RETRIES), suma el `usage` de la
+    respuesta a prompt_usage y registra la llamada en llm_metrics.
+    """
+    headers = headers or {
+        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    endpoint = llm_metrics.current_endpoint(endpoint)
+    template = prompt_usage.template_of(payload)
+
+    def send():
+        response = deepseek_session.post(DEEPSEEK_URL, headers=headers, json=payload, timeout=DEEPSEEK_TIMEOUT)
+        response.raise_for_status()
+        return response
+
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        try:
+            response = deepseek_breaker.call(send)
+            break
+        except CircuitOpenError:
+            llm_metrics.record_call(endpoint, template, time.monotonic() - started, error="rejected", retries=attempt)
+            raise
+        except requests.RequestException as e:
+            status = e.response.status_code if e.response is not None else None
+            transient = isinstance(e, requests.ConnectionError) or status in DEEPSEEK_RETRY_STATUS
+            # Sin reintentos durante las llamadas de prueba (half_open) ni con el circuito abierto
+            if transient and attempt < DEEPSEEK_RETRIES and deepseek_breaker.state == "closed":
+                attempt += 1
+                time.sleep(DEEPSEEK_RETRY_BACKOFF * attempt)
+                continue
+            llm_metrics.record_call(endpoint, template, time.monotonic() - started, error=type(e).__name__, retries=attempt)
+            raise
+
+    try:
+        usage = response.json().get("usage")
+    except ValueError:
+        usage = None
+    prompt_usage.record(payload, usage)
+    llm_metrics.record_call(endpoint, template, time.monotonic() - started, usage=usage, retries=attempt)
+    return response
+
+
+# ==========================
+# 🏠 Rutas del backend
+# ==========================
+
+@app.route("/", methods=["GET"])
+def home():
+    """Verifica que el servidor esté en funcionamiento."""
+    return jsonify({"status": "ok", "message": "✅ Backend Flask funcionando correctamente"})
+
+
+# ======================================
+# 📊 Obtener información de la red
+# ======================================
+@app.route("/network-info", methods=["GET"])
+def network_info():
+    """Obtiene información sobre la red Scroll Sepolia."""
+    try:
+        # Con la cabeza de la cadena al día no hace falta preguntar al nodo
+        latest_block = block_cache.head()
+        is_connected = latest_block is not None or w3.is_connected()
+        if latest_block is None and is_connected:
+            latest_block = w3.eth.block_number
+        
+        return jsonify({
+            "network": NETWORK,
+            "chain_id": CHAIN_ID,
+            "rpc_url": SCROLL_RPC_URL,
+            "contract_address": CONTRACT_ADDRESS,
+            "is_connected": is_connected,
+            "latest_block": latest_block,
+            "explorer_url": f"https://sepolia.scrollscan.com/address/{CONTRACT_ADDRESS}",
+            "single_flight": rpc_flight.stats(),
+            "block_head": block_head.status(),
+            "block_cache": block_cache.stats(),
+            "fee_oracle": fee_oracle.status() if FEE_ORACLE else None,
+            "gas_estimates": gas_estimates.stats(),
+            "nonce_manager": nonce_manager.stats()
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# ======================================
+# 🧭 Parser local de intenciones para /chat
+# ======================================
+
+# Con CHAT_LOCAL_INTENT=false todos los mensajes van a DeepSeek
+CHAT_LOCAL_INTENT = os.getenv("CHAT_LOCAL_INTENT", "true").lower() == "true"
+# Confianza mínima para responder sin llamar a DeepSeek
+CHAT_LOCAL_INTENT_THRESHOLD = float(os.getenv("CHAT_LOCAL_INTENT_THRESHOLD", "0.9"))
+
+_VERB = r"(?:env[ií]a(?:le)?|enviar(?:le)?|m[aá]nda(?:le)?|mandar(?:le)?|transfiere(?:le)?|transferir(?:le)?|paga(?:le)?|pagar(?:le)?|send|transfer|pay)"
+_AMOUNT = r"(?P<amount>\d+(?:[.,]\d+)?)"
+_UNIT = r"(?:\s*(?:eth|ether|ethers|stx))?"
+_TO = r"(?:a|al|to|para|hacia)"
+_ADDRESS = r"(?P<address>0x[a-fA-F0-9]{40})"
+_NAME = r"(?:(?:mi|my)\s+(?:contacto|contact)\s+)?(?P<name>[^\W\d_][^\W\d_'.-]*(?:\s+[^\W\d_][^\W\d_'.-]*){0,2})"
+_SHOW = r"(?:(?:mu[eé]strame|muestra|mostrar|lista(?:r)?|ver|dame|consulta(?:r)?|cu[aá]l\s+es|show(?:\s+me)?|list|get|check|what'?s|what\s+is)\s+)?"
+
+# (acción, patrón): el primer patrón que coincida con el mensaje completo gana
+CHAT_INTENT_GRAMMAR = [
+    ("transfer", rf"{_VERB}\s+{_AMOUNT}{_UNIT}\s+{_TO}\s+(?:la\s+wallet\s+|wallet\s+)?{_ADDRESS}"),
+    ("transfer", rf"{_VERB}\s+{_TO}\s+(?:la\s+wallet\s+|wallet\s+)?{_ADDRESS}\s+{_AMOUNT}{_UNIT}"),
+    ("transfer_to_contact", rf"{_VERB}\s+{_AMOUNT}{_UNIT}\s+{_TO}\s+{_NAME}"),
+    ("transfer_to_contact", rf"{_VERB}\s+{_TO}\s+{_NAME}\s+{_AMOUNT}{_UNIT}"),
+    ("balance", rf"{_SHOW}(?:el\s+|the\s+)?(?:balance|saldo)\s+(?:de\s+|of\s+|for\s+|en\s+)?(?:la\s+wallet\s+|wallet\s+)?{_ADDRESS}"),
+    ("my_balance", rf"{_SHOW}(?:mi|my)\s+(?:balance|saldo)"),
+    ("network_info", rf"{_SHOW}(?:la\s+)?(?:info(?:rmaci[oó]n)?|estado)\s+de\s+(?:la\s+)?red(?:\s+scroll(?:\s+sepolia)?)?|{_SHOW}(?:the\s+)?network\s+(?:info|information|status)"),
+    ("list_users", rf"{_SHOW}(?:a\s+)?(?:todos\s+)?(?:los\s+)?usuarios(?:\s+registrados)?|cu[aá]ntos\s+usuarios\s+hay|{_SHOW}(?:all\s+)?(?:the\s+)?users|how\s+many\s+users(?:\s+are\s+there)?"),
+    ("my_contacts", rf"{_SHOW}(?:mis|my)\s+contact(?:o)?s"),
+    ("get_user", rf"(?:busca(?:r)?|encuentra|find|search(?:\s+for)?)\s+(?:el\s+|al\s+|the\s+)?(?:usuario|user)\s+(?:con\s+(?:la\s+)?wallet\s+|with\s+wallet\s+)?{_ADDRESS}"),
+    ("create_user", rf"(?:registra(?:r)?|crea(?:r)?|register|create)\s+(?:un\s+|a\s+)?(?:nuevo\s+|new\s+)?(?:usuario|user)\s+(?:llamado\s+|named\s+|called\s+)?(?P<name>[\w.-]+)\s+(?:con\s+(?:la\s+)?wallet|with\s+wallet)\s+{_ADDRESS}"),
+]
+_COMPILED_CHAT_GRAMMAR = [(action, re.compile(pattern, re.IGNORECASE)) for action, pattern in CHAT_INTENT_GRAMMAR]
+_POLITE_PREFIX = re.compile(r"^(?:por\s+favor|porfa|please|hola|hey|oye)[\s,]+", re.IGNORECASE)
+_POLITE_SUFFIX = re.compile(r"[\s,]+(?:por\s+favor|porfa|please|gracias|thanks)$", re.IGNORECASE)
+
+
+def _parse_amount(text):
+    return float(text.replace(",", "."))
+
+
+def _build_chat_intent(action, match, sender_wallet):
+    """Arma el JSON de intención con el mismo formato que devuelve DeepSeek."""
+    groups = match.groupdict()
+
+    if action == "transfer":
+        amount = _parse_amount(groups["amount"])
+        return {"action": "transfer", "recipient": groups["address"], "amount": amount, "message": f"Transferir {amount} ETH"}
+    if action == "transfer_to_contact":
+        amount = _parse_amount(groups["amount"])
+        name = groups["name"].strip()
+        intent = {"action": "transfer_to_contact", "contact_name": name, "amount": amount, "message": f"Buscar contacto {name} y transferir {amount} ETH"}
+        if sender_wallet:
+            intent["sender_wallet"] = sender_wallet
+        return intent
+    if action == "balance":
+        return {"action": "balance", "address": groups["address"], "message": "Consultando balance"}
+    if action == "my_balance":
+        return {"action": "balance", "address": sender_wallet, "message": "Consultando balance"}
+    if action == "network_info":
+        return {"action": "network_info", "message": "Obteniendo información de la red Scroll Sepolia"}
+    if action == "list_users":
+        return {"action": "list_users", "message": "Obteniendo lista de usuarios"}
+    if action == "my_contacts":
+        return {"action": "get_contacts", "sender_wallet": sender_wallet, "message": "Obteniendo contactos"}
+    if action == "get_user":
+        return {"action": "get_user", "wallet_address": groups["address"], "message": "Buscando usuario"}
+    if action == "create_user":
+        return {"action": "create_user", "username": groups["name"], "wallet_address": groups["address"], "message": f"Creando usuario {groups['name']}"}
+    return None
+
+
+def _name_confidence(name, contact_names):
+    """Confianza de un nombre de contacto capturado por la gramática.
+
+    Un nombre de una palabra se acepta tal cual. Con varias palabras la
+    gramática no distingue "María José" de "Juan mañana" o "my wallet", así que
+    solo se acepta si coincide con un contacto del remitente; si no, baja del
+    umbral y el mensaje va a DeepSeek.
+    """
+    if len(name.split()) == 1:
+        return 0.95
+    names = contact_names() if callable(contact_names) else (contact_names or [])
+    wanted = " ".join(name.lower().split())
+    if any(" ".join(str(known).lower().split()) == wanted for known in names):
+        return 0.95
+    return 0.7
+
+
+def parse_chat_intent(user_message, sender_wallet="", contact_names=None):
+    """Parser determinista (español/inglés) de los comandos frecuentes de /chat.
+
+    Devuelve {"intent": dict, "confidence": float, "rule": str} o None. La
+    confianza es alta si la gramática cubre el mensaje completo y baja si solo
+    aparece dentro de un mensaje más largo (en ese caso se escala a DeepSeek).
+    contact_names (lista o función que la devuelve) son los nombres de los
+    contactos del remitente, para aceptar nombres de varias palabras.
+    """
+    if not CHAT_LOCAL_INTENT:
+        return None
+
+    text = user_message.strip().strip("¿?¡!.;: ")
+    text = _POLITE_SUFFIX.sub("", _POLITE_PREFIX.sub("", text)).strip("¿?¡!.;:, ")
+
+    for confidence, matcher in ((0.95, "fullmatch"), (0.6, "search")):
+        for action, pattern in _COMPILED_CHAT_GRAMMAR:
+            match = getattr(pattern, matcher)(text)
+            if not match:
+                continue
+
+            # "mi balance" / "mis contactos" necesitan la wallet conectada
+            if action in ("my_balance", "my_contacts") and not sender_wallet:
+                confidence = min(confidence, 0.5)
+            if "amount" in match.groupdict() and _parse_amount(match.group("amount")) <= 0:
+                confidence = min(confidence, 0.5)
+            if action == "transfer_to_contact":
+                confidence = min(confidence, _name_confidence(match.group("name").strip(), contact_names))
+
+            return {
+                "intent": _build_chat_intent(action, match, sender_wallet),
+                "confidence": confidence,
+                "rule": action
+            }
+    return None
+
+
+class ChatIntentStats:
+    """Contadores de aciertos del parser local (hit rate) para /chat."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total = 0
+        self.local_hits = 0
+        self.low_confidence = 0
+        self.by_rule = {}
+
+    def record(self, local_intent, used_local):
+        with self._lock:
+            self.total += 1
+            if used_local:
+                self.local_hits += 1
+                self.by_rule[local_intent["rule"]] = self.by_rule.get(local_intent["rule"], 0) + 1
+            elif local_intent:
+                self.low_confidence += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "total": self.total,
+                "local_hits": self.local_hits,
+                "escalated_to_llm": self.total - self.local_hits,
+                "low_confidence_matches": self.low_confidence,
+                "hit_rate": round(self.local_hits / self.total, 4) if self.total else None,
+                "by_rule": dict(self.by_rule)
+            }
+
+
+chat_intent_stats = ChatIntentStats()
+
+
+# ======================================
+# 🗃️ Caché de intenciones del LLM
+# ======================================
+
+# Número máximo de intenciones en caché (0 = desactivada)
+LLM_INTENT_CACHE_SIZE = int(os.getenv("LLM_INTENT_CACHE_SIZE", "4096"))
+
+_ADDRESS_TOKEN = re.compile(r"0x[a-fA-F0-9]{40}")
+_NUMBER_TOKEN = re.compile(r"(?<![\w.,])\d+(?:[.,]\d+)?(?![\w]|[.,]\d)")
+
+
+class LLMIntentCache:
+    """Caché LRU del JSON de intención devuelto por DeepSeek.
+
+    La clave es el mensaje normalizado (minúsculas, sin acentos, espacios
+    colapsados) con las direcciones y cantidades sustituidas por marcadores,
+    así "envía 0.5 ETH a 0xabc..." y "Envia 2 eth a 0xdef..." comparten la
+    misma entrada. Los valores se guardan como plantilla y se rellenan con
+    los del mensaje actual. Solo se cachea la extracción de la intención:
+    las acciones (precios, balances, base de datos) se ejecutan siempre.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncacheable = 0
+
+    @staticmethod
+    def _slots(user_message, sender_wallet):
+        addresses = _ADDRESS_TOKEN.findall(user_message)
+        numbers = _NUMBER_TOKEN.findall(_ADDRESS_TOKEN.sub(" ", user_message))
+        if sender_wallet:
+            addresses.append(sender_wallet)
+        return [a.lower() for a in addresses], numbers
+
+    @staticmethod
+    def _key(namespace, user_message, sender_wallet):
+        text = unicodedata.normalize("NFKD", user_message)
+        text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+        text = _NUMBER_TOKEN.sub("<num>", _ADDRESS_TOKEN.sub("<addr>", text))
+        text = " ".join(text.split()).strip("¿?¡!.;:, ")
+        return (namespace, bool(sender_wallet), text)
+
+    def _template(self, value, addresses, numbers, used):
+        """Sustituye direcciones y cantidades por marcadores; None si no se puede cachear.
+
+        Un número de la intención que no sale de exactamente un número del
+        mensaje (p. ej. "1.000" leído como 1000) no se puede rellenar con los
+        del siguiente mensaje, así que la intención no se cachea. `used`
+        acumula los índices de los números del mensaje que quedan en la plantilla.
+        """
+        if isinstance(value, dict):
+            out = {}
+            for k, v in value.items():
+                out[k] = self._template(v, addresses, numbers, used)
+                if out[k] is None and v is not None:
+                    return None
+            return out
+        if isinstance(value, list):
+            out = [self._template(v, addresses, numbers, used) for v in value]
+            return None if any(t is None and v is not None for t, v in zip(out, value)) else out
+        if isinstance(value, bool) or value is None:
+            return value
+        if isinstance(value, (int, float)):
+            matches = [i for i, n in enumerate(numbers) if float(n.replace(",", ".")) == value]
+            if len(matches) != 1:
+                return None
+            used.add(matches[0])
+            return {"\0slot": "num", "index": matches[0], "type": type(value).__name__}
+        if isinstance(value, str):
+            text = value
+            for i, address in enumerate(addresses):
+                text = re.sub(re.escape(address), f"\0addr{i}\0", text, flags=re.IGNORECASE)
+
+            def number_slot(match):
+                found = [i for i, n in enumerate(numbers) if float(n.replace(",", ".")) == float(match.group().replace(",", "."))]
+                if len(found) != 1:
+                    raise ValueError("ambiguous amount")
+                used.add(found[0])
+                return f"\0num{found[0]}\0"
+
+            try:
+                return _NUMBER_TOKEN.sub(number_slot, text)
+            except ValueError:
+                return None
+        return value
+
+    def _render(self, value, addresses, numbers):
+        if isinstance(value, dict):
+            if "\0slot" in value:
+                number = float(numbers[value["index"]].replace(",", "."))
+                return int(number) if value["type"] == "int" and number.is_integer() else number
+            return {k: self._render(v, addresses, numbers) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._render(v, addresses, numbers) for v in value]
+        if isinstance(value, str) and "\0" in value:
+            for i, address in enumerate(addresses):
+                value = value.replace(f"\0addr{i}\0", address)
+            for i, number in enumerate(numbers):
+                value = value.replace(f"\0num{i}\0", number)
+        return value
+
+    def get(self, namespace, user_message, sender_wallet=""):
+        """Devuelve una copia de la intención cacheada para este mensaje, o None."""
+        if self.max_size <= 0:
+            return None
+        key = self._key(namespace, user_message, sender_wallet)
+        with self._lock:
+            template = self._entries.get(key)
+            if template is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        # Las direcciones se devuelven tal como vienen en el mensaje actual
+        addresses = _ADDRESS_TOKEN.findall(user_message) + ([sender_wallet] if sender_wallet else [])
+        _, numbers = self._slots(user_message, sender_wallet)
+        return self._render(template, addresses, numbers)
+
+    def put(self, namespace, user_message, sender_wallet, intent):
+        """Guarda la intención parseada de DeepSeek como plantilla."""
+        if self.max_size <= 0 or not isinstance(intent, dict):
+            return
+        addresses, numbers = self._slots(user_message, sender_wallet)
+        used = set()
+        template = self._template(intent, addresses, numbers, used)
+        # Cada <num> de la clave tiene que rellenar algún valor; si no, dos mensajes
+        # con cantidades distintas compartirían una intención que no depende de ellas
+        if len(used) != len(numbers):
+            template = None
+        key = self._key(namespace, user_message, sender_wallet)
+        with self._lock:
+            if template is None:
+                self.uncacheable += 1
+                return
+            self._entries[key] = template
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "uncacheable": self.uncacheable
+            }
+
+
+llm_intent_cache = LLMIntentCache(LLM_INTENT_CACHE_SIZE)
+
+
+# ======================================
+# 💬 Memoria de conversación por wallet para /chat
+# ======================================
+
+# Wallets recordadas, memoria total (MB), turnos por wallet y presupuesto de tokens del contexto
+CHAT_MEMORY_MAX_WALLETS = int(os.getenv("CHAT_MEMORY_MAX_WALLETS", "50000"))
+CHAT_MEMORY_MAX_MB = float(os.getenv("CHAT_MEMORY_MAX_MB", "64"))
+CHAT_MEMORY_TURNS = int(os.getenv("CHAT_MEMORY_TURNS", "4"))
+CHAT_MEMORY_TOKENS = int(os.getenv("CHAT_MEMORY_TOKENS", "200"))
+# Sin actividad durante este tiempo (segundos) la conversación se olvida
+CHAT_MEMORY_TTL = int(os.getenv("CHAT_MEMORY_TTL", "1800"))
+
+# Campos de la intención que se recuerdan como "últimas entidades resueltas"
+CHAT_MEMORY_ENTITIES = {
+    "contact": ("contact_name", "nombre"),
+    "recipient": ("recipient",),
+    "amount": ("amount",),
+    "symbol": ("symbol",),
+    "address": ("address", "wallet_address")
+}
+
+
+class ConversationMemory:
+    """Resumen compacto de los últimos turnos de /chat por sender_wallet.
+
+    Por wallet guarda los últimos CHAT_MEMORY_TURNS turnos en una línea cada uno
+    ("mensaje → acción") y las últimas entidades resueltas (contacto, destinatario,
+    cantidad, símbolo), para que DeepSeek entienda "envía lo mismo a María".
+    Acotada en número de wallets y en bytes: al superar cualquiera de los dos
+    límites se descartan las wallets usadas hace más tiempo (LRU).
+    """
+
+    TURN_CHARS = 160
+    # Coste fijo aproximado de una entrada (dict, deque, claves) además del texto
+    ENTRY_OVERHEAD = 600
+
+    def __init__(self, max_wallets, max_bytes, turns, token_budget, ttl):
+        self.max_wallets = max_wallets
+        self.max_bytes = max_bytes
+        self.turns = turns
+        self.max_chars = token_budget * 4  # ~4 caracteres por token
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expired = 0
+
+    @staticmethod
+    def _size(entry):
+        return ConversationMemory.ENTRY_OVERHEAD + sum(len(turn) for turn in entry["turns"]) + sum(
+            len(str(value)) for value in entry["entities"].values()
+        )
+
+    def _get(self, wallet, now):
+        entry = self._entries.get(wallet)
+        if entry is not None and now - entry["updated"] > self.ttl:
+            self._bytes -= entry["size"]
+            del self._entries[wallet]
+            self.expired += 1
+            entry = None
+        return entry
+
+    def remember(self, wallet, user_message, intent):
+        """Añade el turno (mensaje y acción resuelta) a la memoria de la wallet."""
+        if not wallet or self.max_wallets <= 0 or not isinstance(intent, dict):
+            return
+        wallet = wallet.lower()
+        action = intent.get("action", "none")
+        entities = {}
+        for entity, fields in CHAT_MEMORY_ENTITIES.items():
+            for field in fields:
+                value = intent.get(field)
+                if value not in (None, "", 0):
+                    entities[entity] = str(value)[:64]
+                    break
+        details = ", ".join(f"{entity}={value}" for entity, value in entities.items())
+        message = " ".join(user_message.split())
+        turn = f"{message[:self.TURN_CHARS]} → {action}" + (f" ({details})" if details else "")
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._get(wallet, now)
+            if entry is None:
+                entry = self._entries[wallet] = {"turns": deque(maxlen=self.turns), "entities": {}, "size": 0, "updated": now}
+            self._bytes -= entry["size"]
+            entry["turns"].append(turn)
+            if action != "none":
+                entry["entities"].update(entities)
+                entry["entities"]["action"] = action
+            entry["updated"] = now
+            entry["size"] = self._size(entry)
+            self._bytes += entry["size"]
+            self._entries.move_to_end(wallet)
+
+            while self._entries and (len(self._entries) > self.max_wallets or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted["size"]
+                self.evictions += 1
+
+    def has_context(self, wallet):
+        if not wallet:
+            return False
+        with self._lock:
+            return self._get(wallet.lower(), time.monotonic()) is not None
+
+    def context(self, wallet):
+        """Texto para DeepSeek con las entidades y los turnos más recientes que caben en el presupuesto, o None."""
+        if not wallet:
+            return None
+        with self._lock:
+            entry = self._get(wallet.lower(), time.monotonic())
+            if entry is None:
+                return None
+            self._entries.move_to_end(wallet.lower())
+            turns = list(entry["turns"])
+            entities = dict(entry["entities"])
+
+        header = "Contexto reciente de esta conversación (úsalo para resolver referencias como 'lo mismo', 'a ella' o 'otra vez'):"
+        lines = [header]
+        if entities:
+            lines.append("Últimos datos: " + ", ".join(f"{key}={value}" for key, value in entities.items()))
+        budget = self.max_chars - sum(len(line) + 1 for line in lines)
+        recent = []
+        for turn in reversed(turns):
+            if len(turn) + 3 > budget:
+                break
+            recent.append(f"- {turn}")
+            budget -= len(turn) + 3
+        return "\n".join(lines + list(reversed(recent)))
+
+    def forget(self, wallet):
+        with self._lock:
+            entry = self._entries.pop((wallet or "").lower(), None)
+            if entry is not None:
+                self._bytes -= entry["size"]
+            return entry is not None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "wallets": len(self._entries),
+                "max_wallets": self.max_wallets,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expired": self.expired
+            }
+
+
+conversation_memory = ConversationMemory(
+    CHAT_MEMORY_MAX_WALLETS,
+    int(CHAT_MEMORY_MAX_MB * 1024 * 1024),
+    CHAT_MEMORY_TURNS,
+    CHAT_MEMORY_TOKENS,
+    CHAT_MEMORY_TTL
+)
+
+
+# ======================================
+# 📝 Prompts de DeepSeek: tokens por plantilla
+# ======================================
+
+class PromptUsageStats:
+    """Tokens de prompt por plantilla, según el campo `usage` de las respuestas de DeepSeek.
+
+    Cada plantilla se registra con su prompt de sistema estático y cada llamada
+    se asocia a su plantilla por el primer mensaje. prompt_cache_hit_tokens es
+    la parte del prompt que DeepSeek sirvió desde su caché de prefijos (más
+    barata y más rápida).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._templates = {}
+        self._stats = {}
+
+    def register(self, name, system_prompt):
+        self._templates[system_prompt] = name
+        self._stats[name] = {
+            "calls": 0,
+            "prompt_tokens": 0,
+            "prompt_cache_hit_tokens": 0,
+            "prompt_cache_miss_tokens": 0,
+            "completion_tokens": 0,
+            "system_prompt_chars": len(system_prompt)
+        }
+
+    def template_of(self, payload):
+        """Nombre de la plantilla del payload (por su primer mensaje), u "other"."""
+        messages = payload.get("messages") or [{}]
+        return self._templates.get(messages[0].get("content"), "other")
+
+    def record(self, payload, usage):
+        """Suma el `usage` de una respuesta a la plantilla del payload enviado."""
+        if not usage:
+            return
+        name = self.template_of(payload)
+        if name == "other":
+            return
+        with self._lock:
+            entry = self._stats[name]
+            entry["calls"] += 1
+            for field in ("prompt_tokens", "prompt_cache_hit_tokens", "prompt_cache_miss_tokens", "completion_tokens"):
+                entry[field] += usage.get(field) or 0
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for name, entry in self._stats.items():
+                result[name] = dict(
+                    entry,
+                    avg_prompt_tokens=round(entry["prompt_tokens"] / entry["calls"], 1) if entry["calls"] else None,
+                    cache_hit_ratio=round(entry["prompt_cache_hit_tokens"] / entry["prompt_tokens"], 4) if entry["prompt_tokens"] else None
+                )
+            return result
+
+
+prompt_usage = PromptUsageStats()
+
+
+# ======================================
+# ⚡ Respuestas en streaming (SSE) para /chat y /pyth/chat
+# ======================================
+
+# Campos que necesita cada acción para ejecutarse antes de que DeepSeek termine de generar.
+# Una tupla indica alternativas (basta con una de ellas).
+CHAT_ACTION_REQUIRED_FIELDS = {
+    "transfer": ("recipient", "amount"),
+    "transfer_to_contact": ("contact_name", "amount"),
+    "balance": ("address",),
+    "network_info": (),
+    "list_users": (),
+    "get_user": ("wallet_address",),
+    "create_user": ("username", "wallet_address"),
+    "get_contacts": (("user_id", "sender_wallet"),),
+    "create_contact": ("user_id", "nombre", "wallet_address")
+}
+# Acciones que escriben en Supabase: en streaming esperan al JSON completo y validado
+CHAT_WRITE_ACTIONS = {"create_user", "create_contact"}
+PYTH_ACTION_REQUIRED_FIELDS = {
+    "get_price": ("symbol",),
+    "get_multiple_prices": ("symbols",),
+    "transfer_advice": ("symbol", "amount"),
+    "calculate_portfolio": ("holdings",),
+    "advice": ("message",)
+}
+
+
+class IncrementalJSONObject:
+    """Parser incremental de un objeto JSON que llega por fragmentos.
+
+    Devuelve cada par clave/valor del nivel superior en cuanto su valor está
+    completo, sin esperar al cierre del objeto. Ignora el texto anterior a la
+    primera llave (por ejemplo un bloque ```json).
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.closed = False
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text):
+        completed = []
+        for char in text:
+            if self.closed:
+                break
+            if self._depth == 0:
+                if char == "{":
+                    self._depth = 1
+                continue
+            if self._in_string:
+                self._buffer.append(char)
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.closed = True
+                    completed += self._complete_pair()
+                    continue
+            elif char == "," and self._depth == 1:
+                completed += self._complete_pair()
+                continue
+            self._buffer.append(char)
+        return completed
+
+    def _complete_pair(self):
+        segment = "".join(self._buffer).strip()
+        self._buffer = []
+        if not segment:
+            return []
+        try:
+            pair = json.loads("{" + segment + "}")
+        except ValueError:
+            return []
+        self.fields.update(pair)
+        return list(pair.items())
+
+
+def intent_ready(intent, required_fields):
+    """True si la intención tiene acción conocida y todos sus campos obligatorios."""
+    required = required_fields.get(intent.get("action"))
+    if required is None:
+        return False
+    return all(
+        any(field in intent for field in (requirement if isinstance(requirement, tuple) else (requirement,)))
+        for requirement in required
+    )
+
+
+def wants_event_stream(data):
+    """True si el cliente pidió la respuesta en streaming (?stream=true, "stream": true o Accept: text/event-stream)."""
+    return (
+        request.args.get("stream", "").lower() == "true"
+        or data.get("stream") is True
+        or request.accept_mimetypes.best == "text/event-stream"
+    )
+
+
+def stream_deepseek_completion(payload):
+    """Llama a DeepSeek con stream=true y devuelve los fragmentos de texto a medida que se generan."""
+    if not deepseek_breaker.allow():
+        raise CircuitOpenError("deepseek circuit is open")
+
+    headers = {
+        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    body = dict(payload, stream=True, stream_options={"include_usage": True})
+    endpoint = llm_metrics.current_endpoint()
+    started = time.monotonic()
+    failed = None
+    usage = None
+    response = None
+
+    try:
+        response = deepseek_session.post(DEEPSEEK_URL, headers=headers, json=body, timeout=DEEPSEEK_TIMEOUT, stream=True)
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            # El último fragmento trae el `usage` de toda la respuesta
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+                prompt_usage.record(payload, usage)
+            choices = chunk.get("choices") or []
+            delta = (choices[0].get("delta") or {}).get("content") if choices else None
+            if delta:
+                yield delta
+    except Exception as e:
+        failed = type(e).__name__
+        raise
+    finally:
+        # La generación completa cuenta para la latencia (igual que sin streaming)
+        latency = time.monotonic() - started
+        deepseek_breaker.record(latency, error=failed is not None)
+        llm_metrics.record_call(endpoint, prompt_usage.template_of(payload), latency, usage=usage, error=failed, streamed=True)
+        if response is not None:
+            response.close()
+
+
+def stream_intent_response(intent, payload, required_fields, parse_reply, execute_action, error_body,
+                           prepare_intent=None, degrade=None, write_actions=()):
+    """Generador SSE común de /chat y /pyth/chat.
+
+    Si la intención ya se conoce (parser local o caché) se ejecuta directamente.
+    Si no, reenvía los tokens de DeepSeek (evento token), parsea el JSON a medida
+    que llega y lanza la acción en un hilo en cuanto `action` y sus campos
+    obligatorios están completos (evento intent), mientras la IA sigue generando
+    el resto del mensaje. Las acciones de `write_actions` no se adelantan: se
+    ejecutan con el JSON final ya validado. Si DeepSeek falla o el circuito se
+    abre a mitad del stream, la intención sale de degrade() como sin streaming.
+    El evento result tiene el mismo formato que la respuesta sin streaming y
+    done lleva los tiempos medidos.
+    """
+    prepare_intent = prepare_intent or (lambda value: value)
+    started = time.monotonic()
+    timings = {}
+
+    def elapsed_ms():
+        return round((time.monotonic() - started) * 1000, 1)
+
+    def event(name, data):
+        return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+    try:
+        if intent is not None:
+            intent = prepare_intent(intent)
+            timings["action_started_ms"] = elapsed_ms()
+            yield event("intent", intent)
+            result = execute_action(intent)
+        else:
+            parser = IncrementalJSONObject()
+            chunks = []
+            worker = None
+            early = {}
+
+            try:
+                for delta in stream_deepseek_completion(payload):
+                    timings.setdefault("first_token_ms", elapsed_ms())
+                    chunks.append(delta)
+                    yield event("token", {"text": delta})
+
+                    if worker is None and parser.feed(delta):
+                        partial = prepare_intent(dict(parser.fields))
+                        if intent_ready(partial, required_fields) and partial.get("action") not in write_actions:
+                            early["intent"] = partial
+                            early["fields"] = set(partial)
+
+                            def run_action(partial_intent=copy.deepcopy(partial)):
+                                try:
+                                    early["result"] = execute_action(partial_intent)
+                                except Exception as e:
+                                    early["error"] = e
+
+                            worker = threading.Thread(target=run_action, daemon=True)
+                            worker.start()
+                            timings["action_started_ms"] = elapsed_ms()
+                            yield event("intent", partial)
+
+                intent = prepare_intent(parse_reply("".join(chunks)))
+            except (CircuitOpenError, requests.RequestException):
+                if degrade is None:
+                    raise
+                # La acción adelantada ya tenía su intención completa; si no, modo degradado
+                intent = dict(early["intent"]) if worker is not None else prepare_intent(degrade())
+
+            if worker is None:
+                timings["action_started_ms"] = elapsed_ms()
+                yield event("intent", intent)
+                result = execute_action(intent)
+            else:
+                worker.join()
+                if "error" in early:
+                    raise early["error"]
+                # Completar con lo que la IA generó después de lanzar la acción (p. ej. message)
+                result = early["result"]
+                for key, value in intent.items():
+                    if key not in early["fields"]:
+                        result.setdefault(key, value)
+
+        timings["result_ms"] = elapsed_ms()
+        yield event("result", result)
+
+        # Paso diferido (consejo/resumen de la IA): se envía en cuanto termina
+        followup = result.get("followup") if isinstance(result, dict) else None
+        if followup:
+            yield event("followup", deferred_results.body(followup["id"], timeout=sum(DEEPSEEK_TIMEOUT)))
+
+        timings["total_ms"] = elapsed_ms()
+        yield event("done", timings)
+    except Exception as e:
+        yield event("error", error_body(e))
+
+
+def event_stream_response(generator):
+    """Respuesta Flask text/event-stream sin buffering en proxies."""
+    return Response(
+        stream_with_context(generator),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# ======================================
+# 🤖 Endpoint de chat con DeepSeek
+# ======================================
+# Prompt de sistema de /chat: se compila una vez y es idéntico en todas las peticiones, así
+# DeepSeek puede reutilizar el prefijo cacheado. Los datos de cada petición van al final.
+CHAT_INTENT_SYSTEM_PROMPT = (
+    "Eres un asistente inteligente para interpretar comandos hacia contratos inteligentes "
+    "en la blockchain de Scroll Sepolia (una red compatible con Ethereum) y gestionar usuarios en la base de datos. "
+    "Analiza los comandos del usuario y extrae información relevante. "
+    "Devuelve SIEMPRE una respuesta JSON con las siguientes claves:\n\n"
+    
+    "ACCIONES DISPONIBLES:\n"
+    "- 'transfer': Transferir ETH a una wallet directamente (direcciones que empiezan con 0x)\n"
+    "- 'transfer_to_contact': Transferir ETH a un contacto por su nombre\n"
+    "- 'balance': Consultar balance de una wallet\n"
+    "- 'network_info': Obtener información de la red Scroll Sepolia\n"
+    "- 'list_users': Listar todos los usuarios\n"
+    "- 'get_user': Obtener info de un usuario específico\n"
+    "- 'create_user': Crear un nuevo usuario\n"
+    "- 'get_contacts': Obtener contactos de un usuario\n"
+    "- 'create_contact': Crear un nuevo contacto\n"
+    "- 'none': Ninguna acción específica\n\n"
+    
+    "ESTRUCTURA DE RESPUESTA:\n"
+    "- 'action': una de las acciones listadas arriba\n"
+    "- 'message': explicación breve de lo que se hará\n"
+    "- Campos adicionales según la acción:\n\n"
+    
+    "EJEMPLOS:\n\n"
+    
+    "1. Transferencia ETH (por wallet):\n"
+    "Usuario: 'Transfiere 0.5 ETH a 0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb'\n"
+    "Respuesta: {\"action\": \"transfer\", \"recipient\": \"0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb\", \"amount\": 0.5, \"message\": \"Transferir 0.5 ETH\"}\n\n"
+    
+    "1b. Transferencia ETH (por nombre de contacto):\n"
+    "Usuario: 'Envía 0.1 ETH a Andrés'\n"
+    "Respuesta: {\"action\": \"transfer_to_contact\", \"contact_name\": \"Andrés\", \"amount\": 0.1, \"sender_wallet\": \"0x123...\", \"message\": \"Buscar contacto Andrés y transferir 0.1 ETH\"}\n"
+    "IMPORTANTE: Para esta acción, SIEMPRE incluye el sender_wallet que viene en el contexto del mensaje.\n\n"
+    
+    "2. Balance:\n"
+    "Usuario: '¿Cuál es el balance de 0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb?'\n"
+    "Respuesta: {\"action\": \"balance\", \"address\": \"0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb\", \"message\": \"Consultando balance\"}\n\n"
+    
+    "3. Listar usuarios:\n"
+    "Usuario: 'Muéstrame todos los usuarios' o '¿Cuántos usuarios hay?'\n"
+    "Respuesta: {\"action\": \"list_users\", \"message\": \"Obteniendo lista de usuarios\"}\n\n"
+    
+    "4. Buscar usuario:\n"
+    "Usuario: 'Busca el usuario con wallet 0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb'\n"
+    "Respuesta: {\"action\": \"get_user\", \"wallet_address\": \"0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb\", \"message\": \"Buscando usuario\"}\n\n"
+    
+    "5. Crear usuario:\n"
+    "Usuario: 'Registra un usuario llamado Juan con wallet 0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb'\n"
+    "Respuesta: {\"action\": \"create_user\", \"username\": \"Juan\", \"wallet_address\": \"0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb\", \"message\": \"Creando usuario Juan\"}\n\n"
+    
+    "6. Ver contactos:\n"
+    "Usuario: 'Muéstrame los contactos del usuario 123e4567-e89b-12d3-a456-426614174000'\n"
+    "Respuesta: {\"action\": \"get_contacts\", \"user_id\": \"123e4567-e89b-12d3-a456-426614174000\", \"message\": \"Obteniendo contactos\"}\n\n"
+    
+    "7. Crear contacto:\n"
+    "Usuario: 'Agrega a María con wallet 0x742d35... como contacto del usuario 123e4567...'\n"
+    "Respuesta: {\"action\": \"create_contact\", \"user_id\": \"123e4567...\", \"nombre\": \"María\", \"wallet_address\": \"0x742d35...\", \"message\": \"Agregando contacto\"}\n\n"
+    
+    "IMPORTANTE: Las direcciones Ethereum siempre empiezan con '0x' seguido de 40 caracteres hexadecimales."
+)
+prompt_usage.register("chat_intent", CHAT_INTENT_SYSTEM_PROMPT)
+
+
+def build_chat_intent_payload(user_message, sender_wallet):
+    """Body de la petición a DeepSeek para extraer la intención de un mensaje de /chat."""
+    body = {
+        "model": "deepseek-chat",
+        "messages": [
+            {"role": "system", "content": CHAT_INTENT_SYSTEM_PROMPT},
+            {"role": "system", "content": f"La wallet del usuario conectado es: {sender_wallet if sender_wallet else 'NO PROPORCIONADA'}."},
+            {"role": "user", "content": user_message}
+        ]
+    }
+    # La memoria de la conversación va al final, detrás del prompt estático (cacheable)
+    memory = conversation_memory.context(sender_wallet)
+    if memory:
+        body["messages"].insert(2, {"role": "system", "content": memory})
+    return body
+
+
+def extract_chat_intent_llm(user_message, sender_wallet):
+    """Pide a DeepSeek la intención del mensaje de /chat y la devuelve como dict JSON."""
+    body = build_chat_intent_payload(user_message, sender_wallet)
+
+    # Petición a DeepSeek (a través del circuit breaker)
+    response = post_deepseek(body)
+    result = response.json()
+
+    # --------------------------
+    # 🔍 Extraer texto de la IA
+    # --------------------------
+    ia_text = None
+    if "choices" in result:
+        ia_text = result["choices"][0]["message"]["content"]
+    elif "output_text" in result:
+        ia_text = result["output_text"]
+    elif "data" in result and "output_text" in result["data"]:
+        ia_text = result["data"]["output_text"]
+    else:
+        ia_text = str(result)
+
+    return parse_chat_intent_reply(user_message, sender_wallet, ia_text)
+
+
+def parse_chat_intent_reply(user_message, sender_wallet, ia_text):
+    """Parsea el JSON de intención devuelto por DeepSeek.
+
+    Si la respuesta de la IA no es JSON válido, deduce la acción por palabras clave.
+    """
+    # --------------------------
+    # 🧹 Limpiar y parsear JSON
+    # --------------------------
+    ia_text = ia_text.strip()
+    if ia_text.startswith("```"):
+        ia_text = ia_text.replace("```json", "").replace("```", "").strip()
+
+    try:
+        ia_json = json.loads(ia_text)
+        # Con contexto de conversación la intención depende de los turnos anteriores: no se cachea
+        if not conversation_memory.has_context(sender_wallet):
+            llm_intent_cache.put("chat", user_message, sender_wallet, ia_json)
+        parsed = True
+    except Exception:
+        # Si no es JSON, intentar deducir la acción
+        ia_json = keyword_chat_intent(user_message, ia_text)
+        parsed = False
+
+    llm_metrics.record_parse("chat_intent", ia_json.get("action") if isinstance(ia_json, dict) else None, parsed)
+    return ia_json
+
+
+def keyword_chat_intent(user_message, message):
+    """Deduce la acción de un mensaje de /chat por palabras clave, sin IA."""
+    action = "none"
+    msg_lower = user_message.lower()
+
+    # Detectar si menciona "enviar" o "transferir" con un nombre (no una wallet)
+    if ("transferir" in msg_lower or "transfiere" in msg_lower or 
+        "enviar" in msg_lower or "envía" in msg_lower or "envia" in msg_lower):
+        # Si NO contiene una wallet address Ethereum (0x...)
+        if "0x" not in user_message.lower():
+            action = "transfer_to_contact"
+        else:
+            action = "transfer"
+    elif "balance" in msg_lower or "saldo" in msg_lower:
+        action = "balance"
+    elif "red" in msg_lower or "network" in msg_lower or "info" in msg_lower:
+        action = "network_info"
+    elif "usuarios" in msg_lower or "listar usuarios" in msg_lower or "ver usuarios" in msg_lower:
+        action = "list_users"
+    elif "crear usuario" in msg_lower or "registrar usuario" in msg_lower or "nuevo usuario" in msg_lower:
+        action = "create_user"
+    elif "contactos" in msg_lower or "ver contactos" in msg_lower:
+        action = "get_contacts"
+    elif "crear contacto" in msg_lower or "agregar contacto" in msg_lower or "nuevo contacto" in msg_lower:
+        action = "create_contact"
+    elif "buscar usuario" in msg_lower or "encontrar usuario" in msg_lower:
+        action = "get_user"
+
+    return {"action": action, "message": message}
+
+
+# /chat/batch: máximo de mensajes por lote y llamadas a DeepSeek en paralelo
+CHAT_BATCH_MAX = int(os.getenv("CHAT_BATCH_MAX", "500"))
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "8"))
+CHAT_BATCH_CONCURRENCY_MAX = int(os.getenv("CHAT_BATCH_CONCURRENCY_MAX", "32"))
+
+DEGRADED_CHAT_MESSAGE = "⚠️ El asistente de IA no está disponible en este momento; interpreté tu mensaje sin IA."
+
+
+def degraded_chat_intent(user_message, local_intent):
+    """Intención de /chat sin DeepSeek (circuito abierto o error): parser local aunque tenga poca confianza, si no palabras clave."""
+    if local_intent:
+        ia_json = local_intent["intent"]
+        ia_json["intent_source"] = "local"
+    else:
+        ia_json = keyword_chat_intent(user_message, DEGRADED_CHAT_MESSAGE)
+        ia_json["intent_source"] = "keywords"
+    ia_json["degraded"] = True
+    return ia_json
+
+
+class ChatLookups:
+    """Lecturas de Supabase que hacen las acciones de /chat.
+
+    Sin prefetch consulta Supabase en cada llamada. prefetch() agrupa las
+    lecturas de un lote de intenciones en una consulta por tabla (todos los
+    usuarios por wallet, todos los contactos por usuario). Tras una escritura
+    (crear usuario o contacto) se invalida y vuelve a consultar directamente.
+    """
+
+    def __init__(self):
+        self._users_by_wallet = {}
+        self._contacts_by_user = {}
+        self._all_users = None
+        self.queries = 0
+
+    def prefetch(self, intents):
+        wallets, user_ids = set(), set()
+        for intent in intents:
+            action = intent.get("action")
+            if action == "transfer_to_contact" and intent.get("sender_wallet"):
+                wallets.add(intent["sender_wallet"])
+            elif action == "get_user" and intent.get("wallet_address"):
+                wallets.add(intent["wallet_address"])
+            elif action == "get_contacts":
+                if intent.get("user_id"):
+                    user_ids.add(intent["user_id"])
+                elif intent.get("sender_wallet"):
+                    wallets.add(intent["sender_wallet"])
+
+        try:
+            if wallets:
+                self.queries += 1
+                rows = supabase.table("users").select("*").in_("wallet_address", list(wallets)).execute().data
+                users_by_wallet = {wallet: [] for wallet in wallets}
+                for row in rows:
+                    users_by_wallet.setdefault(row["wallet_address"], []).append(row)
+                    user_ids.add(row["id"])
+                self._users_by_wallet = users_by_wallet
+
+            if user_ids:
+                self.queries += 1
+                rows = supabase.table("contacts").select("*").in_("user_id", list(user_ids)).execute().data
+                contacts_by_user = {user_id: [] for user_id in user_ids}
+                for row in rows:
+                    contacts_by_user.setdefault(row["user_id"], []).append(row)
+                self._contacts_by_user = contacts_by_user
+
+            if any(intent.get("action") == "list_users" for intent in intents):
+                self.queries += 1
+                self._all_users = supabase.table("users").select("*").execute().data
+        except Exception:
+            # Si falla la consulta agrupada, cada acción consulta por su cuenta (y reporta su error)
+            self.invalidate()
+
+    def invalidate(self):
+        self._users_by_wallet = {}
+        self._contacts_by_user = {}
+        self._all_users = None
+
+    def users_by_wallet(self, wallet):
+        if wallet in self._users_by_wallet:
+            return self._users_by_wallet[wallet]
+        self.queries += 1
+        return supabase.table("users").select("*").eq("wallet_address", wallet).execute().data
+
+    def contacts_of(self, user_id):
+        if user_id in self._contacts_by_user:
+            return self._contacts_by_user[user_id]
+        self.queries += 1
+        return supabase.table("contacts").select("*").eq("user_id", user_id).execute().data
+
+    def all_users(self):
+        if self._all_users is not None:
+            return self._all_users
+        self.queries += 1
+        return supabase.table("users").select("*").execute().data
+
+
+def execute_chat_action(ia_json, sender_wallet, lookups=None):
+    """Ejecuta la acción de base de datos de una intención de /chat y devuelve el JSON de respuesta."""
+    lookups = lookups or ChatLookups()
+    action = ia_json.get("action")
+
+    # ==========================================
+    # 💸 TRANSFERENCIA A CONTACTO POR NOMBRE
+    # ==========================================
+    if action == "transfer_to_contact":
+        contact_name = ia_json.get("contact_name")
+        amount = ia_json.get("amount")
+        sender_wallet_from_json = ia_json.get("sender_wallet")
+
+        # Usar sender_wallet del request si no viene en el JSON de la IA
+        if not sender_wallet_from_json and sender_wallet:
+            sender_wallet_from_json = sender_wallet
+
+        if not sender_wallet_from_json:
+            ia_json["error"] = "Se requiere la wallet del remitente (sender_wallet)"
+            ia_json["message"] = "❌ Debes proporcionar tu wallet conectada para buscar tus contactos"
+        elif not contact_name:
+            ia_json["error"] = "No se pudo identificar el nombre del contacto"
+            ia_json["message"] = "❌ Por favor especifica el nombre del contacto"
+        elif not amount or amount <= 0:
+            ia_json["error"] = "No se pudo identificar la cantidad a transferir"
+            ia_json["message"] = "❌ Por favor especifica una cantidad válida de STX"
+        elif supabase:
+            try:
+                # 1. Buscar el usuario por su wallet
+                users = lookups.users_by_wallet(sender_wallet_from_json)
+
+                if not users:
+                    ia_json["error"] = "No se encontró un usuario con esa wallet"
+                    ia_json["message"] = f"❌ Tu wallet {sender_wallet_from_json} no está registrada. Regístrate primero."
+                else:
+                    user_id = users[0]["id"]
+                    username = users[0]["username"]
+
+                    # 2. Buscar el contacto por nombre (case-insensitive)
+                    contacts = lookups.contacts_of(user_id)
+
+                    if not contacts:
+                        ia_json["error"] = "No tienes contactos registrados"
+                        ia_json["message"] = f"❌ {username}, aún no tienes contactos. Agrega algunos primero."
+                    else:
+                        # Buscar contacto por nombre (ignorando mayúsculas/minúsculas y espacios)
+                        contact_found = None
+                        search_name = contact_name.strip().lower()
+
+                        for contact in contacts:
+                            if contact["nombre"].strip().lower() == search_name:
+                                contact_found = contact
+                                break
+
+                        if not contact_found:
+                            # Intentar búsqueda parcial
+                            for contact in contacts:
+                                if search_name in contact["nombre"].strip().lower():
+                                    contact_found = contact
+                                    break
+
+                        if contact_found:
+                            # ✅ Contacto encontrado, preparar transferencia
+                            ia_json["action"] = "transfer"  # Cambiar a acción de transferencia
+                            ia_json["recipient"] = contact_found["wallet_address"]
+                            ia_json["recipient_name"] = contact_found["nombre"]
+                            ia_json["amount"] = amount
+                            ia_json["sender"] = sender_wallet_from_json
+                            ia_json["contact_id"] = contact_found["id"]
+                            ia_json["message"] = f"✅ Contacto '{contact_found['nombre']}' encontrado. Preparando transferencia de {amount} STX a {contact_found['wallet_address']}"
+                            ia_json["success"] = True
+                        else:
+                            # Listar contactos disponibles
+                            available_contacts = [c["nombre"] for c in contacts]
+                            ia_json["error"] = f"Contacto '{contact_name}' no encontrado"
+                            ia_json["message"] = f"❌ No encontré a '{contact_name}' en tus contactos."
+                            ia_json["available_contacts"] = available_contacts
+                            ia_json["suggestion"] = f"Contactos disponibles: {', '.join(available_contacts)}"
+
+            except Exception as e:
+                ia_json["error"] = f"Error al buscar contacto: {str(e)}"
+                ia_json["message"] = "❌ Hubo un error al buscar en tus contactos"
+        else:
+            ia_json["error"] = "Supabase no está configurado"
+            ia_json["message"] = "❌ La base de datos no está disponible"
+
+    # Listar usuarios
+    elif action == "list_users":
+        try:
+            if supabase:
+                users = lookups.all_users()
+                ia_json["users"] = users
+                ia_json["count"] = len(users)
+                ia_json["message"] = f"Se encontraron {len(users)} usuarios registrados"
+            else:
+                ia_json["error"] = "Supabase no está configurado"
+        except Exception as e:
+            ia_json["error"] = f"Error al obtener usuarios: {str(e)}"
+
+    # Buscar usuario por wallet
+    elif action == "get_user":
+        wallet = ia_json.get("wallet_address")
+        if wallet and supabase:
+            try:
+                users = lookups.users_by_wallet(wallet)
+                if users:
+                    ia_json["user"] = users[0]
+                    ia_json["message"] = f"Usuario encontrado: {users[0].get('username')}"
+                else:
+                    ia_json["message"] = "No se encontró ningún usuario con esa wallet"
+            except Exception as e:
+                ia_json["error"] = f"Error al buscar usuario: {str(e)}"
+
+    # Crear usuario
+    elif action == "create_user":
+        username = ia_json.get("username")
+        wallet = ia_json.get("wallet_address")
+        if username and wallet and supabase:
+            try:
+                response = supabase.table("users").insert({
+                    "username": username,
+                    "wallet_address": wallet
+                }).execute()
+                lookups.invalidate()
+                ia_json["user"] = response.data[0]
+                ia_json["message"] = f"✅ Usuario '{username}' creado exitosamente"
+            except Exception as e:
+                error_msg = str(e)
+                if "duplicate" in error_msg.lower():
+                    ia_json["error"] = "Esta wallet ya está registrada"
+                else:
+                    ia_json["error"] = f"Error al crear usuario: {error_msg}"
+
+    # Obtener contactos de un usuario
+    elif action == "get_contacts":
+        user_id = ia_json.get("user_id")
+
+        # "Mis contactos": resolver el usuario a partir de la wallet conectada
+        if not user_id and ia_json.get("sender_wallet") and supabase:
+            try:
+                users = lookups.users_by_wallet(ia_json["sender_wallet"])
+                if users:
+                    user_id = users[0]["id"]
+                else:
+                    ia_json["message"] = f"❌ Tu wallet {ia_json['sender_wallet']} no está registrada. Regístrate primero."
+            except Exception as e:
+                ia_json["error"] = f"Error al buscar usuario: {str(e)}"
+
+        if user_id and supabase:
+            try:
+                contacts = lookups.contacts_of(user_id)
+                ia_json["contacts"] = contacts
+                ia_json["count"] = len(contacts)
+                ia_json["message"] = f"Se encontraron {len(contacts)} contactos"
+            except Exception as e:
+                ia_json["error"] = f"Error al obtener contactos: {str(e)}"
+
+    # Crear contacto
+    elif action == "create_contact":
+        user_id = ia_json.get("user_id")
+        nombre = ia_json.get("nombre")
+        wallet = ia_json.get("wallet_address")
+        if user_id and nombre and wallet and supabase:
+            try:
+                response = supabase.table("contacts").insert({
+                    "user_id": user_id,
+                    "nombre": nombre,
+                    "wallet_address": wallet
+                }).execute()
+                lookups.invalidate()
+                ia_json["contact"] = response.data[0]
+                ia_json["message"] = f"✅ Contacto '{nombre}' agregado exitosamente"
+            except Exception as e:
+                error_msg = str(e)
+                if "duplicate" in error_msg.lower():
+                    ia_json["error"] = "Este contacto ya existe"
+                else:
+                    ia_json["error"] = f"Error al crear contacto: {error_msg}"
+
+    return ia_json
+
+
+def chat_contact_names(sender_wallet):
+    """Nombres de los contactos del remitente (vacío sin Supabase, sin wallet o si falla la consulta)."""
+    if not supabase or not sender_wallet:
+        return []
+    try:
+        lookups = ChatLookups()
+        users = lookups.users_by_wallet(sender_wallet)
+        if not users:
+            return []
+        return [contact.get("nombre", "") for contact in lookups.contacts_of(users[0]["id"])]
+    except Exception:
+        return []
+
+
+def resolve_chat_intent(user_message, sender_wallet, use_llm=True):
+    """Intención de un mensaje de /chat: parser local, caché de intenciones y, si hace falta, DeepSeek.
+
+    Devuelve (ia_json, local_intent). Con use_llm=False, ia_json es None cuando
+    la intención solo puede salir de DeepSeek (el modo streaming la pide aparte).
+    """
+    # 1. Parser local para comandos frecuentes; 2. DeepSeek para el resto
+    ia_json = None
+    local_intent = parse_chat_intent(user_message, sender_wallet, contact_names=lambda: chat_contact_names(sender_wallet))
+    if local_intent and local_intent["confidence"] >= CHAT_LOCAL_INTENT_THRESHOLD:
+        ia_json = local_intent["intent"]
+        ia_json["intent_source"] = "local"
+    chat_intent_stats.record(local_intent, ia_json is not None)
+
+    if ia_json is None and not conversation_memory.has_context(sender_wallet):
+        ia_json = llm_intent_cache.get("chat", user_message, sender_wallet)
+        if ia_json is not None:
+            ia_json["intent_source"] = "llm_cache"
+
+    # DeepSeek no disponible (circuito abierto): modo degradado sin IA
+    if ia_json is None and deepseek_breaker.is_open():
+        ia_json = degraded_chat_intent(user_message, local_intent)
+
+    if ia_json is None and use_llm:
+        ia_json = extract_chat_intent_or_degrade(user_message, sender_wallet, local_intent)
+    return ia_json, local_intent
+
+
+def remember_chat_turn(sender_wallet, user_message, ia_json):
+    """Guarda el turno en la memoria de conversación de la wallet y devuelve ia_json sin cambios."""
+    conversation_memory.remember(sender_wallet, user_message, ia_json)
+    return ia_json
+
+
+def extract_chat_intent_or_degrade(user_message, sender_wallet, local_intent):
+    """Intención de DeepSeek; si el circuito está abierto o la llamada falla, modo degradado."""
+    try:
+        ia_json = extract_chat_intent_llm(user_message, sender_wallet)
+        ia_json["intent_source"] = "llm"
+    except (CircuitOpenError, requests.RequestException):
+        ia_json = degraded_chat_intent(user_message, local_intent)
+    return ia_json
+
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    """Interpreta comandos del usuario con IA y responde en formato JSON."""
+    try:
+        data = request.get_json()
+        user_message = data.get("message", "")
+        sender_wallet = data.get("sender_wallet", "")  # Wallet del usuario conectado
+
+        if not user_message:
+            return jsonify({"action": "none", "message": "No se envió ningún mensaje."}), 400
+        llm_metrics.count_message("/chat")
+
+        # Parser local, caché o modo degradado; None si hace falta DeepSeek
+        ia_json, local_intent = resolve_chat_intent(user_message, sender_wallet, use_llm=False)
+
+        # Modo streaming: tokens de DeepSeek por SSE y la acción en cuanto la intención está completa
+        if wants_event_stream(data):
+            def prepare_chat_intent(intent):
+                intent.setdefault("intent_source", "llm")
+                if sender_wallet and "sender_wallet" not in intent:
+                    intent["sender_wallet"] = sender_wallet
+                return intent
+
+            return event_stream_response(stream_intent_response(
+                ia_json,
+                build_chat_intent_payload(user_message, sender_wallet),
+                CHAT_ACTION_REQUIRED_FIELDS,
+                parse_reply=lambda text: parse_chat_intent_reply(user_message, sender_wallet, text),
+                execute_action=lambda intent: remember_chat_turn(sender_wallet, user_message, execute_chat_action(intent, sender_wallet)),
+                error_body=lambda e: {"action": "none", "message": f"Error: {str(e)}"},
+                prepare_intent=prepare_chat_intent,
+                degrade=lambda: degraded_chat_intent(user_message, local_intent),
+                write_actions=CHAT_WRITE_ACTIONS
+            ))
+
+        if ia_json is None:
+            ia_json = extract_chat_intent_or_degrade(user_message, sender_wallet, local_intent)
+
+        # Asegurar que sender_wallet esté presente si fue proporcionado
+        if sender_wallet and "sender_wallet" not in ia_json:
+            ia_json["sender_wallet"] = sender_wallet
+
+        ia_json = remember_chat_turn(sender_wallet, user_message, execute_chat_action(ia_json, sender_wallet))
+
+        return jsonify(ia_json)
+
+    except Exception as e:
+        return jsonify({"action": "none", "message": f"Error: {str(e)}"}), 500
+
+
+@app.route("/chat/batch", methods=["POST"])
+def chat_batch():
+    """Procesa muchos mensajes de /chat en una petición y devuelve los resultados en orden.
+
+    Body: {"items": [{"message": "...", "sender_wallet": "0x..."}, ...], "concurrency": 8}
+    Las intenciones se extraen en paralelo (como máximo `concurrency` llamadas a
+    DeepSeek a la vez) y las lecturas de Supabase de todo el lote se agrupan en
+    una consulta por tabla. Cada resultado tiene el mismo formato que /chat.
+    """
+    started = time.monotonic()
+    data = request.get_json(silent=True) or {}
+    items = data.get("items")
+
+    if not isinstance(items, list) or not items:
+        return jsonify({"success": False, "error": "items debe ser una lista no vacía"}), 400
+    if len(items) > CHAT_BATCH_MAX:
+        return jsonify({"success": False, "error": f"Máximo {CHAT_BATCH_MAX} mensajes por lote"}), 400
+    if not all(isinstance(item, dict) for item in items):
+        return jsonify({"success": False, "error": "Cada elemento debe ser un objeto {message, sender_wallet}"}), 400
+
+    try:
+        concurrency = min(max(int(data.get("concurrency", CHAT_BATCH_CONCURRENCY)), 1), CHAT_BATCH_CONCURRENCY_MAX)
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "concurrency debe ser un número entero"}), 400
+
+    def resolve(item):
+        user_message = item.get("message") or ""
+        sender_wallet = item.get("sender_wallet") or ""
+        if not user_message:
+            return {"action": "none", "message": "No se envió ningún mensaje."}
+        llm_metrics.count_message("/chat/batch")
+        try:
+            with llm_metrics.scope("/chat/batch"):
+                ia_json, _ = resolve_chat_intent(user_message, sender_wallet)
+            if sender_wallet and "sender_wallet" not in ia_json:
+                ia_json["sender_wallet"] = sender_wallet
+            return ia_json
+        except Exception as e:
+            return {"action": "none", "message": f"Error: {str(e)}"}
+
+    # 1. Intenciones en paralelo, acotadas por la concurrencia pedida
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(items)), thread_name_prefix="chat-batch") as executor:
+        intents = list(executor.map(resolve, items))
+
+    # 2. Lecturas de Supabase agrupadas para todo el lote; 3. acciones en orden
+    lookups = ChatLookups()
+    if supabase:
+        lookups.prefetch(intents)
+
+    results = []
+    for item, ia_json in zip(items, intents):
+        if "intent_source" not in ia_json:
+            results.append(ia_json)
+            continue
+        try:
+            sender_wallet = item.get("sender_wallet") or ""
+            results.append(remember_chat_turn(sender_wallet, item["message"], execute_chat_action(ia_json, sender_wallet, lookups)))
+        except Exception as e:
+            results.append({"action": "none", "message": f"Error: {str(e)}"})
+
+    sources = {}
+    for ia_json in intents:
+        source = ia_json.get("intent_source", "none")
+        sources[source] = sources.get(source, 0) + 1
+
+    return jsonify({
+        "success": True,
+        "count": len(results),
+        "results": results,
+        "stats": {
+            "concurrency": concurrency,
+            "intent_sources": sources,
+            "supabase_queries": lookups.queries,
+            "elapsed_ms": round((time.monotonic() - started) * 1000, 1)
+        }
+    })
+
+
+@app.route("/chat/intent-stats", methods=["GET"])
+def chat_intent_statistics():
+    """Hit rate del parser local de intenciones desde el arranque del proceso."""
+    return jsonify({
+        "success": True,
+        "enabled": CHAT_LOCAL_INTENT,
+        "threshold": CHAT_LOCAL_INTENT_THRESHOLD,
+        "stats": chat_intent_stats.snapshot(),
+        "llm_intent_cache": llm_intent_cache.stats(),
+        "conversation_memory": conversation_memory.stats(),
+        "deepseek_circuit": deepseek_breaker.status()
+    })
+
+
+@app.route("/chat/memory/<wallet>", methods=["DELETE"])
+def forget_chat_memory(wallet):
+    """Borra la memoria de conversación de una wallet (p. ej. al desconectarla)."""
+    return jsonify({"success": True, "forgotten": conversation_memory.forget(wallet)})
+
+
+@app.route("/chat/intent-report", methods=["POST"])
+def chat_intent_report():
+    """Mide el hit rate del parser local sobre una muestra de mensajes (sin ejecutar acciones).
+
+    Body: {"messages": ["envía 0.1 ETH a Juan", ...], "sender_wallet": "0x..."}
+    """
+    data = request.get_json(silent=True) or {}
+    messages = data.get("messages")
+    sender_wallet = data.get("sender_wallet", "")
+
+    if not isinstance(messages, list) or not messages:
+        return jsonify({"success": False, "error": "messages debe ser una lista no vacía"}), 400
+
+    # Mismos nombres de contacto que /chat; se consultan una vez y solo si algún mensaje los necesita
+    names = []
+
+    def contact_names():
+        if not names:
+            names.append(chat_contact_names(sender_wallet))
+        return names[0]
+
+    report = ChatIntentStats()
+    escalated = []
+    for message in messages:
+        if not isinstance(message, str):
+            return jsonify({"success": False, "error": "messages solo puede contener textos"}), 400
+        local_intent = parse_chat_intent(message, sender_wallet, contact_names=contact_names)
+        hit = bool(local_intent) and local_intent["confidence"] >= CHAT_LOCAL_INTENT_THRESHOLD
+        report.record(local_intent, hit)
+        if not hit and len(escalated) < 50:
+            escalated.append(message)
+
+    return jsonify({
+        "success": True,
+        "threshold": CHAT_LOCAL_INTENT_THRESHOLD,
+        "stats": report.snapshot(),
+        "escalated_sample": escalated
+    })
+
+
+@app.route("/chat/prompt-stats", methods=["GET"])
+def chat_prompt_statistics():
+    """Tokens de prompt por plantilla de DeepSeek y proporción servida desde su caché de prefijos."""
+    return jsonify({
+        "success": True,
+        "templates": prompt_usage.snapshot()
+    })
+
+
+@app.route("/llm/metrics", methods=["GET"])
+def llm_call_metrics():
+    """Métricas de cada llamada a DeepSeek: tokens, latencia, reintentos, errores y respuestas sin parsear.
+
+    Query param opcional: format=prometheus para exportarlas en formato de texto de Prometheus.
+    """
+    if request.args.get("format") == "prometheus":
+        return Response(llm_metrics.prometheus(), mimetype="text/plain; version=0.0.4")
+    return jsonify({
+        "success": True,
+        **llm_metrics.snapshot(),
+        "deepseek_circuit": deepseek_breaker.status()
+    })
+
+
+# ======================================
+# 💰 Verificar balance de una wallet
+# ======================================
+@app.route("/api/balance/<address>", methods=["GET"])
+def get_balance(address):
+    """Consulta el balance de ETH de una dirección en Scroll Sepolia."""
+    try:
+        if not address:
+            return jsonify({"error": "Se requiere una dirección"}), 400
+        
+        # Validar formato de dirección Ethereum
+        if not Web3.is_address(address):
+            return jsonify({"error": "Dirección inválida. Debe ser una dirección Ethereum válida"}), 400
+        
+        # Convertir a checksum address
+        checksum_address = Web3.to_checksum_address(address)
+        
+        # Balance nativo (ETH) y balance según el contrato en un solo round trip
+        balance = fetch_balances([checksum_address])[0]
+        if "error" in balance:
+            raise RPCError(balance["error"])
+        balance_eth = w3.from_wei(int(balance["balance_wei"]), 'ether')
+        
+        return jsonify({
+            **balance,
+            "message": f"Balance: {balance_eth} ETH",
+            "network": NETWORK,
+            "chain_id": CHAIN_ID
+        })
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/balances", methods=["POST"])
+def get_balances():
+    """Consulta el balance de ETH y del contrato de muchas direcciones con lotes JSON-RPC.
+
+    Body: {"addresses": ["0x...", "0x..."]}. Los resultados vienen en el mismo
+    orden; una dirección inválida o con error lleva "error" en su entrada.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        addresses = data.get("addresses")
+
+        if not isinstance(addresses, list) or not addresses:
+            return jsonify({"success": False, "error": "Se requiere una lista de direcciones (addresses)"}), 400
+        if len(addresses) > BALANCES_MAX_ADDRESSES:
+            return jsonify({"success": False, "error": f"Máximo {BALANCES_MAX_ADDRESSES} direcciones por petición"}), 400
+
+        # Solo las direcciones válidas (sin repetir) van al nodo
+        valid = []
+        for address in addresses:
+            if isinstance(address, str) and Web3.is_address(address):
+                checksum_address = Web3.to_checksum_address(address)
+                if checksum_address not in valid:
+                    valid.append(checksum_address)
+        fetched = {balance["address"]: balance for balance in fetch_balances(valid)}
+
+        balances = []
+        for address in addresses:
+            if isinstance(address, str) and Web3.is_address(address):
+                balances.append(fetched[Web3.to_checksum_address(address)])
+            else:
+                balances.append({"address": address, "error": "Dirección inválida. Debe ser una dirección Ethereum válida"})
+
+        return jsonify({
+            "success": True,
+            "count": len(balances),
+            "balances": balances,
+            "rpc_batches": -(-2 * len(valid) // RPC_BATCH_SIZE),
+            "network": NETWORK,
+            "chain_id": CHAIN_ID
+        })
+
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+# Ruta alternativa POST para compatibilidad
+@app.route("/get-balance", methods=["POST"])
+def get_balance_post():
+    """Consulta el balance de ETH (versión POST)."""
+    try:
+        data = request.get_json()
+        address = data.get("address", "")
+        
+        if not address:
+            return jsonify({"error": "Se requiere una dirección"}), 400
+        
+        # Redirigir a la función principal
+        return get_balance(address)
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# ======================================
+# 💸 Preparar transacción de transferencia
+# ======================================
+@app.route("/prepare-transfer", methods=["POST"])
+def prepare_transfer():
+    """Prepara los datos para una transferencia de ETH en Scroll Sepolia."""
+    try:
+        data = request.get_json()
+        recipient = data.get("recipient", "")
+        amount = data.get("amount", 0)
+        sender = data.get("sender", "")
+        
+        # Validaciones
+        if not recipient or not sender:
+            return jsonify({
+                "error": "Se requieren las direcciones del remitente y destinatario"
+            }), 400
+        
+        if not Web3.is_address(recipient) or not Web3.is_address(sender):
+            return jsonify({
+                "error": "Dirección inválida. Deben ser direcciones Ethereum válidas"
+            }), 400
         
         if amount <= 0:
             return jsonify({
@@ -564,21 +3095,23 @@ def prepare_transfer():
         # Convertir ETH a Wei
         amount_wei = w3.to_wei(amount, 'ether')
         
-        # Estimar gas
+        speed = data.get("speed", DEFAULT_FEE_SPEED)
+        if speed not in FEE_TIERS:
+            return jsonify({
+                "error": f"Velocidad inválida. Usa una de: {', '.join(FEE_TIERS)}"
+            }), 400
+        
+        # Estimar gas (memorizado por tipo de destinatario y orden de magnitud del monto)
         try:
-            gas_estimate = contract.functions.transferSTX(recipient_checksum).estimate_gas({
-                'from': sender_checksum,
-                'value': amount_wei
-            })
-            
-            gas_price = w3.eth.gas_price
-            estimated_fee_wei = gas_estimate * gas_price
-            estimated_fee_eth = w3.from_wei(estimated_fee_wei, 'ether')
+            gas_estimate, gas_estimate_source = gas_estimates.estimate("transferSTX", sender_checksum, recipient_checksum, amount_wei)
         except Exception as e:
             gas_estimate = 100000  # Estimación por defecto
-            gas_price = w3.eth.gas_price
-            estimated_fee_wei = gas_estimate * gas_price
-            estimated_fee_eth = w3.from_wei(estimated_fee_wei, 'ether')
+            gas_estimate_source = "default"
+        
+        # Comisiones EIP-1559 del oráculo (sin ir al nodo) o gasPrice legacy
+        fee_fields, gas_price = transaction_fees(speed)
+        estimated_fee_wei = gas_estimate * gas_price
+        estimated_fee_eth = w3.from_wei(estimated_fee_wei, 'ether')
         
         # Preparar los datos de la transacción
         transaction_data = {
@@ -591,14 +3124,32 @@ def prepare_transfer():
             "network": NETWORK,
             "chain_id": CHAIN_ID,
             "gas_estimate": gas_estimate,
+            "gas_estimate_source": gas_estimate_source,
             "gas_price_wei": str(gas_price),
             "gas_price_gwei": float(w3.from_wei(gas_price, 'gwei')),
             "estimated_fee_eth": float(estimated_fee_eth),
             "estimated_fee_wei": str(estimated_fee_wei),
+            "tx_type": "eip1559" if "maxFeePerGas" in fee_fields else "legacy",
+            "speed": speed,
             "explorer_url": f"https://sepolia.scrollscan.com/address/{CONTRACT_ADDRESS}",
             "message": f"¿Deseas aprobar la transferencia de {amount} ETH a {recipient_checksum}?"
         }
         
+        if "maxFeePerGas" in fee_fields:
+            transaction_data["max_fee_per_gas_wei"] = str(fee_fields["maxFeePerGas"])
+            transaction_data["max_priority_fee_per_gas_wei"] = str(fee_fields["maxPriorityFeePerGas"])
+            # Cotización de las tres velocidades para que el usuario elija
+            transaction_data["fee_options"] = {
+                option: {
+                    "max_fee_per_gas_gwei": float(w3.from_wei(quote["max_fee_per_gas"], 'gwei')),
+                    "max_priority_fee_per_gas_gwei": float(w3.from_wei(quote["max_priority_fee_per_gas"], 'gwei')),
+                    "estimated_fee_eth": float(w3.from_wei(gas_estimate * quote["expected_gas_price"], 'ether')),
+                    "max_fee_eth": float(w3.from_wei(gas_estimate * quote["max_fee_per_gas"], 'ether'))
+                }
+                for option, quote in ((option, fee_oracle.quote(option)) for option in FEE_TIERS)
+                if quote is not None
+            }
+        
         return jsonify(transaction_data)
         
     except Exception as e:
@@ -725,23 +3276,42 @@ def execute_transfer():
                 "error": f"Balance insuficiente. Tienes {w3.from_wei(balance, 'ether')} ETH"
             }), 400
         
-        # Construir transacción
-        nonce = w3.eth.get_transaction_count(sender_address)
-        
-        transaction = contract.functions.transferSTX(recipient_checksum).build_transaction({
-            'from': sender_address,
-            'value': amount_wei,
-            'gas': 100000,
-            'gasPrice': w3.eth.gas_price,
-            'nonce': nonce,
-            'chainId': CHAIN_ID
-        })
+        speed = data.get("speed", DEFAULT_FEE_SPEED)
+        if speed not in FEE_TIERS:
+            return jsonify({
+                "success": False,
+                "error": f"Velocidad inválida. Usa una de: {', '.join(FEE_TIERS)}"
+            }), 400
         
-        # Firmar transacción
-        signed_txn = w3.eth.account.sign_transaction(transaction, PRIVATE_KEY)
+        fee_fields, _ = transaction_fees(speed)
         
-        # Enviar transacción
-        tx_hash = w3.eth.send_raw_transaction(signed_txn.raw_transaction)
+        # Nonce del gestor compartido; con un error de nonce se reconcilia y se reintenta una vez
+        for attempt in range(2):
+            nonce = nonce_manager.reserve(sender_address)
+            sent = False
+            try:
+                # Construir transacción
+                transaction = contract.functions.transferSTX(recipient_checksum).build_transaction({
+                    'from': sender_address,
+                    'value': amount_wei,
+                    'gas': 100000,
+                    **fee_fields,
+                    'nonce': nonce,
+                    'chainId': CHAIN_ID
+                })
+                
+                # Firmar transacción
+                signed_txn = w3.eth.account.sign_transaction(transaction, PRIVATE_KEY)
+                
+                # Enviar transacción
+                sent = True
+                tx_hash = w3.eth.send_raw_transaction(signed_txn.raw_transaction)
+                break
+            except Exception as e:
+                # Un timeout durante el envío no se reintenta: la transacción pudo llegar al nodo
+                nonce_manager.release(sender_address, nonce, e, sent=sent)
+                if attempt == 1 or not is_nonce_error(e):
+                    raise
         tx_hash_hex = tx_hash.hex()
         
         # Esperar confirmación (opcional, comentado para no bloquear)
@@ -753,6 +3323,7 @@ def execute_transfer():
             "amount": amount,
             "recipient": recipient_checksum,
             "explorer_url": f"https://sepolia.scrollscan.com/tx/{tx_hash_hex}",
+            "nonce": nonce,
             "message": f"Transferencia de {amount} ETH enviada correctamente",
             "network": NETWORK
         })
@@ -1288,14 +3859,41 @@ def get_contact_wallets(wallet_address):
         # Normalizar a checksum address
         wallet_address = Web3.to_checksum_address(wallet_address)
         
-        # Obtener contactos de la wallet
-        response = supabase.table("contact_wallets").select("*").eq(
-            "wallet_quien_agrego", wallet_address
-        ).order("fecha_creacion", desc=True).execute()
+        # Obtener contactos de la wallet
+        response = supabase.table("contact_wallets").select("*").eq(
+            "wallet_quien_agrego", wallet_address
+        ).order("fecha_creacion", desc=True).execute()
+        
+        return jsonify({
+            "success": True,
+            "wallet": wallet_address,
+            "count": len(response.data),
+            "contacts": response.data
+        })
+        
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route("/contact-wallets", methods=["GET"])
+def get_all_contact_wallets():
+    """Obtiene todos los contactos de la tabla contact_wallets."""
+    try:
+        if not supabase:
+            return jsonify({
+                "error": "Supabase no está configurado. Verifica las variables SUPABASE_URL y SUPABASE_KEY"
+            }), 500
+        
+        # Obtener todos los contactos
+        response = supabase.table("contact_wallets").select("*").order(
+            "fecha_creacion", desc=True
+        ).execute()
         
         return jsonify({
             "success": True,
-            "wallet": wallet_address,
             "count": len(response.data),
             "contacts": response.data
         })
@@ -1307,53 +3905,1121 @@ def get_contact_wallets(wallet_address):
         }), 500
 
 
-@app.route("/contact-wallets", methods=["GET"])
-def get_all_contact_wallets():
-    """Obtiene todos los contactos de la tabla contact_wallets."""
-    try:
-        if not supabase:
-            return jsonify({
-                "error": "Supabase no está configurado. Verifica las variables SUPABASE_URL y SUPABASE_KEY"
-            }), 500
-        
-        # Obtener todos los contactos
-        response = supabase.table("contact_wallets").select("*").order(
-            "fecha_creacion", desc=True
-        ).execute()
-        
-        return jsonify({
-            "success": True,
-            "count": len(response.data),
-            "contacts": response.data
-        })
-        
-    except Exception as e:
-        return jsonify({
-            "success": False,
-            "error": str(e)
-        }), 500
+# ======================================
+# 💹 ENDPOINTS DE PYTH NETWORK - PRECIOS EN TIEMPO REAL
+# ======================================
+
+# Pyth Hermes API URL
+PYTH_HERMES_URL = os.getenv("PYTH_HERMES_URL", "https://hermes.pyth.network")
+
+# Price Feed IDs más comunes (Pyth Network)
+PRICE_FEEDS = {
+    "eth": "0xff61491a931112ddf1bd8147cd1b641375f79f5825126d665480874634fd0ace",  # ETH/USD
+    "btc": "0xe62df6c8b4a85fe1a67db44dc12de5db330f7ac66b72dc658afedf0f4a415b43",  # BTC/USD
+    "usdc": "0xeaa020c61cc479712813461ce153894a96a6c00b21ed0cfc2798d1f9a9e9c94a",  # USDC/USD
+    "usdt": "0x2b89b9dc8fdf9f34709a5b106b472f0f39bb6ca9ce04b0fd7f2e971688e2e53b",  # USDT/USD
+    "bnb": "0x2f95862b045670cd22bee3114c39763a4a08beeb663b145d283c31d7d1101c4f",   # BNB/USD
+    "sol": "0xef0d8b6fda2ceba41da15d4095d1da392a0d2f8ed0c6c7bc0f4cfac8c280b56d",   # SOL/USD
+    "matic": "0x5de33a9112c2b700b8d30b8a3402c103578ccfa2765696471cc672bd5cf6ac52", # MATIC/USD
+    "avax": "0x93da3352f9f1d105fdfe4971cfa80e9dd777bfc5d0f683ebb6e1294b92137bb7",  # AVAX/USD
+    "ada": "0x2a01deaec9e51a579277b34b122399984d0bbf57e2458a7e42fecd2829867a0d",   # ADA/USD
+    "doge": "0xdcef50dd0a4cd2dcc17e45df1676dcb336a11a61c69df7a0299b0150c672d25c",  # DOGE/USD
+}
+
+# Ventana de frescura de la caché de precios (segundos)
+PYTH_CACHE_TTL = float(os.getenv("PYTH_CACHE_TTL", "1.5"))
+
+# Modo streaming: una suscripción SSE a Hermes mantiene la caché caliente
+PYTH_STREAMING = os.getenv("PYTH_STREAMING", "false").lower() == "true"
+PYTH_STREAM_STALE_AFTER = float(os.getenv("PYTH_STREAM_STALE_AFTER", "10"))
+
+# Suscriptor de streaming (se inicia al final de la sección de Pyth si está habilitado)
+price_stream = None
+
+# Caché en memoria: feed_id normalizado -> (momento de descarga, price_feed de Hermes)
+_price_cache = {}
+_price_cache_lock = threading.Lock()
+
+
+def _normalize_feed_id(feed_id):
+    """Hermes devuelve los ids sin el prefijo 0x; normalizamos para comparar."""
+    return feed_id.lower().removeprefix("0x")
+
+
+def _store_price_feeds(parsed, fetched_at):
+    """Guarda en la caché los price_feed de Hermes y los devuelve indexados por id normalizado."""
+    stored = {}
+    with _price_cache_lock:
+        for price_feed in parsed:
+            feed_key = _normalize_feed_id(price_feed["id"])
+            _price_cache[feed_key] = (fetched_at, price_feed)
+            stored[feed_key] = price_feed
+
+    # Todo precio observado queda en el historial del feed y se reparte a los clientes SSE
+    batch = decode_price_feeds(stored.values())
+    record_price_history(batch)
+    price_broadcaster.publish(batch)
+    price_alerts.evaluate(batch)
+    return stored
+
+
+hermes_flight = SingleFlight()
+
+
+def _fetch_latest_from_hermes(price_ids):
+    """Descarga de Hermes los precios indicados y los guarda en la caché."""
+    hermes_url = f"{PYTH_HERMES_URL}/v2/updates/price/latest"
+    params = [("ids[]", price_id) for price_id in price_ids]
+
+    response = hermes_session.get(hermes_url, params=params, timeout=HERMES_TIMEOUT)
+    response.raise_for_status()
+
+    data = response.json()
+    return _store_price_feeds(data.get("parsed") or [], time.monotonic())
+
+
+def get_latest_prices(price_ids):
+    """Obtiene los últimos precios de Pyth pasando por la caché en memoria.
+
+    Devuelve un dict {price_id: price_feed} (en el orden pedido) donde cada
+    price_feed tiene el mismo formato que los elementos de "parsed" de Hermes.
+    Solo se consultan a Hermes los feeds cuya entrada tiene más de
+    PYTH_CACHE_TTL segundos; el resto se responde desde memoria. Con el
+    streaming activo y al día, los feeds suscritos al stream se consideran
+    frescos durante PYTH_STREAM_STALE_AFTER segundos, así que no hay I/O
+    saliente; los demás feeds del catálogo siguen con PYTH_CACHE_TTL.
+    """
+    streamed = frozenset()
+    if price_stream and not price_stream.is_stale():
+        streamed = price_stream.feed_keys
+    stream_ttl = max(PYTH_CACHE_TTL, PYTH_STREAM_STALE_AFTER)
+
+    now = time.monotonic()
+    found = {}
+    missing = []
+
+    with _price_cache_lock:
+        for price_id in price_ids:
+            feed_key = _normalize_feed_id(price_id)
+            entry = _price_cache.get(feed_key)
+            ttl = stream_ttl if feed_key in streamed else PYTH_CACHE_TTL
+            if entry and now - entry[0] < ttl:
+                found[price_id] = entry[1]
+            elif price_id not in missing:
+                missing.append(price_id)
+
+    if missing:
+        # Peticiones concurrentes por el mismo conjunto de ids comparten una sola llamada a Hermes
+        flight_key = frozenset(_normalize_feed_id(price_id) for price_id in missing)
+        fetched = hermes_flight.do(flight_key, lambda: _fetch_latest_from_hermes(missing))
+
+        for price_id in missing:
+            price_feed = fetched.get(_normalize_feed_id(price_id))
+            if price_feed:
+                found[price_id] = price_feed
+
+    return {price_id: found[price_id] for price_id in price_ids if price_id in found}
+
+
+class HermesPriceStream:
+    """Suscripción SSE de larga duración a Hermes que mantiene la caché de precios caliente.
+
+    Corre en un hilo daemon, reconecta con backoff exponencial y marca la tabla
+    como obsoleta si no llegan actualizaciones en `stale_after` segundos (en ese
+    caso get_latest_prices vuelve a consultar Hermes por HTTP).
+    """
+
+    def __init__(self, price_ids, base_url, stale_after=10, max_backoff=30):
+        self.price_ids = list(price_ids)
+        self.feed_keys = frozenset(_normalize_feed_id(price_id) for price_id in self.price_ids)
+        self.base_url = base_url
+        self.stale_after = stale_after
+        self.max_backoff = max_backoff
+        self.connected = False
+        self.last_update = None
+        self.last_error = None
+        self.updates = 0
+        self.reconnects = 0
+        self._backoff = 1
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="hermes-price-stream", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def is_stale(self):
+        return self.last_update is None or time.monotonic() - self.last_update > self.stale_after
+
+    def status(self):
+        return {
+            "connected": self.connected,
+            "stale": self.is_stale(),
+            "seconds_since_update": round(time.monotonic() - self.last_update, 3) if self.last_update else None,
+            "updates": self.updates,
+            "reconnects": self.reconnects,
+            "last_error": self.last_error,
+            "feeds": len(self.price_ids)
+        }
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._consume()
+            except Exception as e:
+                self.last_error = str(e)
+            self.connected = False
+
+            if self._stop.is_set():
+                break
+
+            # Reconectar con backoff exponencial
+            self.reconnects += 1
+            self._stop.wait(self._backoff)
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+
+    def _consume(self):
+        stream_url = f"{self.base_url}/v2/updates/price/stream"
+        params = [("ids[]", price_id) for price_id in self.price_ids] + [("parsed", "true")]
+
+        # El read timeout corta conexiones silenciosas para forzar la reconexión
+        with hermes_session.get(stream_url, params=params, stream=True, timeout=(HERMES_TIMEOUT[0], self.stale_after)) as response:
+            response.raise_for_status()
+            self.connected = True
+
+            for line in response.iter_lines():
+                if self._stop.is_set():
+                    return
+
+                line = line.decode("utf-8").strip() if isinstance(line, bytes) else line.strip()
+                if not line.startswith("data:"):
+                    continue
+
+                payload = json.loads(line[len("data:"):].strip())
+                now = time.monotonic()
+                _store_price_feeds(payload.get("parsed") or [], now)
+
+                self.last_update = now
+                self.updates += 1
+                self._backoff = 1
+
+
+
+# ======================================
+# 📚 Catálogo de price feeds de Pyth
+# ======================================
+
+# Archivo donde se persiste el catálogo descargado de Hermes
+PYTH_CATALOG_PATH = os.getenv("PYTH_CATALOG_PATH", "pyth_price_feeds.json")
+# Antigüedad máxima (segundos) del catálogo antes de volver a pedirlo a Hermes
+PYTH_CATALOG_MAX_AGE = float(os.getenv("PYTH_CATALOG_MAX_AGE", "86400"))
+PYTH_CATALOG_AUTOREFRESH = os.getenv("PYTH_CATALOG_AUTOREFRESH", "true").lower() == "true"
+
+
+class PythFeedCatalog:
+    """Catálogo de price feeds de Pyth con índices O(1) símbolo→id e id→símbolo.
+
+    Arranca con el snapshot PRICE_FEEDS, se reemplaza con el archivo persistido
+    en disco si existe y se actualiza desde el listado /v2/price_feeds de Hermes.
+    Los símbolos del snapshot conservan siempre su feed id.
+    """
+
+    def __init__(self, snapshot, path):
+        self.snapshot = [{"symbol": symbol, "id": feed_id} for symbol, feed_id in snapshot.items()]
+        self.path = path
+        self._refresh_lock = threading.Lock()
+        self._set_entries([], "snapshot", None)
+
+    def _set_entries(self, entries, source, updated_at):
+        by_symbol = {}
+        by_id = {}
+
+        # El snapshot va primero: ante símbolos duplicados gana la primera entrada
+        for entry in self.snapshot + entries:
+            symbol = entry["symbol"].strip().lower()
+            feed_key = _normalize_feed_id(entry["id"])
+            if not symbol or symbol in by_symbol or feed_key in by_id:
+                continue
+            by_symbol[symbol] = {**entry, "symbol": symbol, "id": f"0x{feed_key}"}
+            by_id[feed_key] = symbol
+
+        # Reemplazo atómico de los índices (los lectores nunca ven un estado a medias)
+        self._indexes = (by_symbol, by_id, sorted(by_symbol))
+        self.source = source
+        self.updated_at = updated_at
+
+    def __len__(self):
+        return len(self._indexes[0])
+
+    def __contains__(self, symbol):
+        return symbol.lower() in self._indexes[0]
+
+    def get_id(self, symbol):
+        entry = self._indexes[0].get(symbol.lower())
+        return entry["id"] if entry else None
+
+    def get_symbol(self, feed_id):
+        return self._indexes[1].get(_normalize_feed_id(feed_id))
+
+    def search(self, prefix="", offset=0, limit=50):
+        """Busca feeds cuyo símbolo empieza con `prefix`. Devuelve (total, entradas de la página)."""
+        by_symbol, _, symbols = self._indexes
+        prefix = prefix.strip().lower()
+
+        start = bisect.bisect_left(symbols, prefix)
+        end = bisect.bisect_left(symbols, prefix + "\uffff") if prefix else len(symbols)
+
+        page = symbols[start + offset:min(start + offset + limit, end)] if limit > 0 else []
+        return end - start, [by_symbol[symbol] for symbol in page]
+
+    def is_expired(self):
+        return self.updated_at is None or time.time() - self.updated_at > PYTH_CATALOG_MAX_AGE
+
+    def load_from_disk(self):
+        """Carga el catálogo persistido. Devuelve False si no existe o es inválido."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            self._set_entries(stored["feeds"], "disk", stored.get("updated_at"))
+            return True
+        except Exception:
+            return False
+
+    def refresh_from_hermes(self):
+        """Descarga el listado de feeds cripto/USD de Hermes, reconstruye los índices y lo persiste."""
+        with self._refresh_lock:
+            response = hermes_session.get(f"{PYTH_HERMES_URL}/v2/price_feeds", params={"asset_type": "crypto"}, timeout=(HERMES_TIMEOUT[0], 30))
+            response.raise_for_status()
+
+            entries = []
+            for feed in response.json():
+                attributes = feed.get("attributes", {})
+                if attributes.get("quote_currency", "").upper() != "USD" or not attributes.get("base"):
+                    continue
+                entries.append({
+                    "symbol": attributes["base"].lower(),
+                    "id": feed["id"],
+                    "description": attributes.get("description"),
+                    "display_symbol": attributes.get("display_symbol")
+                })
+
+            updated_at = time.time()
+            self._set_entries(entries, "hermes", updated_at)
+
+            # Escritura atómica del archivo
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"updated_at": updated_at, "feeds": entries}, f)
+            os.replace(tmp_path, self.path)
+
+            return len(self)
+
+
+def _refresh_feed_catalog():
+    try:
+        feed_catalog.refresh_from_hermes()
+        print(f"✅ Catálogo de Pyth actualizado: {len(feed_catalog)} feeds")
+    except Exception as e:
+        print(f"⚠️ No se pudo actualizar el catálogo de Pyth ({feed_catalog.source}): {e}")
+
+
+feed_catalog = PythFeedCatalog(PRICE_FEEDS, PYTH_CATALOG_PATH)
+feed_catalog.load_from_disk()
+if PYTH_CATALOG_AUTOREFRESH and feed_catalog.is_expired():
+    threading.Thread(target=_refresh_feed_catalog, name="pyth-catalog-refresh", daemon=True).start()
+
+
+# ======================================
+# 🧮 Decodificación exacta de precios de Pyth
+# ======================================
+
+def _exact_decimal(mantissa, exponent):
+    """Decimal exacto mantisa × 10^exponente (scaleb redondearía a la precisión del contexto)."""
+    return Decimal((int(mantissa < 0), tuple(int(digit) for digit in str(abs(mantissa))), exponent))
+
+
+class PriceBatch:
+    """Lote de precios de Hermes decodificados como enteros escalados (precio = mantisa × 10^expo).
+
+    Los precios se exponen como Decimal exactos. La valoración en lote también es
+    exacta: cantidades y precios se multiplican como enteros y el exponente se
+    aplica una sola vez al final, con NumPy (matriz de enteros de Python) o sin él.
+    """
+
+    def __init__(self, feed_keys, prices, confs, expos, publish_times):
+        self.feed_keys = feed_keys
+        self.prices = prices
+        self.confs = confs
+        self.expos = expos
+        self.publish_times = publish_times
+        self.index = {feed_key: i for i, feed_key in enumerate(feed_keys)}
+
+    def __len__(self):
+        return len(self.feed_keys)
+
+    def __contains__(self, feed_id):
+        return _normalize_feed_id(feed_id) in self.index
+
+    def price(self, feed_id):
+        i = self.index[_normalize_feed_id(feed_id)]
+        return _exact_decimal(self.prices[i], self.expos[i])
+
+    def conf(self, feed_id):
+        i = self.index[_normalize_feed_id(feed_id)]
+        return _exact_decimal(self.confs[i], self.expos[i])
+
+    def expo(self, feed_id):
+        return self.expos[self.index[_normalize_feed_id(feed_id)]]
+
+    def publish_time(self, feed_id):
+        return self.publish_times[self.index[_normalize_feed_id(feed_id)]]
+
+    def _scaled_amounts(self, portfolios):
+        """Cantidades como enteros × 10^scale (scale común al lote), sumando las grafías de un mismo feed."""
+        decoded = []
+        for holdings in portfolios:
+            row = []
+            for feed_id, amount in holdings.items():
+                feed_key = _normalize_feed_id(feed_id)
+                if feed_key not in self.index:
+                    continue
+                amount = Decimal(str(amount))
+                if not amount.is_finite():
+                    raise ValueError(f"Invalid amount: {amount}")
+                sign, digits, exponent = amount.as_tuple()
+                mantissa = int("".join(map(str, digits)))
+                row.append((feed_key, -mantissa if sign else mantissa, exponent))
+            decoded.append(row)
+
+        scale = min((exponent for row in decoded for _, _, exponent in row), default=0)
+        rows = []
+        for row in decoded:
+            amounts = {}
+            for feed_key, mantissa, exponent in row:
+                amounts[feed_key] = amounts.get(feed_key, 0) + mantissa * 10 ** (exponent - scale)
+            rows.append(amounts)
+        return rows, scale
+
+    def value_portfolios(self, portfolios):
+        """Valora muchos portfolios a la vez.
+
+        `portfolios` es una lista de dicts {feed_id: cantidad}. Devuelve una lista
+        de (total, {feed_id normalizado: valor}) en el mismo orden, todo en Decimal
+        exacto; los feeds sin precio en el lote se ignoran.
+        """
+        rows, scale = self._scaled_amounts(portfolios)
+        # El total de cada portfolio se acumula en el menor exponente del lote
+        low = min(self.expos, default=0)
+        weights = [price * 10 ** (expo - low) for price, expo in zip(self.prices, self.expos)]
+
+        if np is not None:
+            return self._value_portfolios_numpy(rows, scale, low, weights)
+
+        results = []
+        for amounts in rows:
+            total = 0
+            values = {}
+            for feed_key, amount in amounts.items():
+                i = self.index[feed_key]
+                values[feed_key] = _exact_decimal(amount * self.prices[i], self.expos[i] + scale)
+                total += amount * weights[i]
+            results.append((_exact_decimal(total, low + scale), values))
+        return results
+
+    def _value_portfolios_numpy(self, rows, scale, low, weights):
+        # Matriz portfolios × feeds de enteros de Python (dtype=object): un producto valora todo sin redondeo
+        amounts = np.zeros((len(rows), len(self.feed_keys)), dtype=object)
+        for row, row_amounts in enumerate(rows):
+            for feed_key, amount in row_amounts.items():
+                amounts[row, self.index[feed_key]] = amount
+
+        totals = amounts.dot(np.array(weights, dtype=object)) if len(self.feed_keys) else [0] * len(rows)
+        return [
+            (
+                _exact_decimal(int(totals[row]), low + scale),
+                {
+                    feed_key: _exact_decimal(amounts[row, self.index[feed_key]] * self.prices[self.index[feed_key]], self.expos[self.index[feed_key]] + scale)
+                    for feed_key in row_amounts
+                }
+            )
+            for row, row_amounts in enumerate(rows)
+        ]
+
+
+def decode_price_feeds(price_feeds):
+    """Decodifica en una sola pasada una lista de price_feed de Hermes (elementos de "parsed").
+
+    Las entradas mal formadas no detienen el lote: quedan en `batch.invalid`
+    ({feed_id normalizado: error}).
+    """
+    feed_keys, prices, confs, expos, publish_times = [], [], [], [], []
+    invalid = {}
+
+    for price_feed in price_feeds:
+        feed_key = _normalize_feed_id(price_feed.get("id", ""))
+        try:
+            price_data = price_feed["price"]
+            decoded = (int(price_data["price"]), int(price_data["conf"]), int(price_data["expo"]), price_data["publish_time"])
+        except Exception as e:
+            invalid[feed_key] = str(e)
+            continue
+
+        feed_keys.append(feed_key)
+        prices.append(decoded[0])
+        confs.append(decoded[1])
+        expos.append(decoded[2])
+        publish_times.append(decoded[3])
+
+    batch = PriceBatch(feed_keys, prices, confs, expos, publish_times)
+    batch.invalid = invalid
+    return batch
+
+
+# ======================================
+# 📈 Historial de precios por feed (ring buffer)
+# ======================================
+
+# Muestras que guarda cada feed
+PYTH_HISTORY_SIZE = max(int(os.getenv("PYTH_HISTORY_SIZE", "1024")), 2)
+# Retornos mínimos para usar volatilidad realizada en vez del intervalo de confianza
+PYTH_HISTORY_MIN_SAMPLES = int(os.getenv("PYTH_HISTORY_MIN_SAMPLES", "10"))
+
+VOLATILITY_LABELS = ["Very Low", "Low", "Moderate", "High"]
+# Límites (%) de la desviación estándar de retornos por √segundo
+REALIZED_VOLATILITY_THRESHOLDS = [0.005, 0.01, 0.02, 0.04]
+# Límites (%) de confianza / precio cuando no hay historial suficiente
+CONFIDENCE_VOLATILITY_THRESHOLDS = [0.1, 0.5, 1.0, 2.0]
+
+
+class PriceHistory:
+    """Ring buffer de tamaño fijo (arrays de floats) con los precios observados de un feed.
+
+    Cada muestra guarda su retorno respecto a la anterior normalizado por √Δt, y la
+    suma y suma de cuadrados de los retornos de la ventana completa se mantienen
+    incrementalmente al insertar y desalojar muestras.
+    """
+
+    def __init__(self, capacity=PYTH_HISTORY_SIZE):
+        self.capacity = capacity
+        self.times = array("d", [0.0]) * capacity
+        self.prices = array("d", [0.0]) * capacity
+        self.returns = array("d", [0.0]) * capacity
+        self.head = 0
+        self.count = 0
+        self._sum = 0.0
+        self._sumsq = 0.0
+        self._lock = threading.Lock()
+
+    def append(self, publish_time, price):
+        """Agrega una muestra; ignora las que no son más nuevas que la última."""
+        with self._lock:
+            ret = None
+            if self.count:
+                last = (self.head - 1) % self.capacity
+                if publish_time <= self.times[last]:
+                    return False
+                previous = self.prices[last]
+                if previous > 0:
+                    ret = (price / previous - 1) / math.sqrt(publish_time - self.times[last])
+
+            if self.count == self.capacity:
+                # La muestra siguiente a la desalojada pasa a ser la más vieja: su retorno sale de la ventana
+                oldest = (self.head + 1) % self.capacity
+                self._sum -= self.returns[oldest]
+                self._sumsq -= self.returns[oldest] ** 2
+                self.returns[oldest] = 0.0
+
+            self.times[self.head] = publish_time
+            self.prices[self.head] = price
+            self.returns[self.head] = ret or 0.0
+            if ret is not None:
+                self._sum += ret
+                self._sumsq += ret * ret
+
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+            # Recalcular las sumas en cada vuelta del buffer para evitar deriva numérica
+            if self.head == 0:
+                window = self._ordered(self.returns)[1:]
+                self._sum = math.fsum(window)
+                self._sumsq = math.fsum(r * r for r in window)
+            return True
+
+    def _ordered(self, values, window=None):
+        """Valores de las últimas `window` muestras, de la más vieja a la más nueva."""
+        n = self.count if window is None else min(window, self.count)
+        start = (self.head - n) % self.capacity
+        if start + n <= self.capacity:
+            return values[start:start + n].tolist()
+        return values[start:].tolist() + values[:(start + n) % self.capacity].tolist()
+
+    def samples(self, window=None):
+        with self._lock:
+            return list(zip(self._ordered(self.times, window), self._ordered(self.prices, window)))
+
+    def stats(self, window=None):
+        """Estadísticas de la ventana (por defecto todo el buffer). None si no hay muestras."""
+        with self._lock:
+            if not self.count:
+                return None
+
+            prices = self._ordered(self.prices, window)
+            n = len(prices)
+            if n == self.count:
+                # Ventana completa: sumas incrementales
+                total, total_sq = self._sum, self._sumsq
+            else:
+                window_returns = self._ordered(self.returns, window)[1:]
+                total, total_sq = math.fsum(window_returns), math.fsum(r * r for r in window_returns)
+            returns_count = n - 1
+
+        stddev = None
+        if returns_count >= 2:
+            variance = max((total_sq - total * total / returns_count) / (returns_count - 1), 0.0)
+            stddev = math.sqrt(variance) * 100
+
+        return {
+            "samples": n,
+            "returns": returns_count,
+            "first": prices[0],
+            "last": prices[-1],
+            "min": min(prices),
+            "max": max(prices),
+            "mean": math.fsum(prices) / n,
+            "change_pct": (prices[-1] / prices[0] - 1) * 100 if prices[0] > 0 else 0.0,
+            "return_mean_pct": total / returns_count * 100 if returns_count else None,
+            "return_stddev_pct": stddev
+        }
+
+
+_price_histories = {}
+_price_histories_lock = threading.Lock()
+
+
+def get_price_history(feed_id, create=False):
+    feed_key = _normalize_feed_id(feed_id)
+    history = _price_histories.get(feed_key)
+    if history is None and create:
+        with _price_histories_lock:
+            history = _price_histories.setdefault(feed_key, PriceHistory())
+    return history
+
+
+def record_price_history(batch):
+    """Registra en el historial de cada feed los precios de un PriceBatch."""
+    for feed_key in batch.feed_keys:
+        get_price_history(feed_key, create=True).append(float(batch.publish_time(feed_key)), float(batch.price(feed_key)))
+
+
+def classify_volatility(feed_id, confidence_pct):
+    """Etiqueta de volatilidad del feed y su origen ("history" o "confidence").
+
+    Usa la volatilidad realizada del historial si hay suficientes retornos y si no
+    el cociente confianza / precio de la última muestra.
+    """
+    history = get_price_history(feed_id)
+    stats = history.stats() if history else None
+
+    if stats and stats["returns"] >= PYTH_HISTORY_MIN_SAMPLES and stats["return_stddev_pct"] is not None:
+        value, thresholds, source = stats["return_stddev_pct"], REALIZED_VOLATILITY_THRESHOLDS, "history"
+    else:
+        value, thresholds, source = confidence_pct, CONFIDENCE_VOLATILITY_THRESHOLDS, "confidence"
+
+    return volatility_label(value, thresholds), source
+
+
+def volatility_label(value, thresholds):
+    for limit, label in zip(thresholds, VOLATILITY_LABELS):
+        if value < limit:
+            return label
+    return "Very High"
+
+
+# ======================================
+# 📡 Difusión de precios a clientes SSE
+# ======================================
+
+# Intervalo del poller compartido cuando no hay streaming de Hermes (segundos)
+PYTH_SSE_POLL_INTERVAL = float(os.getenv("PYTH_SSE_POLL_INTERVAL", "1"))
+# Segundos entre comentarios keep-alive hacia el cliente
+PYTH_SSE_HEARTBEAT = float(os.getenv("PYTH_SSE_HEARTBEAT", "15"))
+# Con gthread cada cliente SSE ocupa un hilo hasta que se desconecta: por defecto se dejan
+# PYTH_SSE_RESERVED_THREADS hilos libres para el resto de peticiones
+PYTH_SSE_RESERVED_THREADS = int(os.getenv("PYTH_SSE_RESERVED_THREADS", "4"))
+PYTH_SSE_MAX_CLIENTS = int(os.getenv(
+    "PYTH_SSE_MAX_CLIENTS",
+    "100" if ASYNC_SERVING else str(max(1, WORKER_CONCURRENCY - PYTH_SSE_RESERVED_THREADS))
+))
+PYTH_SSE_MAX_SYMBOLS = 50
+
+
+def sse_price_message(batch, feed_key):
+    """Serializa el precio de un feed del lote como payload JSON de un evento SSE."""
+    price = batch.price(feed_key)
+    return json.dumps({
+        "symbol": (feed_catalog.get_symbol(feed_key) or "UNKNOWN").upper(),
+        "price": float(price),
+        "price_usd": f"${price:.2f}",
+        "confidence": float(batch.conf(feed_key)),
+        "publish_time": batch.publish_time(feed_key)
+    })
+
+
+class PriceSubscriber:
+    """Buzón de un cliente SSE: guarda solo el último precio pendiente por feed.
+
+    Si el cliente consume más lento de lo que llegan los precios, las
+    actualizaciones intermedias se reemplazan (coalescen) en vez de encolarse,
+    así que la memoria por cliente está acotada por la cantidad de símbolos.
+    """
+
+    def __init__(self, feed_keys):
+        self.feed_keys = set(feed_keys)
+        self.coalesced = 0
+        self._pending = {}
+        self._last_publish_time = {}
+        self._cond = threading.Condition()
+
+    def offer(self, feed_key, publish_time, message):
+        with self._cond:
+            if publish_time <= self._last_publish_time.get(feed_key, -1):
+                return
+            self._last_publish_time[feed_key] = publish_time
+            if feed_key in self._pending:
+                self.coalesced += 1
+            self._pending[feed_key] = message
+            self._cond.notify()
+
+    def drain(self, timeout):
+        """Espera hasta `timeout` segundos y devuelve los mensajes pendientes (puede ser vacío)."""
+        with self._cond:
+            if not self._pending:
+                self._cond.wait(timeout)
+            messages = list(self._pending.values())
+            self._pending = {}
+            return messages
+
+
+class PriceBroadcaster:
+    """Reparte cada precio recibido de Hermes a todos los clientes suscritos a ese feed.
+
+    Los precios entran por _store_price_feeds (streaming de Hermes o el poller
+    compartido), de modo que hay una sola fuente upstream por proceso sin
+    importar cuántos clientes estén conectados.
+    """
+
+    def __init__(self, max_clients):
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._by_feed = {}
+        self._subscribers = set()
+        self._poller = None
+
+    def subscribe(self, feed_keys):
+        subscriber = PriceSubscriber(feed_keys)
+        with self._lock:
+            if len(self._subscribers) >= self.max_clients:
+                return None
+            self._subscribers.add(subscriber)
+            for feed_key in subscriber.feed_keys:
+                self._by_feed.setdefault(feed_key, set()).add(subscriber)
+
+            if self._poller is None or not self._poller.is_alive():
+                self._poller = threading.Thread(target=self._poll_loop, name="pyth-sse-poller", daemon=True)
+                self._poller.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+            for feed_key in subscriber.feed_keys:
+                subscribers = self._by_feed.get(feed_key)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self._by_feed[feed_key]
+
+    def is_full(self):
+        with self._lock:
+            return len(self._subscribers) >= self.max_clients
+
+    def feed_keys(self):
+        with self._lock:
+            return list(self._by_feed)
+
+    def client_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, batch):
+        with self._lock:
+            targets = {feed_key: list(self._by_feed.get(feed_key, ())) for feed_key in batch.feed_keys}
+
+        for feed_key, subscribers in targets.items():
+            if not subscribers:
+                continue
+
+            # El mensaje se arma una sola vez y se comparte entre todos los clientes
+            message = sse_price_message(batch, feed_key)
+            for subscriber in subscribers:
+                subscriber.offer(feed_key, batch.publish_time(feed_key), message)
+
+    def _poll_loop(self):
+        # Un único poller por proceso mientras haya clientes; con streaming activo lee de la caché
+        while True:
+            feed_keys = self.feed_keys()
+            if not feed_keys:
+                with self._lock:
+                    if not self._by_feed:
+                        self._poller = None
+                        return
+                continue
+            try:
+                get_latest_prices([f"0x{feed_key}" for feed_key in feed_keys])
+            except Exception as e:
+                print(f"⚠️ Error en el poller de precios SSE: {e}")
+            time.sleep(PYTH_SSE_POLL_INTERVAL)
+
+
+price_broadcaster = PriceBroadcaster(PYTH_SSE_MAX_CLIENTS)
+
+
+# ======================================
+# 🔔 Alertas de precio
+# ======================================
+
+PYTH_ALERTS_DB = os.getenv("PYTH_ALERTS_DB", "price_alerts.db")
+# Intervalo con el que se consultan los feeds que tienen alertas activas (segundos)
+PYTH_ALERTS_POLL_INTERVAL = float(os.getenv("PYTH_ALERTS_POLL_INTERVAL", "2"))
+PYTH_ALERTS_WEBHOOK_RETRIES = int(os.getenv("PYTH_ALERTS_WEBHOOK_RETRIES", "3"))
+# Espera máxima por el bloqueo de escritura de la base de alertas (segundos)
+PYTH_ALERTS_LOCK_TIMEOUT = float(os.getenv("PYTH_ALERTS_LOCK_TIMEOUT", "10"))
+
+
+class PriceAlertEngine:
+    """Registro de alertas de precio evaluado en cada tick que observa la capa de Pyth.
+
+    Por feed se mantienen dos listas ordenadas: umbrales "below" (se disparan
+    cuando el precio cae por debajo) y umbrales "above" negados (se disparan
+    cuando lo supera). Así las alertas cruzadas por un tick son siempre la cola
+    de la lista y se encuentran con un bisect, sin recorrer las demás. Las
+    alertas se persisten en SQLite y la entrega (webhook y listeners) ocurre en
+    un hilo aparte, fuera del camino de la petición.
+
+    La base y los hilos se crean en el primer uso. Con varios workers cada uno
+    puede tener la misma alerta en memoria: la entrega la reclama con un UPDATE
+    condicionado a status = 'active', así que solo un worker la envía y una
+    alerta cancelada (desde cualquier worker) no se dispara.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.triggered = 0
+        self.delivered = 0
+        self.delivery_errors = 0
+        self.already_claimed = 0
+        self._lock = threading.Lock()
+        self._index = {}
+        self._active = {}
+        self._seq = itertools.count()
+        self._deliveries = queue.Queue()
+        self._listeners = []
+        self._watcher = None
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        """Crea la base, carga las alertas activas e inicia el hilo de entrega (una vez por proceso)."""
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            self._init_db()
+            self._load_active()
+            threading.Thread(target=self._delivery_loop, name="price-alert-delivery", daemon=True).start()
+            self._started = True
+        if self._active:
+            self._ensure_watcher()
+
+    # -- persistencia --
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=sqlite_busy_timeout(PYTH_ALERTS_LOCK_TIMEOUT))
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _execute(self, *statements):
+        """Ejecuta (sql, params) en una sola transacción; devuelve el cursor de la última sentencia ya leído."""
+        def transaction():
+            connection = self._connect()
+            try:
+                with connection:
+                    for sql, params in statements:
+                        cursor = connection.execute(sql, params)
+                    return cursor.fetchall(), cursor.rowcount
+            finally:
+                connection.close()
+
+        return sqlite_retry_locked(transaction, PYTH_ALERTS_LOCK_TIMEOUT)
+
+    def _init_db(self):
+        self._execute(
+            ("""
+                CREATE TABLE IF NOT EXISTS price_alerts (
+                    id TEXT PRIMARY KEY,
+                    symbol TEXT NOT NULL,
+                    feed_id TEXT NOT NULL,
+                    direction TEXT NOT NULL,
+                    threshold REAL NOT NULL,
+                    webhook_url TEXT,
+                    wallet TEXT,
+                    status TEXT NOT NULL DEFAULT 'active',
+                    created_at REAL NOT NULL,
+                    triggered_at REAL,
+                    triggered_price REAL,
+                    publish_time INTEGER
+                )
+            """, ()),
+            ("CREATE INDEX IF NOT EXISTS idx_price_alerts_status ON price_alerts (status)", ()),
+            ("CREATE INDEX IF NOT EXISTS idx_price_alerts_wallet ON price_alerts (wallet)", ())
+        )
+
+    def _load_active(self):
+        rows, _ = self._execute(("SELECT * FROM price_alerts WHERE status = 'active'", ()))
+
+        # Carga masiva: se agregan sin ordenar y se ordena una vez por lista
+        with self._lock:
+            for row in rows:
+                self._index_add(dict(row), keep_sorted=False)
+            for sides in self._index.values():
+                sides["below"].sort()
+                sides["above"].sort()
+
+    # -- índice en memoria --
+
+    def _index_add(self, alert, keep_sorted=True):
+        alert["seq"] = next(self._seq)
+        sides = self._index.setdefault(alert["feed_id"], {"below": [], "above": []})
+        if alert["direction"] == "below":
+            entry = (alert["threshold"], alert["seq"], alert["id"])
+        else:
+            entry = (-alert["threshold"], alert["seq"], alert["id"])
+
+        if keep_sorted:
+            bisect.insort(sides[alert["direction"]], entry)
+        else:
+            sides[alert["direction"]].append(entry)
+        self._active[alert["id"]] = alert
+
+    def _index_remove(self, alert):
+        sides = self._index.get(alert["feed_id"])
+        if not sides:
+            return
+        key = alert["threshold"] if alert["direction"] == "below" else -alert["threshold"]
+        entries = sides[alert["direction"]]
+        position = bisect.bisect_left(entries, (key, alert["seq"], alert["id"]))
+        if position < len(entries) and entries[position][2] == alert["id"]:
+            del entries[position]
+        if not sides["below"] and not sides["above"]:
+            del self._index[alert["feed_id"]]
+
+    # -- API --
+
+    def add_listener(self, callback):
+        """Registra una función que recibe cada alerta disparada (en el hilo de entrega)."""
+        self._listeners.append(callback)
+
+    def create(self, symbol, feed_id, direction, threshold, webhook_url=None, wallet=None):
+        alert = {
+            "id": uuid.uuid4().hex,
+            "symbol": symbol.lower(),
+            "feed_id": _normalize_feed_id(feed_id),
+            "direction": direction,
+            "threshold": float(threshold),
+            "webhook_url": webhook_url,
+            "wallet": wallet,
+            "status": "active",
+            "created_at": time.time()
+        }
+        self._ensure_started()
+        self._execute((
+            "INSERT INTO price_alerts (id, symbol, feed_id, direction, threshold, webhook_url, wallet, status, created_at) "
+            "VALUES (:id, :symbol, :feed_id, :direction, :threshold, :webhook_url, :wallet, :status, :created_at)",
+            alert
+        ))
+        with self._lock:
+            self._index_add(alert)
+        self._ensure_watcher()
+        return self.get(alert["id"])
+
+    def cancel(self, alert_id):
+        """Cancela una alerta activa. Devuelve la alerta (o None si no existe)."""
+        self._ensure_started()
+        with self._lock:
+            alert = self._active.pop(alert_id, None)
+            if alert:
+                self._index_remove(alert)
+        # Siempre en la base: la alerta puede estar en memoria solo en otro worker
+        self._execute(("UPDATE price_alerts SET status = 'cancelled' WHERE id = ? AND status = 'active'", (alert_id,)))
+        return self.get(alert_id)
+
+    def get(self, alert_id):
+        self._ensure_started()
+        rows, _ = self._execute(("SELECT * FROM price_alerts WHERE id = ?", (alert_id,)))
+        return dict(rows[0]) if rows else None
+
+    def list_alerts(self, wallet=None, symbol=None, status=None, limit=100):
+        query = "SELECT * FROM price_alerts WHERE 1 = 1"
+        params = []
+        for column, value in (("wallet", wallet), ("symbol", symbol.lower() if symbol else None), ("status", status)):
+            if value:
+                query += f" AND {column} = ?"
+                params.append(value)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        self._ensure_started()
+        rows, _ = self._execute((query, params))
+        return [dict(row) for row in rows]
+
+    def active_count(self):
+        return len(self._active)
+
+    def feed_keys(self):
+        with self._lock:
+            return list(self._index)
+
+    def evaluate(self, batch):
+        """Dispara las alertas cruzadas por los precios del lote (se llama en cada tick)."""
+        # El primer tick del proceso retoma las alertas activas guardadas
+        self._ensure_started()
+        if not self._index:
+            return
+
+        fired = []
+        with self._lock:
+            for feed_key in batch.feed_keys:
+                sides = self._index.get(feed_key)
+                if not sides:
+                    continue
+                price = float(batch.price(feed_key))
+                publish_time = batch.publish_time(feed_key)
+
+                # below: umbral > precio | above (negado): -umbral > -precio → siempre la cola de la lista
+                for direction, key in (("below", price), ("above", -price)):
+                    entries = sides[direction]
+                    position = bisect.bisect_right(entries, (key, math.inf))
+                    if position == len(entries):
+                        continue
+                    for _, _, alert_id in entries[position:]:
+                        alert = self._active.pop(alert_id)
+                        fired.append({**alert, "triggered_price": price, "publish_time": publish_time})
+                    del entries[position:]
+
+                if not sides["below"] and not sides["above"]:
+                    del self._index[feed_key]
+
+        for alert in fired:
+            self.triggered += 1
+            self._deliveries.put(alert)
+
+    def stats(self):
+        return {
+            "active": self.active_count(),
+            "feeds": len(self._index),
+            "triggered": self.triggered,
+            "delivered": self.delivered,
+            "delivery_errors": self.delivery_errors,
+            "already_claimed": self.already_claimed,
+            "pending_deliveries": self._deliveries.qsize()
+        }
+
+    # -- hilos de fondo --
+
+    def _ensure_watcher(self):
+        with self._lock:
+            if self._watcher is None or not self._watcher.is_alive():
+                self._watcher = threading.Thread(target=self._watch_loop, name="price-alert-watcher", daemon=True)
+                self._watcher.start()
 
+    def _watch_loop(self):
+        # Mantiene observados los feeds con alertas activas (con streaming son lecturas de caché)
+        while True:
+            feed_keys = self.feed_keys()
+            if not feed_keys:
+                with self._lock:
+                    if not self._index:
+                        self._watcher = None
+                        return
+                continue
+            try:
+                get_latest_prices([f"0x{feed_key}" for feed_key in feed_keys])
+            except Exception as e:
+                print(f"⚠️ Error consultando precios para alertas: {e}")
+            time.sleep(PYTH_ALERTS_POLL_INTERVAL)
 
-# ======================================
-# 💹 ENDPOINTS DE PYTH NETWORK - PRECIOS EN TIEMPO REAL
-# ======================================
+    def _delivery_loop(self):
+        while True:
+            alert = self._deliveries.get()
+            alert["status"] = "triggered"
+            alert["triggered_at"] = time.time()
+            try:
+                # Reclamo atómico: cancelada o ya disparada por otro worker → no se entrega
+                _, claimed_rows = self._execute((
+                    "UPDATE price_alerts SET status = 'triggered', triggered_at = ?, triggered_price = ?, publish_time = ? "
+                    "WHERE id = ? AND status = 'active'",
+                    (alert["triggered_at"], alert["triggered_price"], alert["publish_time"], alert["id"])
+                ))
+                if claimed_rows != 1:
+                    self.already_claimed += 1
+                    continue
 
-# Pyth Hermes API URL
-PYTH_HERMES_URL = "https://hermes.pyth.network"
+                for callback in self._listeners:
+                    callback(alert)
+
+                if alert.get("webhook_url"):
+                    self._deliver_webhook(alert)
+                self.delivered += 1
+            except Exception as e:
+                self.delivery_errors += 1
+                print(f"⚠️ Error entregando alerta {alert['id']}: {e}")
+
+    def _deliver_webhook(self, alert):
+        payload = {
+            "alert_id": alert["id"],
+            "symbol": alert["symbol"].upper(),
+            "condition": alert["direction"],
+            "threshold": alert["threshold"],
+            "price": alert["triggered_price"],
+            "publish_time": alert["publish_time"],
+            "wallet": alert.get("wallet")
+        }
+        for attempt in range(PYTH_ALERTS_WEBHOOK_RETRIES):
+            try:
+                response = webhook_session.post(alert["webhook_url"], json=payload, timeout=WEBHOOK_TIMEOUT)
+                response.raise_for_status()
+                return
+            except requests.exceptions.RequestException:
+                if attempt == PYTH_ALERTS_WEBHOOK_RETRIES - 1:
+                    raise
+                time.sleep(2 ** attempt)
+
+
+price_alerts = PriceAlertEngine(PYTH_ALERTS_DB)
+
+
+# Iniciar el streaming de Hermes si está habilitado
+if PYTH_STREAMING:
+    price_stream = HermesPriceStream(PRICE_FEEDS.values(), PYTH_HERMES_URL, stale_after=PYTH_STREAM_STALE_AFTER)
+    price_stream.start()
 
-# Price Feed IDs más comunes (Pyth Network)
-PRICE_FEEDS = {
-    "eth": "0xff61491a931112ddf1bd8147cd1b641375f79f5825126d665480874634fd0ace",  # ETH/USD
-    "btc": "0xe62df6c8b4a85fe1a67db44dc12de5db330f7ac66b72dc658afedf0f4a415b43",  # BTC/USD
-    "usdc": "0xeaa020c61cc479712813461ce153894a96a6c00b21ed0cfc2798d1f9a9e9c94a",  # USDC/USD
-    "usdt": "0x2b89b9dc8fdf9f34709a5b106b472f0f39bb6ca9ce04b0fd7f2e971688e2e53b",  # USDT/USD
-    "bnb": "0x2f95862b045670cd22bee3114c39763a4a08beeb663b145d283c31d7d1101c4f",   # BNB/USD
-    "sol": "0xef0d8b6fda2ceba41da15d4095d1da392a0d2f8ed0c6c7bc0f4cfac8c280b56d",   # SOL/USD
-    "matic": "0x5de33a9112c2b700b8d30b8a3402c103578ccfa2765696471cc672bd5cf6ac52", # MATIC/USD
-    "avax": "0x93da3352f9f1d105fdfe4971cfa80e9dd777bfc5d0f683ebb6e1294b92137bb7",  # AVAX/USD
-    "ada": "0x2a01deaec9e51a579277b34b122399984d0bbf57e2458a7e42fecd2829867a0d",   # ADA/USD
-    "doge": "0xdcef50dd0a4cd2dcc17e45df1676dcb336a11a61c69df7a0299b0150c672d25c",  # DOGE/USD
-}
 
 @app.route("/pyth/price/<symbol>", methods=["GET"])
 def get_pyth_price(symbol):
@@ -1362,49 +5028,37 @@ def get_pyth_price(symbol):
         symbol_lower = symbol.lower()
         
         # Verificar si el símbolo existe
-        if symbol_lower not in PRICE_FEEDS:
+        price_feed_id = feed_catalog.get_id(symbol_lower)
+        if not price_feed_id:
             return jsonify({
                 "success": False,
-                "error": f"Symbol '{symbol}' not supported. Available: {', '.join(PRICE_FEEDS.keys())}"
+                "error": f"Symbol '{symbol}' not supported. Available: {', '.join(PRICE_FEEDS.keys())} (see /pyth/supported)"
             }), 400
-        
-        price_feed_id = PRICE_FEEDS[symbol_lower]
-        
-        # Llamar a Hermes API
-        hermes_url = f"{PYTH_HERMES_URL}/v2/updates/price/latest"
-        params = {"ids[]": price_feed_id}
-        
-        response = requests.get(hermes_url, params=params, timeout=10)
-        response.raise_for_status()
-        
-        data = response.json()
-        
-        if not data.get("parsed"):
+
+        # Obtener precio (caché en memoria o Hermes API)
+        prices = get_latest_prices([price_feed_id])
+
+        if price_feed_id not in prices:
             return jsonify({
                 "success": False,
                 "error": "No price data available"
             }), 404
-        
-        # Parsear datos del precio
-        price_feed = data["parsed"][0]
-        price_data = price_feed["price"]
-        
-        # Calcular precio real
-        price_raw = int(price_data["price"])
-        expo = int(price_data["expo"])
-        price = price_raw * (10 ** expo)
-        
-        # Calcular confianza
-        conf_raw = int(price_data["conf"])
-        confidence = conf_raw * (10 ** expo)
+
+        # Decodificar precio y confianza (enteros escalados exactos)
+        batch = decode_price_feeds([prices[price_feed_id]])
+        if price_feed_id not in batch:
+            raise ValueError(batch.invalid.get(_normalize_feed_id(price_feed_id), "Malformed price data"))
+
+        price = batch.price(price_feed_id)
+        confidence = batch.conf(price_feed_id)
         
         return jsonify({
             "success": True,
             "symbol": symbol.upper(),
             "price": float(price),
             "confidence": float(confidence),
-            "expo": expo,
-            "publish_time": price_data["publish_time"],
+            "expo": batch.expo(price_feed_id),
+            "publish_time": batch.publish_time(price_feed_id),
             "price_feed_id": price_feed_id,
             "message": f"Current {symbol.upper()} price: ${price:.2f} USD"
         })
@@ -1440,9 +5094,10 @@ def get_multiple_prices():
         
         for symbol in symbols:
             symbol = symbol.strip().lower()
-            if symbol in PRICE_FEEDS:
-                price_ids.append(PRICE_FEEDS[symbol])
-                symbol_map[PRICE_FEEDS[symbol]] = symbol
+            price_id = feed_catalog.get_id(symbol)
+            if price_id:
+                price_ids.append(price_id)
+                symbol_map[price_id] = symbol
         
         if not price_ids:
             return jsonify({
@@ -1450,87 +5105,526 @@ def get_multiple_prices():
                 "error": "No valid symbols provided"
             }), 400
         
-        # Llamar a Hermes API con múltiples IDs
-        hermes_url = f"{PYTH_HERMES_URL}/v2/updates/price/latest"
-        params = [("ids[]", price_id) for price_id in price_ids]
-        
-        response = requests.get(hermes_url, params=params, timeout=10)
-        response.raise_for_status()
-        
-        data = response.json()
-        
+        # Obtener precios (caché en memoria o Hermes API con múltiples IDs)
+        prices = get_latest_prices(price_ids)
+
         results = []
         errors = []
+
+        # Decodificar todo el lote de una vez
+        batch = decode_price_feeds(prices.values())
+
+        for feed_id in prices:
+            symbol = symbol_map.get(feed_id, "UNKNOWN")
+
+            if feed_id not in batch:
+                errors.append({
+                    "symbol": symbol.upper(),
+                    "error": batch.invalid.get(_normalize_feed_id(feed_id), "Malformed price data")
+                })
+                continue
+
+            price = batch.price(feed_id)
+            results.append({
+                "symbol": symbol.upper(),
+                "price": float(price),
+                "price_usd": f"${price:.2f}",
+                "publish_time": batch.publish_time(feed_id)
+            })
         
-        if data.get("parsed"):
-            for price_feed in data["parsed"]:
-                try:
-                    price_data = price_feed["price"]
-                    feed_id = price_feed["id"]
-                    
-                    # Calcular precio real
-                    price_raw = int(price_data["price"])
-                    expo = int(price_data["expo"])
-                    price = price_raw * (10 ** expo)
-                    
-                    symbol = symbol_map.get(feed_id, "UNKNOWN")
-                    
-                    results.append({
-                        "symbol": symbol.upper(),
-                        "price": float(price),
-                        "price_usd": f"${price:.2f}"
-                    })
+        return jsonify({
+            "success": True,
+            "count": len(results),
+            "prices": results,
+            "errors": errors if errors else None
+        })
+        
+    except requests.exceptions.RequestException as e:
+        return jsonify({
+            "success": False,
+            "error": f"Error fetching prices from Hermes API: {str(e)}"
+        }), 500
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+# Máximo de portfolios por petición de valoración en lote
+PYTH_PORTFOLIO_BATCH_MAX = int(os.getenv("PYTH_PORTFOLIO_BATCH_MAX", "10000"))
+
+
+@app.route("/pyth/portfolio/batch", methods=["POST"])
+def value_portfolios_batch():
+    """Valora muchos portfolios en una sola petición, sin pasar por la IA.
+
+    Body: {"portfolios": [{"id": "user-1", "holdings": {"eth": 2, "btc": 0.5}}, ...]}
+    (cada elemento también puede ser directamente el mapa de holdings). Se piden a
+    Hermes, en una sola llamada, los precios de la unión de símbolos de todo el lote.
+    """
+    try:
+        data = request.get_json() or {}
+        portfolios = data.get("portfolios")
+
+        if not isinstance(portfolios, list) or not portfolios:
+            return jsonify({
+                "success": False,
+                "error": "portfolios must be a non-empty list"
+            }), 400
+
+        if len(portfolios) > PYTH_PORTFOLIO_BATCH_MAX:
+            return jsonify({
+                "success": False,
+                "error": f"Maximum {PYTH_PORTFOLIO_BATCH_MAX} portfolios allowed"
+            }), 400
+
+        # Normalizar holdings y reunir la unión de feeds del lote
+        parsed = []
+        needed_ids = {}
+        for index, portfolio in enumerate(portfolios):
+            if isinstance(portfolio, dict) and isinstance(portfolio.get("holdings"), dict):
+                portfolio_id = portfolio.get("id", index)
+                holdings = portfolio["holdings"]
+            elif isinstance(portfolio, dict):
+                portfolio_id = index
+                holdings = portfolio
+            else:
+                return jsonify({
+                    "success": False,
+                    "error": f"Portfolio at index {index} must be an object"
+                }), 400
+
+            holdings_by_feed = {}
+            unsupported = []
+            for symbol, amount in holdings.items():
+                price_id = feed_catalog.get_id(str(symbol))
+                if not price_id:
+                    unsupported.append(str(symbol).upper())
+                    continue
+                if isinstance(amount, bool) or not isinstance(amount, (int, float)) or amount < 0:
+                    return jsonify({
+                        "success": False,
+                        "error": f"Invalid amount for {str(symbol).upper()} in portfolio {portfolio_id}"
+                    }), 400
+                holdings_by_feed[price_id] = holdings_by_feed.get(price_id, 0) + amount
+                needed_ids[price_id] = True
+
+            parsed.append((portfolio_id, holdings_by_feed, unsupported))
+
+        # Una sola consulta de precios (caché o Hermes) para todo el lote
+        prices = get_latest_prices(list(needed_ids)) if needed_ids else {}
+        batch = decode_price_feeds(prices.values())
+        valuations = batch.value_portfolios([holdings_by_feed for _, holdings_by_feed, _ in parsed])
+
+        results = []
+        grand_total = Decimal(0)
+        for (portfolio_id, holdings_by_feed, unsupported), (exact_total, values) in zip(parsed, valuations):
+            grand_total += exact_total
+            total = float(exact_total)
+
+            items = []
+            amounts = {_normalize_feed_id(price_id): amount for price_id, amount in holdings_by_feed.items()}
+            for feed_key, value in values.items():
+                value = float(value)
+                items.append({
+                    "symbol": feed_catalog.get_symbol(feed_key).upper(),
+                    "amount": amounts[feed_key],
+                    "price": float(batch.price(feed_key)),
+                    "value_usd": value,
+                    "percentage": (value / total * 100) if total > 0 else 0
+                })
+            items.sort(key=lambda x: x["value_usd"], reverse=True)
+
+            # Feeds soportados pero sin precio disponible en Hermes
+            missing = [feed_catalog.get_symbol(feed_key).upper() for feed_key in amounts if feed_key not in values]
+
+            results.append({
+                "id": portfolio_id,
+                "total_value_usd": total,
+                "holdings_count": len(items),
+                "items": items,
+                "unsupported": unsupported or None,
+                "missing_prices": missing or None
+            })
+
+        return jsonify({
+            "success": True,
+            "count": len(results),
+            "total_value_usd": float(grand_total),
+            "prices_publish_time": {
+                feed_catalog.get_symbol(feed_key).upper(): batch.publish_time(feed_key)
+                for feed_key in batch.feed_keys if feed_catalog.get_symbol(feed_key)
+            },
+            "portfolios": results
+        })
+
+    except requests.exceptions.RequestException as e:
+        return jsonify({
+            "success": False,
+            "error": f"Error fetching prices from Hermes API: {str(e)}"
+        }), 500
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route("/pyth/alerts", methods=["POST"])
+def create_price_alert():
+    """Registra una alerta de precio.
+
+    Body: {"symbol": "eth", "condition": "below" | "above", "price": 2500,
+    "webhook_url": "https://..." (opcional), "wallet": "0x..." (opcional)}
+    """
+    try:
+        data = request.get_json() or {}
+        symbol = str(data.get("symbol", "")).strip().lower()
+        condition = str(data.get("condition", "")).strip().lower()
+        threshold = data.get("price")
+        webhook_url = data.get("webhook_url")
+        wallet = data.get("wallet")
+
+        price_feed_id = feed_catalog.get_id(symbol) if symbol else None
+        if not price_feed_id:
+            return jsonify({
+                "success": False,
+                "error": f"Symbol '{symbol}' not supported (see /pyth/supported)"
+            }), 400
+
+        if condition not in ("below", "above"):
+            return jsonify({
+                "success": False,
+                "error": "condition must be 'below' or 'above'"
+            }), 400
+
+        if isinstance(threshold, bool) or not isinstance(threshold, (int, float)) or threshold <= 0:
+            return jsonify({
+                "success": False,
+                "error": "price must be a number greater than 0"
+            }), 400
+
+        if webhook_url and not str(webhook_url).startswith(("http://", "https://")):
+            return jsonify({
+                "success": False,
+                "error": "webhook_url must be an http(s) URL"
+            }), 400
+
+        if wallet:
+            if not Web3.is_address(wallet):
+                return jsonify({
+                    "success": False,
+                    "error": "Invalid wallet address"
+                }), 400
+            wallet = Web3.to_checksum_address(wallet)
+
+        alert = price_alerts.create(symbol, price_feed_id, condition, threshold, webhook_url, wallet)
+
+        return jsonify({
+            "success": True,
+            "message": f"Alert created: notify when {symbol.upper()} is {condition} ${threshold}",
+            "alert": alert
+        }), 201
+
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route("/pyth/alerts", methods=["GET"])
+def list_price_alerts():
+    """Lista alertas filtrando opcionalmente por wallet, symbol y status."""
+    try:
+        limit = min(max(int(request.args.get("limit", 100)), 1), 1000)
+        alerts = price_alerts.list_alerts(
+            wallet=request.args.get("wallet"),
+            symbol=request.args.get("symbol"),
+            status=request.args.get("status"),
+            limit=limit
+        )
+        return jsonify({
+            "success": True,
+            "count": len(alerts),
+            "alerts": alerts,
+            "engine": price_alerts.stats()
+        })
+    except ValueError:
+        return jsonify({
+            "success": False,
+            "error": "limit must be an integer"
+        }), 400
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route("/pyth/alerts/<alert_id>", methods=["GET"])
+def get_price_alert(alert_id):
+    """Obtiene una alerta por su ID."""
+    alert = price_alerts.get(alert_id)
+    if not alert:
+        return jsonify({
+            "success": False,
+            "error": "Alert not found"
+        }), 404
+    return jsonify({
+        "success": True,
+        "alert": alert
+    })
+
+
+@app.route("/pyth/alerts/<alert_id>", methods=["DELETE"])
+def cancel_price_alert(alert_id):
+    """Cancela una alerta activa."""
+    alert = price_alerts.cancel(alert_id)
+    if not alert:
+        return jsonify({
+            "success": False,
+            "error": "Alert not found"
+        }), 404
+    return jsonify({
+        "success": True,
+        "message": "Alert cancelled" if alert["status"] == "cancelled" else f"Alert already {alert['status']}",
+        "alert": alert
+    })
+
+
+@app.route("/pyth/history/<symbol>", methods=["GET"])
+def get_pyth_history(symbol):
+    """Historial de precios observados por el proceso y estadísticas móviles.
+
+    Query params opcionales: window (últimas N muestras) y samples=false para
+    devolver solo las estadísticas.
+    """
+    price_feed_id = feed_catalog.get_id(symbol)
+    if not price_feed_id:
+        return jsonify({
+            "success": False,
+            "error": f"Symbol '{symbol}' not supported (see /pyth/supported)"
+        }), 400
+
+    try:
+        window = int(request.args["window"]) if "window" in request.args else None
+    except ValueError:
+        return jsonify({
+            "success": False,
+            "error": "window must be an integer"
+        }), 400
+    if window is not None and window < 1:
+        return jsonify({
+            "success": False,
+            "error": "window must be greater than 0"
+        }), 400
+
+    history = get_price_history(price_feed_id)
+    stats = history.stats(window) if history else None
+    if not stats:
+        return jsonify({
+            "success": False,
+            "error": "No price history available yet"
+        }), 404
+
+    stats["volatility"] = None
+    if stats["returns"] >= PYTH_HISTORY_MIN_SAMPLES and stats["return_stddev_pct"] is not None:
+        stats["volatility"] = volatility_label(stats["return_stddev_pct"], REALIZED_VOLATILITY_THRESHOLDS)
+
+    result = {
+        "success": True,
+        "symbol": symbol.upper(),
+        "price_feed_id": price_feed_id,
+        "capacity": history.capacity,
+        "window": stats["samples"],
+        "stats": stats
+    }
+    if request.args.get("samples", "true").lower() != "false":
+        result["samples"] = [
+            {"publish_time": int(publish_time), "price": price}
+            for publish_time, price in history.samples(window)
+        ]
+
+    return jsonify(result)
+
+
+@app.route("/pyth/stream", methods=["GET"])
+def stream_pyth_prices():
+    """Stream SSE de precios: el cliente se suscribe a ?symbols=eth,btc y recibe cada actualización.
+
+    Todos los clientes comparten una única fuente upstream por proceso. Si un
+    cliente es lento solo recibe el último precio de cada símbolo. Cada conexión
+    ocupa un hilo del worker mientras está abierta.
+    """
+    symbols = [s.strip().lower() for s in request.args.get("symbols", "eth,btc").split(",") if s.strip()]
+
+    if len(symbols) > PYTH_SSE_MAX_SYMBOLS:
+        return jsonify({
+            "success": False,
+            "error": f"Maximum {PYTH_SSE_MAX_SYMBOLS} symbols allowed"
+        }), 400
+
+    price_ids = [feed_catalog.get_id(symbol) for symbol in symbols if symbol in feed_catalog]
+    if not price_ids:
+        return jsonify({
+            "success": False,
+            "error": "No valid symbols provided"
+        }), 400
+
+    if price_broadcaster.is_full():
+        return jsonify({
+            "success": False,
+            "error": "Too many stream clients, try again later"
+        }), 503
+
+    def generate():
+        # La suscripción se toma al empezar a iterar: una respuesta que nunca se
+        # consume (cliente que corta antes) no deja su plaza ocupada
+        subscriber = price_broadcaster.subscribe(_normalize_feed_id(price_id) for price_id in price_ids)
+        if subscriber is None:
+            yield f"event: error\ndata: {json.dumps({'error': 'Too many stream clients, try again later'})}\n\n"
+            return
+
+        try:
+            # Precios actuales para que el cliente no espere a la siguiente actualización
+            try:
+                batch = decode_price_feeds(get_latest_prices(price_ids).values())
+                for feed_key in batch.feed_keys:
+                    subscriber.offer(feed_key, batch.publish_time(feed_key), sse_price_message(batch, feed_key))
+            except Exception as e:
+                yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+            while True:
+                messages = subscriber.drain(PYTH_SSE_HEARTBEAT)
+                if not messages:
+                    yield ": keep-alive\n\n"
+                    continue
+                for message in messages:
+                    yield f"event: price\ndata: {message}\n\n"
+        finally:
+            price_broadcaster.unsubscribe(subscriber)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# ======================================
+# 🔀 Pasos concurrentes y diferidos de /pyth/chat
+# ======================================
+
+# Hilos para los pasos de las acciones de /pyth/chat (Hermes, consejo y resumen de la IA)
+PYTH_CHAT_WORKERS = int(os.getenv("PYTH_CHAT_WORKERS", max(16, WORKER_CONCURRENCY)))
+# Segundos que se conserva un resultado diferido para consultarlo
+PYTH_CHAT_FOLLOWUP_TTL = float(os.getenv("PYTH_CHAT_FOLLOWUP_TTL", "300"))
+PYTH_CHAT_FOLLOWUP_MAX = int(os.getenv("PYTH_CHAT_FOLLOWUP_MAX", "10000"))
+
+pyth_chat_executor = ThreadPoolExecutor(max_workers=PYTH_CHAT_WORKERS, thread_name_prefix="pyth-chat")
+
+
+class StepGraph:
+    """Ejecutor mínimo de pasos con dependencias sobre un ThreadPoolExecutor.
+
+    Cada paso recibe un dict con los resultados de sus dependencias y arranca en
+    cuanto estas terminan; los pasos independientes corren en paralelo. run()
+    devuelve un Future por paso, así quien llama espera solo lo que necesita
+    para responder y el resto (p. ej. el consejo de la IA) sigue en segundo plano.
+    Si una dependencia falla, los pasos que dependen de ella fallan con el mismo error.
+    """
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._steps = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, fn, deps=()):
+        self._steps[name] = (fn, tuple(deps))
+        return self
+
+    def run(self):
+        futures = {name: Future() for name in self._steps}
+        waiting = {name: set(deps) for name, (_, deps) in self._steps.items()}
+
+        def start(name):
+            fn, deps = self._steps[name]
+
+            def task():
+                try:
+                    futures[name].set_result(fn({dep: futures[dep].result() for dep in deps}))
                 except Exception as e:
-                    errors.append({
-                        "symbol": symbol_map.get(feed_id, "UNKNOWN").upper(),
-                        "error": str(e)
-                    })
-        
-        return jsonify({
-            "success": True,
-            "count": len(results),
-            "prices": results,
-            "errors": errors if errors else None
-        })
-        
-    except requests.exceptions.RequestException as e:
-        return jsonify({
-            "success": False,
-            "error": f"Error fetching prices from Hermes API: {str(e)}"
-        }), 500
-    except Exception as e:
-        return jsonify({
-            "success": False,
-            "error": str(e)
-        }), 500
+                    futures[name].set_exception(e)
 
+            self._executor.submit(task)
+
+        def on_done(finished):
+            with self._lock:
+                ready = []
+                for name, deps in waiting.items():
+                    if finished in deps:
+                        deps.discard(finished)
+                        if not deps:
+                            ready.append(name)
+            for name in ready:
+                start(name)
+
+        for name, future in futures.items():
+            future.add_done_callback(lambda _, name=name: on_done(name))
+        for name in [name for name, deps in waiting.items() if not deps]:
+            start(name)
+        return futures
+
+
+class DeferredResults:
+    """Resultados diferidos de /pyth/chat (consejo o resumen de la IA) pendientes de consulta."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, field, future):
+        """Registra un Future y devuelve el objeto `followup` que se incluye en la respuesta."""
+        followup_id = uuid.uuid4().hex
+        now = time.monotonic()
+        with self._lock:
+            self._entries[followup_id] = (now, field, future)
+            while self._entries:
+                oldest_id, (created, _, _) = next(iter(self._entries.items()))
+                if now - created <= self.ttl and len(self._entries) <= self.max_entries:
+                    break
+                del self._entries[oldest_id]
+        return {"id": followup_id, "field": field, "status": "pending", "url": f"/pyth/chat/followup/{followup_id}"}
+
+    def body(self, followup_id, timeout=0):
+        """Estado del resultado como JSON de respuesta (espera hasta `timeout` segundos); None si no existe."""
+        with self._lock:
+            entry = self._entries.get(followup_id)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+
+        _, field, future = entry
+        try:
+            value = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            return {"success": True, "id": followup_id, "status": "pending"}
+        except Exception as e:
+            return {"success": False, "id": followup_id, "status": "error", "error": str(e)}
+        return {"success": True, "id": followup_id, "status": "done", field: value}
+
+
+deferred_results = DeferredResults(PYTH_CHAT_FOLLOWUP_TTL, PYTH_CHAT_FOLLOWUP_MAX)
 
-@app.route("/pyth/chat", methods=["POST"])
-def pyth_chat_ai():
-    """Chat con IA para consultar precios usando Pyth Network (en inglés)."""
-    try:
-        data = request.get_json()
-        user_message = data.get("message", "")
-        
-        if not user_message:
-            return jsonify({
-                "success": False,
-                "error": "Message is required"
-            }), 400
-        
-        if not DEEPSEEK_API_KEY:
-            return jsonify({
-                "success": False,
-                "error": "AI API key not configured"
-            }), 500
-        
-        # Obtener precios actuales para contexto
-        available_symbols = list(PRICE_FEEDS.keys())
-        
-        # Prompt mejorado para la IA (en inglés con consejos de transferencia)
-        system_prompt = f"""You are an expert cryptocurrency advisor and price assistant. You help users get real-time cryptocurrency prices using Pyth Network and provide smart advice for making transfers and transactions.
 
-Available cryptocurrencies: {', '.join([s.upper() for s in available_symbols])}
+# Prompt de sistema de /pyth/chat (en inglés con consejos de transferencia), compilado una vez.
+# Los símbolos son los del snapshot incluido, así el prefijo es idéntico en todas las peticiones.
+PYTH_INTENT_SYSTEM_PROMPT = f"""You are an expert cryptocurrency advisor and price assistant. You help users get real-time cryptocurrency prices using Pyth Network and provide smart advice for making transfers and transactions.
+
+Available cryptocurrencies: {', '.join([s.upper() for s in PRICE_FEEDS])}
 
 Your capabilities:
 1. Get real-time cryptocurrency prices
@@ -1574,303 +5668,353 @@ Examples:
 
 Always respond in English and with valid JSON only."""
 
-        # Llamar a DeepSeek
-        headers = {
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": "deepseek-chat",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
-            "temperature": 0.3,
-            "max_tokens": 500
-        }
-        
-        response = requests.post(DEEPSEEK_URL, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        
-        ai_response = response.json()
-        ai_message = ai_response["choices"][0]["message"]["content"].strip()
-        
-        # Parsear respuesta JSON de la IA
-        try:
-            ai_json = json.loads(ai_message)
-        except:
-            ai_json = {"action": "none", "message": ai_message}
-        
-        # Procesar acciones
-        action = ai_json.get("action", "none")
-        
-        if action == "get_price":
-            symbol = ai_json.get("symbol", "").lower()
-            if symbol in PRICE_FEEDS:
-                try:
-                    price_feed_id = PRICE_FEEDS[symbol]
-                    
-                    # Llamar a Hermes API
-                    hermes_url = f"{PYTH_HERMES_URL}/v2/updates/price/latest"
-                    params = {"ids[]": price_feed_id}
+TRANSFER_ADVICE_SYSTEM_PROMPT = "You are a cryptocurrency advisor. Provide brief, practical advice."
+PORTFOLIO_SUMMARY_SYSTEM_PROMPT = "You are a crypto portfolio advisor. Provide brief, actionable insights."
+
+prompt_usage.register("pyth_intent", PYTH_INTENT_SYSTEM_PROMPT)
+prompt_usage.register("transfer_advice", TRANSFER_ADVICE_SYSTEM_PROMPT)
+prompt_usage.register("portfolio_summary", PORTFOLIO_SUMMARY_SYSTEM_PROMPT)
+
+
+def build_pyth_intent_payload(user_message):
+    """Body de la petición a DeepSeek para extraer la intención de un mensaje de /pyth/chat."""
+    return {
+        "model": "deepseek-chat",
+        "messages": [
+            {"role": "system", "content": PYTH_INTENT_SYSTEM_PROMPT},
+            {"role": "user", "content": user_message}
+        ],
+        "temperature": 0.3,
+        "max_tokens": 500
+    }
+
+
+def parse_pyth_intent_reply(user_message, ai_message):
+    """Parsea el JSON de intención devuelto por DeepSeek para /pyth/chat."""
+    ai_message = ai_message.strip()
+
+    # Parsear respuesta JSON de la IA
+    try:
+        ai_json = json.loads(ai_message)
+        llm_intent_cache.put("pyth", user_message, "", ai_json)
+        parsed = True
+    except:
+        ai_json = {"action": "none", "message": ai_message}
+        parsed = False
+
+    llm_metrics.record_parse("pyth_intent", ai_json.get("action") if isinstance(ai_json, dict) else None, parsed)
+    return ai_json
+
+
+_HOLDING_TOKEN = re.compile(r"(\d+(?:[.,]\d+)?)\s*([A-Za-z][A-Za-z0-9]{1,9})\b")
+_SYMBOL_TOKEN = re.compile(r"\b[A-Za-z][A-Za-z0-9]{1,9}\b")
+
+
+def _keyword_symbol(token):
+    """Símbolo soportado si el token es uno de los habituales o está en mayúsculas (evita palabras como 'near' o 'one')."""
+    symbol = token.lower()
+    if symbol in PRICE_FEEDS or (token.isupper() and symbol in feed_catalog):
+        return symbol
+    return None
+
+
+def keyword_pyth_intent(user_message):
+    """Intención de /pyth/chat por palabras clave, para el modo degradado sin IA."""
+    text = user_message.lower()
+    note = "AI assistant temporarily unavailable; your message was interpreted without AI."
+
+    holdings = {}
+    for amount, token in _HOLDING_TOKEN.findall(user_message):
+        symbol = _keyword_symbol(token)
+        if symbol:
+            holdings[symbol] = float(amount.replace(",", "."))
+
+    symbols = []
+    for token in _SYMBOL_TOKEN.findall(user_message):
+        symbol = _keyword_symbol(token)
+        if symbol and symbol not in symbols:
+            symbols.append(symbol)
+
+    if len(holdings) > 1 or (holdings and any(word in text for word in ("portfolio", "worth", "value", "total"))):
+        intent = {"action": "calculate_portfolio", "holdings": holdings, "message": note}
+    elif symbols and any(word in text for word in ("transfer", "send", "should i", "good time", "move")):
+        intent = {"action": "transfer_advice", "symbol": symbols[0], "amount": holdings.get(symbols[0], 0), "message": note}
+    elif len(symbols) > 1:
+        intent = {"action": "get_multiple_prices", "symbols": symbols, "message": note}
+    elif symbols:
+        intent = {"action": "get_price", "symbol": symbols[0], "message": note}
+    else:
+        intent = {"action": "advice", "message": "The AI assistant is temporarily unavailable. Try a price (\"ETH price\") or a portfolio (\"2 ETH and 0.5 BTC\")."}
+
+    intent["degraded"] = True
+    return intent
+
+
+def execute_pyth_action(ai_json, headers, defer=False):
+    """Ejecuta la acción de precios de una intención de /pyth/chat y devuelve el JSON de respuesta.
+
+    Con defer=True el consejo o resumen de la IA no se espera: la respuesta sale
+    en cuanto hay precios y lleva un `followup` para consultarlo después.
+    """
+    action = ai_json.get("action", "none")
+    
+    if action == "get_price":
+        symbol = ai_json.get("symbol", "").lower()
+        if symbol in feed_catalog:
+            try:
+                price_feed_id = feed_catalog.get_id(symbol)
+
+                # Obtener precio (caché en memoria o Hermes API)
+                prices = get_latest_prices([price_feed_id])
+
+                batch = decode_price_feeds(prices.values())
+
+                if price_feed_id in batch:
+                    price_feed = prices[price_feed_id]
+                    price = batch.price(price_feed_id)
+                    expo = batch.expo(price_feed_id)
+                    publish_time = batch.publish_time(price_feed_id)
+
+                    # Calcular confianza
+                    confidence = batch.conf(price_feed_id)
+                    confidence_pct = (confidence / price * 100) if price > 0 else 0
                     
-                    price_response = requests.get(hermes_url, params=params, timeout=10)
-                    price_response.raise_for_status()
+                    # Determinar volatilidad (historial de precios o intervalo de confianza)
+                    volatility, volatility_source = classify_volatility(price_feed_id, confidence_pct)
                     
-                    price_json = price_response.json()
+                    # Timestamp legible
+                    from datetime import datetime
+                    publish_timestamp = datetime.fromtimestamp(publish_time).strftime("%Y-%m-%d %H:%M:%S UTC")
                     
-                    if price_json.get("parsed"):
-                        price_feed = price_json["parsed"][0]
-                        price_data = price_feed["price"]
-                        
-                        price_raw = int(price_data["price"])
-                        expo = int(price_data["expo"])
-                        price = price_raw * (10 ** expo)
+                    ai_json["price_data"] = {
+                        "symbol": symbol.upper(),
+                        "price": float(price),
+                        "price_usd": f"${price:.2f}",
+                        "confidence": float(confidence),
+                        "confidence_usd": f"±${confidence:.4f}",
+                        "confidence_percentage": f"{confidence_pct:.3f}%",
+                        "volatility": volatility,
+                        "volatility_source": volatility_source,
+                        "publish_time": publish_time,
+                        "publish_timestamp": publish_timestamp,
+                        "expo": expo,
+                        "price_feed_id": price_feed["id"],
+                        "source": "Pyth Network (Hermes API)"
+                    }
+                    ai_json["message"] = f"The current price of {symbol.upper()} is ${price:.2f} USD (±${confidence:.4f}, {volatility} volatility)"
+            except Exception as e:
+                ai_json["error"] = f"Error fetching price: {str(e)}"
+    
+    elif action == "get_multiple_prices":
+        symbols = ai_json.get("symbols", [])
+        prices_result = []
+        
+        # Construir lista de IDs
+        price_ids = [feed_catalog.get_id(s) for s in symbols if s in feed_catalog]
+        
+        if price_ids:
+            try:
+                prices = get_latest_prices(price_ids)
+
+                # Decodificar todo el lote de una vez
+                batch = decode_price_feeds(prices.values())
+
+                if prices:
+                    for feed_id in prices:
+                        if feed_id not in batch:
+                            continue
+
+                        price = batch.price(feed_id)
                         
                         # Calcular confianza
-                        conf_raw = int(price_data["conf"])
-                        confidence = conf_raw * (10 ** expo)
+                        confidence = batch.conf(feed_id)
                         confidence_pct = (confidence / price * 100) if price > 0 else 0
                         
-                        # Determinar volatilidad
-                        if confidence_pct < 0.1:
-                            volatility = "Very Low"
-                        elif confidence_pct < 0.5:
-                            volatility = "Low"
-                        elif confidence_pct < 1.0:
-                            volatility = "Moderate"
-                        elif confidence_pct < 2.0:
-                            volatility = "High"
-                        else:
-                            volatility = "Very High"
+                        # Volatilidad (historial de precios o intervalo de confianza)
+                        volatility, volatility_source = classify_volatility(feed_id, confidence_pct)
                         
-                        # Timestamp legible
-                        from datetime import datetime
-                        publish_timestamp = datetime.fromtimestamp(price_data["publish_time"]).strftime("%Y-%m-%d %H:%M:%S UTC")
+                        # Encontrar símbolo por feed_id
+                        symbol = feed_catalog.get_symbol(feed_id) or "UNKNOWN"
                         
-                        ai_json["price_data"] = {
+                        prices_result.append({
                             "symbol": symbol.upper(),
                             "price": float(price),
                             "price_usd": f"${price:.2f}",
                             "confidence": float(confidence),
                             "confidence_usd": f"±${confidence:.4f}",
-                            "confidence_percentage": f"{confidence_pct:.3f}%",
                             "volatility": volatility,
-                            "publish_time": price_data["publish_time"],
-                            "publish_timestamp": publish_timestamp,
-                            "expo": expo,
-                            "price_feed_id": price_feed["id"],
-                            "source": "Pyth Network (Hermes API)"
-                        }
-                        ai_json["message"] = f"The current price of {symbol.upper()} is ${price:.2f} USD (±${confidence:.4f}, {volatility} volatility)"
-                except Exception as e:
-                    ai_json["error"] = f"Error fetching price: {str(e)}"
-        
-        elif action == "get_multiple_prices":
-            symbols = ai_json.get("symbols", [])
-            prices_result = []
-            
-            # Construir lista de IDs
-            price_ids = [PRICE_FEEDS[s.lower()] for s in symbols if s.lower() in PRICE_FEEDS]
-            
-            if price_ids:
-                try:
-                    hermes_url = f"{PYTH_HERMES_URL}/v2/updates/price/latest"
-                    params = [("ids[]", price_id) for price_id in price_ids]
-                    
-                    price_response = requests.get(hermes_url, params=params, timeout=10)
-                    price_response.raise_for_status()
-                    
-                    price_json = price_response.json()
-                    
-                    if price_json.get("parsed"):
-                        for price_feed in price_json["parsed"]:
-                            price_data = price_feed["price"]
-                            feed_id = price_feed["id"]
-                            
-                            price_raw = int(price_data["price"])
-                            expo = int(price_data["expo"])
-                            price = price_raw * (10 ** expo)
-                            
-                            # Calcular confianza
-                            conf_raw = int(price_data["conf"])
-                            confidence = conf_raw * (10 ** expo)
-                            confidence_pct = (confidence / price * 100) if price > 0 else 0
-                            
-                            # Volatilidad
-                            if confidence_pct < 0.5:
-                                volatility = "Low"
-                            elif confidence_pct < 1.0:
-                                volatility = "Moderate"
-                            else:
-                                volatility = "High"
-                            
-                            # Encontrar símbolo por feed_id
-                            symbol = next((k for k, v in PRICE_FEEDS.items() if v == feed_id), "UNKNOWN")
-                            
-                            prices_result.append({
-                                "symbol": symbol.upper(),
-                                "price": float(price),
-                                "price_usd": f"${price:.2f}",
-                                "confidence": float(confidence),
-                                "confidence_usd": f"±${confidence:.4f}",
-                                "volatility": volatility,
-                                "publish_time": price_data["publish_time"]
-                            })
-                except Exception as e:
-                    ai_json["error"] = f"Error fetching prices: {str(e)}"
-            
-            ai_json["prices"] = prices_result
-            if prices_result:
-                price_list = ", ".join([f"{p['symbol']}: {p['price_usd']}" for p in prices_result])
-                ai_json["message"] = f"Current prices - {price_list}"
-        
-        elif action == "transfer_advice":
-            symbol = ai_json.get("symbol", "").lower()
-            amount = ai_json.get("amount", 0)
-            
-            if symbol in PRICE_FEEDS:
-                try:
-                    price_feed_id = PRICE_FEEDS[symbol]
-                    
-                    # Obtener precio actual
-                    hermes_url = f"{PYTH_HERMES_URL}/v2/updates/price/latest"
-                    params = {"ids[]": price_feed_id}
-                    
-                    price_response = requests.get(hermes_url, params=params, timeout=10)
-                    price_response.raise_for_status()
-                    
-                    price_json = price_response.json()
-                    
-                    if price_json.get("parsed"):
-                        price_feed = price_json["parsed"][0]
-                        price_data = price_feed["price"]
-                        
-                        price_raw = int(price_data["price"])
-                        expo = int(price_data["expo"])
-                        price = price_raw * (10 ** expo)
-                        conf_raw = int(price_data["conf"])
-                        confidence = conf_raw * (10 ** expo)
-                        
-                        # Calcular valor de la transferencia
-                        transfer_value_usd = price * amount if amount > 0 else 0
-                        
-                        # Generar consejo con IA
-                        advice_prompt = f"""Based on the current {symbol.upper()} price of ${price:.2f} USD with a confidence interval of ±${confidence:.2f}, provide brief advice (2-3 sentences) about:
+                            "volatility_source": volatility_source,
+                            "publish_time": batch.publish_time(feed_id)
+                        })
+            except Exception as e:
+                ai_json["error"] = f"Error fetching prices: {str(e)}"
+        
+        ai_json["prices"] = prices_result
+        if prices_result:
+            price_list = ", ".join([f"{p['symbol']}: {p['price_usd']}" for p in prices_result])
+            ai_json["message"] = f"Current prices - {price_list}"
+    
+    elif action == "transfer_advice":
+        symbol = ai_json.get("symbol", "").lower()
+        amount = ai_json.get("amount", 0)
+        
+        if symbol in feed_catalog:
+            try:
+                price_feed_id = feed_catalog.get_id(symbol)
+
+                def fetch_market(_):
+                    # Obtener precio actual (caché en memoria o Hermes API)
+                    batch = decode_price_feeds(get_latest_prices([price_feed_id]).values())
+                    if price_feed_id not in batch:
+                        return None
+
+                    price = batch.price(price_feed_id)
+                    confidence = batch.conf(price_feed_id)
+
+                    # Volatilidad y variación reciente desde el historial (sin llamadas extra a Hermes)
+                    confidence_pct = (confidence / price * 100) if price > 0 else 0
+                    volatility, volatility_source = classify_volatility(price_feed_id, confidence_pct)
+                    history = get_price_history(price_feed_id)
+                    history_stats = history.stats() if history else None
+                    recent_change = f", {history_stats['change_pct']:+.3f}% over the last {history_stats['samples']} observed prices" if history_stats and history_stats["samples"] > 1 else ""
+                    return {
+                        "price": price,
+                        "confidence": confidence,
+                        "volatility": volatility,
+                        "volatility_source": volatility_source,
+                        "recent_change": recent_change
+                    }
+
+                def generate_advice(inputs):
+                    market = inputs["market"]
+                    if market is None:
+                        return None
+                    price, confidence = market["price"], market["confidence"]
+
+                    # Generar consejo con IA
+                    advice_prompt = f"""Based on the current {symbol.upper()} price of ${price:.2f} USD with a confidence interval of ±${confidence:.2f} ({market['volatility']} volatility{market['recent_change']}), provide brief advice (2-3 sentences) about:
 1. Whether it's a good time to transfer {amount if amount > 0 else 'some'} {symbol.upper()}
 2. Any considerations about transaction fees (gas fees on Scroll Sepolia are typically low, ~$0.01-0.10)
 3. Market volatility considerations
 
 Keep advice practical and concise."""
 
-                        advice_payload = {
-                            "model": "deepseek-chat",
-                            "messages": [
-                                {"role": "system", "content": "You are a cryptocurrency advisor. Provide brief, practical advice."},
-                                {"role": "user", "content": advice_prompt}
-                            ],
-                            "temperature": 0.7,
-                            "max_tokens": 200
-                        }
-                        
-                        advice_response = requests.post(DEEPSEEK_URL, headers=headers, json=advice_payload, timeout=30)
-                        advice_response.raise_for_status()
-                        advice_result = advice_response.json()
-                        advice_text = advice_result["choices"][0]["message"]["content"].strip()
-                        
-                        ai_json["price_data"] = {
-                            "symbol": symbol.upper(),
-                            "price": float(price),
-                            "price_usd": f"${price:.2f}",
-                            "confidence": float(confidence),
-                            "confidence_usd": f"±${confidence:.2f}",
-                            "source": "Pyth Network (Hermes API)"
-                        }
-                        
-                        ai_json["transfer_info"] = {
-                            "amount": amount,
-                            "estimated_value_usd": f"${transfer_value_usd:.2f}" if amount > 0 else "N/A",
-                            "estimated_gas_fee": "$0.01 - $0.10 (Scroll Sepolia)",
-                            "network": "Scroll Sepolia Testnet"
-                        }
-                        
-                        ai_json["advice"] = advice_text
-                        ai_json["message"] = f"Current {symbol.upper()} price: ${price:.2f} USD. Analysis complete."
-                        
-                except Exception as e:
-                    ai_json["error"] = f"Error generating transfer advice: {str(e)}"
-        
-        elif action == "calculate_portfolio":
-            holdings = ai_json.get("holdings", {})
-            
-            if not holdings:
-                ai_json["error"] = "No holdings provided for portfolio calculation"
-            else:
-                try:
-                    # Obtener símbolos válidos
-                    valid_holdings = {k.lower(): v for k, v in holdings.items() if k.lower() in PRICE_FEEDS}
+                    advice_payload = {
+                        "model": "deepseek-chat",
+                        "messages": [
+                            {"role": "system", "content": TRANSFER_ADVICE_SYSTEM_PROMPT},
+                            {"role": "user", "content": advice_prompt}
+                        ],
+                        "temperature": 0.7,
+                        "max_tokens": 200
+                    }
                     
-                    if not valid_holdings:
-                        ai_json["error"] = "No valid cryptocurrencies found in portfolio"
-                    else:
+                    try:
+                        advice_response = post_deepseek(advice_payload, headers, endpoint="/pyth/chat")
+                    except CircuitOpenError:
+                        return "AI advice is temporarily unavailable. Review the current price and volatility above before transferring."
+                    advice_result = advice_response.json()
+                    return advice_result["choices"][0]["message"]["content"].strip()
+
+                steps = StepGraph(pyth_chat_executor).add("market", fetch_market).add("advice", generate_advice, deps=["market"]).run()
+                market = steps["market"].result()
+
+                if market is not None:
+                    price, confidence = market["price"], market["confidence"]
+
+                    # Calcular valor de la transferencia
+                    transfer_value_usd = price * Decimal(str(amount)) if amount > 0 else 0
+
+                    # Sin diferir se espera el consejo; si falla, falla toda la acción como antes
+                    advice_text = None if defer else steps["advice"].result()
+                    
+                    ai_json["price_data"] = {
+                        "symbol": symbol.upper(),
+                        "price": float(price),
+                        "price_usd": f"${price:.2f}",
+                        "confidence": float(confidence),
+                        "confidence_usd": f"±${confidence:.2f}",
+                        "volatility": market["volatility"],
+                        "volatility_source": market["volatility_source"],
+                        "source": "Pyth Network (Hermes API)"
+                    }
+                    
+                    ai_json["transfer_info"] = {
+                        "amount": amount,
+                        "estimated_value_usd": f"${transfer_value_usd:.2f}" if amount > 0 else "N/A",
+                        "estimated_gas_fee": "$0.01 - $0.10 (Scroll Sepolia)",
+                        "network": "Scroll Sepolia Testnet"
+                    }
+                    
+                    ai_json["advice"] = advice_text
+                    if defer:
+                        ai_json["followup"] = deferred_results.add("advice", steps["advice"])
+                    ai_json["message"] = f"Current {symbol.upper()} price: ${price:.2f} USD. Analysis complete."
+                    
+            except Exception as e:
+                ai_json["error"] = f"Error generating transfer advice: {str(e)}"
+    
+    elif action == "calculate_portfolio":
+        holdings = ai_json.get("holdings", {})
+        
+        if not holdings:
+            ai_json["error"] = "No holdings provided for portfolio calculation"
+        else:
+            try:
+                # Obtener símbolos válidos
+                valid_holdings = {k.lower(): v for k, v in holdings.items() if k in feed_catalog}
+                
+                if not valid_holdings:
+                    ai_json["error"] = "No valid cryptocurrencies found in portfolio"
+                else:
+                    def value_holdings(_):
                         # Construir lista de IDs para Hermes
-                        price_ids = [PRICE_FEEDS[symbol] for symbol in valid_holdings.keys()]
-                        
-                        # Obtener precios de todas las criptos del portfolio
-                        hermes_url = f"{PYTH_HERMES_URL}/v2/updates/price/latest"
-                        params = [("ids[]", price_id) for price_id in price_ids]
+                        price_ids = [feed_catalog.get_id(symbol) for symbol in valid_holdings.keys()]
                         
-                        price_response = requests.get(hermes_url, params=params, timeout=10)
-                        price_response.raise_for_status()
-                        
-                        price_json = price_response.json()
+                        # Obtener precios de todas las criptos del portfolio (caché o Hermes API)
+                        prices = get_latest_prices(price_ids)
+                        if len(prices) == 0:
+                            return None
+
+                        portfolio_items = []
+
+                        # Decodificar precios y valorar todas las posiciones en lote
+                        batch = decode_price_feeds(prices.values())
+                        holdings_by_feed = {feed_catalog.get_id(symbol): amount for symbol, amount in valid_holdings.items()}
+                        total, values = batch.value_portfolios([holdings_by_feed])[0]
+                        total_value_usd = float(total)
+
+                        for feed_id, value_usd in values.items():
+                            symbol = feed_catalog.get_symbol(feed_id)
+                            price = batch.price(feed_id)
+
+                            portfolio_items.append({
+                                "symbol": symbol.upper(),
+                                "amount": valid_holdings[symbol],
+                                "price": float(price),
+                                "price_usd": f"${price:.2f}",
+                                "value_usd": float(value_usd),
+                                "value_formatted": f"${value_usd:,.2f}",
+                                "publish_time": batch.publish_time(feed_id)
+                            })
+
+                        # Calcular porcentajes
+                        for item in portfolio_items:
+                            item["percentage"] = (item["value_usd"] / total_value_usd * 100) if total_value_usd > 0 else 0
+                            item["percentage_formatted"] = f"{item['percentage']:.2f}%"
                         
-                        if price_json.get("parsed") and len(price_json["parsed"]) > 0:
-                            portfolio_items = []
-                            total_value_usd = 0
-                            
-                            for price_feed in price_json["parsed"]:
-                                price_data = price_feed["price"]
-                                feed_id = price_feed["id"]
-                                
-                                # Calcular precio
-                                price_raw = int(price_data["price"])
-                                expo = int(price_data["expo"])
-                                price = price_raw * (10 ** expo)
-                                
-                                # Encontrar símbolo y cantidad
-                                symbol = next((k for k, v in PRICE_FEEDS.items() if v == feed_id), None)
-                                if symbol and symbol in valid_holdings:
-                                    amount = valid_holdings[symbol]
-                                    value_usd = price * amount
-                                    total_value_usd += value_usd
-                                    
-                                    portfolio_items.append({
-                                        "symbol": symbol.upper(),
-                                        "amount": amount,
-                                        "price": float(price),
-                                        "price_usd": f"${price:.2f}",
-                                        "value_usd": float(value_usd),
-                                        "value_formatted": f"${value_usd:,.2f}"
-                                    })
-                            
-                            if len(portfolio_items) == 0:
-                                ai_json["error"] = "No price data available for the cryptocurrencies in your portfolio"
-                            else:
-                                # Calcular porcentajes
-                                for item in portfolio_items:
-                                    item["percentage"] = (item["value_usd"] / total_value_usd * 100) if total_value_usd > 0 else 0
-                                    item["percentage_formatted"] = f"{item['percentage']:.2f}%"
-                                
-                                # Ordenar por valor descendente
-                                portfolio_items.sort(key=lambda x: x["value_usd"], reverse=True)
-                                
-                                # Generar resumen con IA solo si hay items
-                                summary_text = ""
-                                if len(portfolio_items) > 0:
-                                    try:
-                                        summary_prompt = f"""Based on this crypto portfolio analysis:
+                        # Ordenar por valor descendente
+                        portfolio_items.sort(key=lambda x: x["value_usd"], reverse=True)
+                        return total_value_usd, portfolio_items
+
+                    def summarize(inputs):
+                        # Generar resumen con IA solo si hay items
+                        valuation = inputs["valuation"]
+                        if not valuation or not valuation[1]:
+                            return ""
+                        total_value_usd, portfolio_items = valuation
+                        try:
+                            summary_prompt = f"""Based on this crypto portfolio analysis:
 - Total Value: ${total_value_usd:,.2f}
 - Holdings: {len(portfolio_items)} different cryptocurrencies
 - Top holding: {portfolio_items[0]['symbol']} ({portfolio_items[0]['percentage_formatted']})
@@ -1880,41 +6024,117 @@ Provide a brief summary (2-3 sentences) about:
 2. Risk level based on distribution
 3. Any quick recommendation"""
 
-                                        summary_payload = {
-                                            "model": "deepseek-chat",
-                                            "messages": [
-                                                {"role": "system", "content": "You are a crypto portfolio advisor. Provide brief, actionable insights."},
-                                                {"role": "user", "content": summary_prompt}
-                                            ],
-                                            "temperature": 0.7,
-                                            "max_tokens": 150
-                                        }
-                                        
-                                        summary_response = requests.post(DEEPSEEK_URL, headers=headers, json=summary_payload, timeout=30)
-                                        summary_response.raise_for_status()
-                                        summary_result = summary_response.json()
-                                        summary_text = summary_result["choices"][0]["message"]["content"].strip()
-                                    except:
-                                        summary_text = "Portfolio calculated successfully. Review your holdings distribution above."
-                                
-                                ai_json["portfolio"] = {
-                                    "total_value_usd": float(total_value_usd),
-                                    "total_value_formatted": f"${total_value_usd:,.2f}",
-                                    "holdings_count": len(portfolio_items),
-                                    "items": portfolio_items
-                                }
-                                
-                                ai_json["summary"] = summary_text
-                                ai_json["message"] = f"Portfolio calculated: {len(portfolio_items)} assets worth ${total_value_usd:,.2f} USD"
-                        else:
-                            ai_json["error"] = "No price data received from Pyth Network"
+                            summary_payload = {
+                                "model": "deepseek-chat",
+                                "messages": [
+                                    {"role": "system", "content": PORTFOLIO_SUMMARY_SYSTEM_PROMPT},
+                                    {"role": "user", "content": summary_prompt}
+                                ],
+                                "temperature": 0.7,
+                                "max_tokens": 150
+                            }
                             
-                except Exception as e:
-                    ai_json["error"] = f"Error calculating portfolio: {str(e)}"
+                            summary_response = post_deepseek(summary_payload, headers, endpoint="/pyth/chat")
+                            summary_result = summary_response.json()
+                            return summary_result["choices"][0]["message"]["content"].strip()
+                        except:
+                            return "Portfolio calculated successfully. Review your holdings distribution above."
+
+                    steps = StepGraph(pyth_chat_executor).add("valuation", value_holdings).add("summary", summarize, deps=["valuation"]).run()
+                    valuation = steps["valuation"].result()
+
+                    if valuation is None:
+                        ai_json["error"] = "No price data received from Pyth Network"
+                    elif len(valuation[1]) == 0:
+                        ai_json["error"] = "No price data available for the cryptocurrencies in your portfolio"
+                    else:
+                        total_value_usd, portfolio_items = valuation
+                        ai_json["portfolio"] = {
+                            "total_value_usd": float(total_value_usd),
+                            "total_value_formatted": f"${total_value_usd:,.2f}",
+                            "holdings_count": len(portfolio_items),
+                            "items": portfolio_items
+                        }
+                        
+                        # El total se devuelve en cuanto hay precios; el resumen de la IA puede diferirse
+                        if defer:
+                            ai_json["summary"] = None
+                            ai_json["followup"] = deferred_results.add("summary", steps["summary"])
+                        else:
+                            ai_json["summary"] = steps["summary"].result()
+                        ai_json["message"] = f"Portfolio calculated: {len(portfolio_items)} assets worth ${total_value_usd:,.2f} USD"
+                        
+            except Exception as e:
+                ai_json["error"] = f"Error calculating portfolio: {str(e)}"
+    
+    elif action == "advice":
+        # Consejo general sin precio específico
+        ai_json["message"] = ai_json.get("message", "Please specify which cryptocurrency you want advice about.")
+
+    return ai_json
+
+
+@app.route("/pyth/chat", methods=["POST"])
+def pyth_chat_ai():
+    """Chat con IA para consultar precios usando Pyth Network (en inglés)."""
+    try:
+        data = request.get_json()
+        user_message = data.get("message", "")
+        
+        if not user_message:
+            return jsonify({
+                "success": False,
+                "error": "Message is required"
+            }), 400
+        
+        if not DEEPSEEK_API_KEY:
+            return jsonify({
+                "success": False,
+                "error": "AI API key not configured"
+            }), 500
+        
+        headers = {
+            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+            "Content-Type": "application/json"
+        }
+        llm_metrics.count_message("/pyth/chat")
+
+        # Intención cacheada para mensajes equivalentes; si no, llamar a DeepSeek
+        ai_json = llm_intent_cache.get("pyth", user_message)
+
+        # DeepSeek no disponible (circuito abierto): modo degradado por palabras clave
+        if ai_json is None and deepseek_breaker.is_open():
+            ai_json = keyword_pyth_intent(user_message)
+
+        # Modo streaming: tokens de DeepSeek por SSE y la acción en cuanto la intención está completa
+        if wants_event_stream(data):
+            return event_stream_response(stream_intent_response(
+                ai_json,
+                build_pyth_intent_payload(user_message),
+                PYTH_ACTION_REQUIRED_FIELDS,
+                parse_reply=lambda text: parse_pyth_intent_reply(user_message, text),
+                execute_action=lambda intent: execute_pyth_action(intent, headers, defer=True),
+                error_body=lambda e: {"success": False, "error": str(e)},
+                degrade=lambda: keyword_pyth_intent(user_message)
+            ))
+
+        if ai_json is None:
+            payload = build_pyth_intent_payload(user_message)
+
+            try:
+                response = post_deepseek(payload, headers)
+            except (CircuitOpenError, requests.RequestException):
+                response = None
+
+            if response is None:
+                ai_json = keyword_pyth_intent(user_message)
+            else:
+                ai_response = response.json()
+                ai_message = ai_response["choices"][0]["message"]["content"]
+                ai_json = parse_pyth_intent_reply(user_message, ai_message)
         
-        elif action == "advice":
-            # Consejo general sin precio específico
-            ai_json["message"] = ai_json.get("message", "Please specify which cryptocurrency you want advice about.")
+        # "defer": true devuelve los precios sin esperar el consejo/resumen de la IA
+        ai_json = execute_pyth_action(ai_json, headers, defer=data.get("defer") is True)
         
         return jsonify(ai_json)
         
@@ -1925,14 +6145,79 @@ Provide a brief summary (2-3 sentences) about:
         }), 500
 
 
+@app.route("/pyth/chat/followup/<followup_id>", methods=["GET"])
+def get_pyth_chat_followup(followup_id):
+    """Consulta el consejo o resumen diferido de una respuesta de /pyth/chat.
+
+    Query param opcional: wait (segundos, máx. 30) para esperar a que termine.
+    """
+    try:
+        wait = min(max(float(request.args.get("wait", 0)), 0), 30)
+    except ValueError:
+        return jsonify({
+            "success": False,
+            "error": "wait must be a number"
+        }), 400
+
+    body = deferred_results.body(followup_id, timeout=wait)
+    if body is None:
+        return jsonify({
+            "success": False,
+            "error": "Follow-up not found or expired"
+        }), 404
+    return jsonify(body)
+
+
 @app.route("/pyth/supported", methods=["GET"])
 def get_supported_symbols():
-    """Obtiene la lista de criptomonedas soportadas."""
+    """Obtiene la lista paginada de criptomonedas soportadas (catálogo de Pyth).
+
+    Query params opcionales: prefix (búsqueda por prefijo del símbolo), page y per_page.
+    """
+    try:
+        prefix = request.args.get("prefix", "")
+        page = max(int(request.args.get("page", 1)), 1)
+        per_page = min(max(int(request.args.get("per_page", 50)), 1), 500)
+    except ValueError:
+        return jsonify({
+            "success": False,
+            "error": "page and per_page must be integers"
+        }), 400
+
+    total, feeds = feed_catalog.search(prefix, offset=(page - 1) * per_page, limit=per_page)
+    symbols = [feed["symbol"] for feed in feeds]
+
+    return jsonify({
+        "success": True,
+        "count": len(symbols),
+        "total": total,
+        "page": page,
+        "per_page": per_page,
+        "pages": (total + per_page - 1) // per_page,
+        "source": feed_catalog.source,
+        "symbols": symbols,
+        "feeds": feeds,
+        "message": f"Supported cryptocurrencies: {', '.join([s.upper() for s in symbols])}"
+    })
+
+
+@app.route("/pyth/status", methods=["GET"])
+def get_pyth_status():
+    """Estado de la capa de precios: modo (polling/streaming) y frescura de la caché."""
+    with _price_cache_lock:
+        cached_feeds = len(_price_cache)
+
     return jsonify({
         "success": True,
-        "count": len(PRICE_FEEDS),
-        "symbols": list(PRICE_FEEDS.keys()),
-        "message": f"Supported cryptocurrencies: {', '.join([s.upper() for s in PRICE_FEEDS.keys()])}"
+        "mode": "streaming" if price_stream else "polling",
+        "cache_ttl": PYTH_CACHE_TTL,
+        "cached_feeds": cached_feeds,
+        "single_flight": hermes_flight.stats(),
+        "stream_clients": price_broadcaster.client_count(),
+        "alerts": price_alerts.stats(),
+        "llm_intent_cache": llm_intent_cache.stats(),
+        "deepseek_circuit": deepseek_breaker.status(),
+        "stream": price_stream.status() if price_stream else None
     })
 
 
@@ -0,0 +1,16 @@
+"""
+🧪 Configuración de pytest para las pruebas unitarias de app.py
+"""
+
+import os
+import tempfile
+
+# Sin hilos de red al importar app.py y con bases de datos temporales
+_TMP = tempfile.mkdtemp(prefix="backend-ai-tests-")
+os.environ.setdefault("PYTH_CATALOG_AUTOREFRESH", "false")
+os.environ.setdefault("PYTH_STREAMING", "false")
+os.environ.setdefault("PYTH_ALERTS_DB", os.path.join(_TMP, "price_alerts.db"))
+os.environ.setdefault("NONCE_DB", os.path.join(_TMP, "nonces.db"))
+
+# Scripts manuales que necesitan el servidor levantado en localhost:5000
+collect_ignore = ["test_ai_db.py", "test_contact_wallets.py", "test_transfer_contacts.py"]
@@ -0,0 +1,15 @@
+# Configuración de gunicorn (se carga automáticamente desde el directorio de trabajo).
+# Todo se puede ajustar por variables de entorno; los flags de la línea de comandos tienen prioridad.
+import os
+
+# "gthread": un hilo por petición (GUNICORN_THREADS peticiones en vuelo por worker).
+# "gevent": E/S cooperativa; cada petición es un greenlet y las llamadas a DeepSeek,
+# Hermes, Supabase y el RPC ceden el control mientras esperan, así un solo proceso
+# mantiene cientos de peticiones en vuelo (GUNICORN_WORKER_CONNECTIONS).
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("GUNICORN_WORKERS", "1"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+# Las respuestas SSE (/pyth/stream, chat en streaming) mantienen la conexión abierta
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "0"))
@@ -0,0 +1,94 @@
+"""
+🧪 Pruebas del parser local de intenciones de /chat (parse_chat_intent)
+"""
+
+import pytest
+
+import app as app_module
+from app import CHAT_LOCAL_INTENT_THRESHOLD, app, parse_chat_intent
+
+WALLET = "0x" + "a" * 40
+ADDRESS = "0x742d35Cc6634C0532925a3b844Bc9e7595f0bEb0"
+
+
+def resolved_locally(message, contact_names=None, sender_wallet=WALLET):
+    result = parse_chat_intent(message, sender_wallet, contact_names=contact_names)
+    return result if result and result["confidence"] >= CHAT_LOCAL_INTENT_THRESHOLD else None
+
+
+@pytest.mark.parametrize("message, action, fields", [
+    ("envía 0.1 eth a Juan", "transfer_to_contact", {"contact_name": "Juan", "amount": 0.1}),
+    ("Manda 2 ETH a mi contacto Andrés", "transfer_to_contact", {"contact_name": "Andrés", "amount": 2.0}),
+    ("send 5 eth to Maria please", "transfer_to_contact", {"contact_name": "Maria", "amount": 5.0}),
+    (f"transfiere 0,5 eth a {ADDRESS}", "transfer", {"recipient": ADDRESS, "amount": 0.5}),
+    ("muéstrame mi balance", "balance", {"address": WALLET}),
+    ("mis contactos", "get_contacts", {"sender_wallet": WALLET}),
+    ("show network status", "network_info", {}),
+])
+def test_common_commands_resolve_locally(message, action, fields):
+    result = resolved_locally(message)
+    assert result is not None
+    assert result["intent"]["action"] == action
+    for key, value in fields.items():
+        assert result["intent"][key] == value
+
+
+@pytest.mark.parametrize("message", [
+    "envía 0.1 eth a Juan mañana",
+    "send 5 eth to my wallet",
+    "paga 10 a la renta",
+    "manda 3 eth a Juan por la tarde",
+    "envía 0 eth a Juan",
+    "hola, quiero saber cómo funciona sBTC",
+])
+def test_ambiguous_messages_go_to_the_llm(message):
+    assert resolved_locally(message) is None
+
+
+def test_multi_word_name_matching_a_contact_resolves_locally():
+    result = resolved_locally("envía 0.1 eth a María José", contact_names=["Juan", "maría  josé"])
+    assert result["intent"]["contact_name"] == "María José"
+
+
+def test_multi_word_name_not_in_contacts_goes_to_the_llm():
+    assert resolved_locally("envía 0.1 eth a Juan mañana", contact_names=["Juan"]) is None
+
+
+def test_contact_names_are_only_fetched_for_multi_word_names():
+    calls = []
+
+    def contact_names():
+        calls.append(1)
+        return []
+
+    assert resolved_locally("envía 0.1 eth a Juan", contact_names=contact_names) is not None
+    assert calls == []
+
+
+def test_my_balance_without_wallet_goes_to_the_llm():
+    assert resolved_locally("muéstrame mi balance", sender_wallet="") is None
+
+
+def test_intent_report_errors_are_in_spanish():
+    client = app.test_client()
+    response = client.post("/chat/intent-report", json={"messages": []})
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "messages debe ser una lista no vacía"
+    response = client.post("/chat/intent-report", json={"messages": ["hola", 3]})
+    assert response.get_json()["error"] == "messages solo puede contener textos"
+
+
+def test_intent_report_uses_the_sender_contacts(monkeypatch):
+    calls = []
+
+    def contact_names(sender_wallet):
+        calls.append(sender_wallet)
+        return ["María José"]
+
+    monkeypatch.setattr(app_module, "chat_contact_names", contact_names)
+    messages = ["envía 0.1 eth a María José", "envía 2 eth a María José", "envía 1 eth a Juan"]
+    response = app.test_client().post("/chat/intent-report", json={"messages": messages, "sender_wallet": "0xabc"})
+
+    body = response.get_json()
+    assert body["escalated_sample"] == []
+    assert calls == ["0xabc"]
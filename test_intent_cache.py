@@ -0,0 +1,62 @@
+"""
+🧪 Pruebas de la caché de intenciones del LLM (LLMIntentCache)
+"""
+
+from app import LLMIntentCache
+
+WALLET = "0x" + "a" * 40
+
+
+def test_reuses_template_with_new_amount():
+    cache = LLMIntentCache(16)
+    cache.put("chat", "Envía 0.5 ETH a Juan", WALLET, {"action": "transfer_to_contact", "contact_name": "Juan", "amount": 0.5})
+
+    intent = cache.get("chat", "envia 2 eth a Juan", WALLET)
+    assert intent == {"action": "transfer_to_contact", "contact_name": "Juan", "amount": 2}
+
+
+def test_reuses_addresses_from_the_current_message():
+    cache = LLMIntentCache(16)
+    first, second = "0x" + "b" * 40, "0x" + "c" * 40
+    cache.put("chat", f"transfiere 1 eth a {first}", "", {"action": "transfer", "recipient": first, "amount": 1, "message": "Transferir 1 ETH"})
+
+    intent = cache.get("chat", f"transfiere 3 eth a {second}", "")
+    assert intent == {"action": "transfer", "recipient": second, "amount": 3, "message": "Transferir 3 ETH"}
+
+
+def test_thousands_separator_is_not_cached():
+    # "1.000" se lee como 1.0, pero DeepSeek devuelve 1000: no hay slot que rellenar
+    cache = LLMIntentCache(16)
+    cache.put("chat", "Envía 1.000 ETH a Juan", WALLET, {"action": "transfer_to_contact", "contact_name": "Juan", "amount": 1000})
+
+    assert cache.get("chat", "Envía 2.500 ETH a Juan", WALLET) is None
+    assert cache.stats()["uncacheable"] == 1
+
+
+def test_thousands_separator_in_message_text_is_not_cached():
+    cache = LLMIntentCache(16)
+    cache.put("chat", "Envía 1,000 ETH a Juan", WALLET, {"action": "transfer_to_contact", "contact_name": "Juan", "amount": 1000, "message": "Transferir 1000 ETH a Juan"})
+
+    assert cache.get("chat", "Envía 7,500 ETH a Juan", WALLET) is None
+
+
+def test_numbers_not_used_by_the_intent_are_not_cached():
+    # El "2" del mensaje no llega a la intención: otro número daría la misma respuesta equivocada
+    cache = LLMIntentCache(16)
+    cache.put("chat", "envía 5 eth a Juan en 2 horas", WALLET, {"action": "transfer_to_contact", "contact_name": "Juan", "amount": 5})
+
+    assert cache.get("chat", "envía 5 eth a Juan en 9 horas", WALLET) is None
+
+
+def test_numeric_field_without_message_token_is_not_cached():
+    cache = LLMIntentCache(16)
+    cache.put("chat", "envía lo de siempre a Juan", WALLET, {"action": "transfer_to_contact", "contact_name": "Juan", "amount": 0.25})
+
+    assert cache.get("chat", "envía lo de siempre a Juan", WALLET) is None
+
+
+def test_ambiguous_amount_is_not_cached():
+    cache = LLMIntentCache(16)
+    cache.put("pyth", "tengo 2 eth y 2 btc", "", {"action": "calculate_portfolio", "portfolio": {"eth": 2, "btc": 2}})
+
+    assert cache.get("pyth", "tengo 3 eth y 4 btc") is None
@@ -0,0 +1,97 @@
+"""
+🧪 Pruebas del streaming de intenciones (stream_intent_response)
+"""
+
+import json
+import threading
+
+import requests
+
+import app
+from app import CHAT_ACTION_REQUIRED_FIELDS, CHAT_WRITE_ACTIONS, CircuitOpenError, stream_intent_response
+
+
+def events(generator):
+    parsed = []
+    for chunk in generator:
+        name, data = chunk.strip().split("\n", 1)
+        parsed.append((name.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return parsed
+
+
+def fake_completion(chunks, error=None):
+    def completion(payload):
+        yield from chunks
+        if error is not None:
+            raise error
+    return completion
+
+
+def run(monkeypatch, chunks, error=None, executed=None, **kwargs):
+    monkeypatch.setattr(app, "stream_deepseek_completion", fake_completion(chunks, error))
+    executed = [] if executed is None else executed
+
+    def execute_action(intent):
+        executed.append((dict(intent), threading.current_thread() is threading.main_thread()))
+        return dict(intent, executed=True)
+
+    return events(stream_intent_response(
+        None, {}, CHAT_ACTION_REQUIRED_FIELDS,
+        parse_reply=json.loads,
+        execute_action=execute_action,
+        error_body=lambda e: {"error": str(e)},
+        **kwargs
+    ))
+
+
+def test_failure_mid_stream_falls_back_to_degraded_intent(monkeypatch):
+    degraded = {"action": "list_users", "degraded": True}
+    result = run(monkeypatch, ['{"action": "bal'], error=requests.exceptions.ChunkedEncodingError("reset"), degrade=lambda: dict(degraded))
+
+    names = [name for name, _ in result]
+    assert "error" not in names
+    assert dict(result)["result"] == dict(degraded, executed=True)
+
+
+def test_open_circuit_falls_back_to_degraded_intent(monkeypatch):
+    result = run(monkeypatch, [], error=CircuitOpenError("deepseek circuit is open"), degrade=lambda: {"action": "none", "degraded": True})
+    assert dict(result)["result"]["degraded"] is True
+
+
+def test_without_degrade_the_error_is_reported(monkeypatch):
+    result = run(monkeypatch, ['{"action"'], error=requests.exceptions.ConnectionError("down"))
+    assert result[-1] == ("error", {"error": "down"})
+
+
+def test_read_actions_start_before_the_reply_ends(monkeypatch):
+    executed = []
+    run(monkeypatch, ['{"action": "balance", "address": "0xabc",', ' "message": "ok"}'], executed=executed, write_actions=CHAT_WRITE_ACTIONS)
+
+    [(intent, on_main_thread)] = executed
+    assert intent == {"action": "balance", "address": "0xabc"}
+    assert not on_main_thread
+
+
+def test_write_actions_wait_for_the_validated_reply(monkeypatch):
+    executed = []
+    result = run(
+        monkeypatch,
+        ['{"action": "create_user", "username": "ana", "wallet_address": "0xabc",', ' "message": "Creando"}'],
+        executed=executed, write_actions=CHAT_WRITE_ACTIONS
+    )
+
+    [(intent, on_main_thread)] = executed
+    assert intent["message"] == "Creando"
+    assert on_main_thread
+    assert dict(result)["result"]["executed"] is True
+
+
+def test_write_action_is_not_run_when_the_reply_is_cut(monkeypatch):
+    executed = []
+    run(
+        monkeypatch,
+        ['{"action": "create_user", "username": "ana", "wallet_address": "0xabc",'],
+        error=requests.exceptions.ReadTimeout("slow"), executed=executed, write_actions=CHAT_WRITE_ACTIONS,
+        degrade=lambda: {"action": "none", "degraded": True}
+    )
+    assert [intent["action"] for intent, _ in executed] == ["none"]
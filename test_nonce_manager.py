@@ -0,0 +1,167 @@
+"""
+🧪 Pruebas del gestor de nonces de la cuenta del servidor (NonceManager)
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+import requests
+
+import app
+from app import NonceManager
+
+ADDRESS = "0x" + "d" * 40
+
+
+class FakeEth:
+    """Pending count del nodo; cuenta las llamadas y cuántas ocurren con el bloqueo tomado."""
+
+    def __init__(self, pending, manager=None):
+        self.pending = pending
+        self.manager = manager
+        self.calls = 0
+        self.calls_under_lock = 0
+
+    def get_transaction_count(self, address, block_identifier):
+        self.calls += 1
+        if self.manager is not None and self.manager._lock.locked():
+            self.calls_under_lock += 1
+        return self.pending
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    manager = NonceManager(str(tmp_path / "nonces.db"), 10, 30, 120)
+    eth = FakeEth(5, manager)
+    monkeypatch.setattr(app.w3, "eth", eth)
+    manager.eth = eth
+    return manager
+
+
+def test_database_is_created_on_first_reserve(manager):
+    assert not os.path.exists(manager.db_path)
+    assert manager.reserve(ADDRESS) == 5
+    assert os.path.exists(manager.db_path)
+
+
+def test_failure_mid_run_reuses_only_the_released_nonce(manager):
+    assert [manager.reserve(ADDRESS) for _ in range(3)] == [5, 6, 7]
+
+    # El 6 falló antes de enviarse; el 7 se envió y el nodo aún no lo cuenta
+    manager.release(ADDRESS, 6, ValueError("could not sign transaction"))
+    manager.eth.pending = 6
+    manager._reconciled.clear()
+
+    assert manager.reserve(ADDRESS) == 6
+    assert manager.reserve(ADDRESS) == 8
+    assert manager.stats()["reused"] == 1
+
+
+@pytest.mark.parametrize("error", [
+    requests.exceptions.ReadTimeout("read timed out"),
+    requests.exceptions.ConnectionError("connection reset by peer"),
+])
+def test_send_with_unknown_outcome_reconciles_instead_of_freeing(manager, error):
+    assert [manager.reserve(ADDRESS) for _ in range(3)] == [5, 6, 7]
+
+    # El nodo aceptó el 6 pero la respuesta no llegó
+    manager.release(ADDRESS, 6, error, sent=True)
+    manager.eth.pending = 7
+    calls = manager.eth.calls
+
+    assert manager.reserve(ADDRESS) == 8
+    assert manager.eth.calls == calls + 1
+    assert manager.stats()["reused"] == 0
+
+
+def test_transport_error_before_sending_frees_the_nonce(manager):
+    assert [manager.reserve(ADDRESS) for _ in range(2)] == [5, 6]
+    manager.release(ADDRESS, 5, requests.exceptions.ConnectionError("gas price lookup failed"))
+    assert manager.reserve(ADDRESS) == 5
+
+
+def test_reconcile_never_moves_backwards(manager):
+    assert [manager.reserve(ADDRESS) for _ in range(3)] == [5, 6, 7]
+
+    # Un nodo rezagado informa un pending count menor: no se repiten 5-7
+    manager.eth.pending = 5
+    manager.release(ADDRESS, 7, ValueError("nonce too low"))
+    assert manager.reserve(ADDRESS) == 8
+
+
+def test_nonce_error_jumps_to_the_node_count_and_drops_stale_free_nonces(manager):
+    assert [manager.reserve(ADDRESS) for _ in range(3)] == [5, 6, 7]
+    manager.release(ADDRESS, 6, RuntimeError("timeout"))
+
+    # Otra cartera con la misma clave envió hasta el 11
+    manager.eth.pending = 12
+    manager.release(ADDRESS, 7, ValueError("nonce too low: next nonce 12"))
+    assert manager.reserve(ADDRESS) == 12
+    assert manager.reserve(ADDRESS) == 13
+
+
+def test_pending_count_is_fetched_outside_the_locks(manager):
+    manager.reserve(ADDRESS)
+    manager.release(ADDRESS, 5, ValueError("already known"))
+    manager.reserve(ADDRESS)
+
+    assert manager.eth.calls == 2
+    assert manager.eth.calls_under_lock == 0
+
+
+def test_long_gap_frees_the_node_pending_count(manager):
+    manager.gap_timeout = 0
+    assert [manager.reserve(ADDRESS) for _ in range(3)] == [5, 6, 7]
+
+    # El 5 nunca llegó al nodo
+    manager._reconciled.clear()
+    manager.reserve(ADDRESS)
+    manager._reconciled.clear()
+    time.sleep(0.01)
+    assert manager.reserve(ADDRESS) == 5
+    assert manager.stats()["gaps"] == 1
+
+
+def test_concurrent_reservations_are_unique(manager):
+    nonces = []
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(20):
+                nonce = manager.reserve(ADDRESS)
+                if nonce % 7 == 0:
+                    manager.release(ADDRESS, nonce, RuntimeError("send failed"))
+                else:
+                    nonces.append(nonce)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert len(nonces) == len(set(nonces))
+
+
+def test_gevent_mode_waits_for_the_lock_cooperatively(manager, monkeypatch):
+    manager.reserve(ADDRESS)
+    monkeypatch.setattr(app, "ASYNC_SERVING", True)
+    sleeps = []
+    real_sleep = time.sleep
+    monkeypatch.setattr(app.time, "sleep", lambda seconds: (sleeps.append(seconds), real_sleep(seconds)))
+
+    # Otro worker retiene el bloqueo de escritura durante 0.3 s
+    holder = sqlite3.connect(manager.db_path, isolation_level=None, check_same_thread=False)
+    holder.execute("BEGIN IMMEDIATE")
+    threading.Timer(0.3, lambda: holder.execute("COMMIT")).start()
+
+    assert manager.reserve(ADDRESS) == 6
+    assert sleeps
+    holder.close()
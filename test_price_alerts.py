@@ -0,0 +1,76 @@
+"""
+🧪 Pruebas de la entrega de alertas de precio (PriceAlertEngine)
+"""
+
+import os
+import time
+
+from app import PriceAlertEngine, decode_price_feeds
+
+FEED_ID = "ab" * 32
+
+
+def batch_at(price):
+    return decode_price_feeds([{
+        "id": FEED_ID,
+        "price": {"price": str(price), "conf": "1", "expo": 0, "publish_time": int(time.time())}
+    }])
+
+
+def wait_for_deliveries(*engines):
+    def pending(engine):
+        stats = engine.stats()
+        return stats["triggered"] - stats["delivered"] - stats["already_claimed"] - stats["delivery_errors"]
+
+    deadline = time.time() + 5
+    while any(pending(engine) for engine in engines) and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def engine_with_listener(db_path, delivered):
+    engine = PriceAlertEngine(db_path)
+    engine.add_listener(lambda alert: delivered.append((engine, alert["id"])))
+    return engine
+
+
+def test_database_is_created_on_first_use(tmp_path):
+    engine = PriceAlertEngine(str(tmp_path / "alerts.db"))
+    assert not os.path.exists(engine.db_path)
+    assert engine.list_alerts() == []
+    assert os.path.exists(engine.db_path)
+
+
+def test_only_one_worker_delivers_a_shared_alert(tmp_path):
+    db_path = str(tmp_path / "alerts.db")
+    delivered = []
+    first = engine_with_listener(db_path, delivered)
+    alert = first.create("eth", FEED_ID, "below", 100)
+
+    # Segundo worker: carga la misma alerta activa al arrancar
+    second = engine_with_listener(db_path, delivered)
+    second.list_alerts()
+    assert second.active_count() == 1
+
+    first.evaluate(batch_at(90))
+    second.evaluate(batch_at(90))
+    wait_for_deliveries(first, second)
+
+    assert [alert_id for _, alert_id in delivered] == [alert["id"]]
+    assert first.get(alert["id"])["status"] == "triggered"
+    assert first.stats()["already_claimed"] + second.stats()["already_claimed"] == 1
+
+
+def test_alert_cancelled_in_another_worker_does_not_fire(tmp_path):
+    db_path = str(tmp_path / "alerts.db")
+    delivered = []
+    first = engine_with_listener(db_path, delivered)
+    alert = first.create("eth", FEED_ID, "above", 100)
+
+    second = engine_with_listener(db_path, delivered)
+    assert second.cancel(alert["id"])["status"] == "cancelled"
+
+    first.evaluate(batch_at(110))
+    wait_for_deliveries(first)
+
+    assert delivered == []
+    assert first.get(alert["id"])["status"] == "cancelled"
@@ -0,0 +1,70 @@
+"""
+🧪 Pruebas de la valoración exacta de portfolios (PriceBatch)
+"""
+
+from decimal import Decimal
+
+import pytest
+
+import app
+from app import decode_price_feeds
+
+ETH = "aa" * 32
+BTC = "bb" * 32
+
+
+def price_feed(feed_id, price, expo):
+    return {"id": feed_id, "price": {"price": str(price), "conf": "1", "expo": expo, "publish_time": 1700000000}}
+
+
+@pytest.fixture(params=["numpy", "python"])
+def batch(request, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(app, "np", None)
+    elif app.np is None:
+        pytest.skip("NumPy no está instalado")
+    return decode_price_feeds([price_feed(ETH, 312345678901, -8), price_feed(BTC, 6712345, -2)])
+
+
+def test_valuation_is_exact_decimal(batch):
+    [(total, values)] = batch.value_portfolios([{f"0x{ETH}": 0.1, BTC: 3}])
+
+    assert values == {ETH: Decimal("312.345678901"), BTC: Decimal("201370.35")}
+    assert total == Decimal("201682.695678901")
+    assert all(isinstance(value, Decimal) for value in (total, *values.values()))
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_products_beyond_context_precision_are_not_rounded(use_numpy, monkeypatch):
+    if not use_numpy:
+        monkeypatch.setattr(app, "np", None)
+    elif app.np is None:
+        pytest.skip("NumPy no está instalado")
+    batch = decode_price_feeds([price_feed(ETH, 9876543210987654321, -15)])
+
+    [(total, values)] = batch.value_portfolios([{ETH: 123456789.12345679}])
+
+    # 17 × 19 dígitos: más que los 28 significativos del contexto Decimal
+    exact = Decimal(f"{12345678912345679 * 9876543210987654321}E-23")
+    assert len(exact.as_tuple().digits) > 28
+    assert values[ETH] == exact
+    assert total == exact
+
+
+def test_feed_spellings_are_merged_under_the_normalized_id(batch):
+    [(total, values)] = batch.value_portfolios([{ETH: 1, f"0x{ETH.upper()}": 1}])
+
+    assert list(values) == [ETH]
+    assert values[ETH] == Decimal("6246.91357802")
+    assert sum(values.values()) == total
+
+
+def test_both_paths_return_the_same_result(monkeypatch):
+    feeds = [price_feed(ETH, 312345678901, -8), price_feed(BTC, 6712345, -2)]
+    portfolios = [{ETH: 0.5}, {BTC: 1e-9, ETH: 2}, {"cc" * 32: 1}, {}]
+    if app.np is None:
+        pytest.skip("NumPy no está instalado")
+
+    with_numpy = decode_price_feeds(feeds).value_portfolios(portfolios)
+    monkeypatch.setattr(app, "np", None)
+    assert decode_price_feeds(feeds).value_portfolios(portfolios) == with_numpy
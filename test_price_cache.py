@@ -0,0 +1,55 @@
+"""
+🧪 Pruebas de la caché de precios con el streaming de Hermes (get_latest_prices)
+"""
+
+import time
+
+import pytest
+
+import app
+
+STREAMED = "aa" * 32
+POLLED = "bb" * 32
+
+
+class FreshStream:
+    feed_keys = frozenset({STREAMED})
+
+    def is_stale(self):
+        return False
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    calls = []
+
+    def fetch(price_ids):
+        calls.append(list(price_ids))
+        return {app._normalize_feed_id(price_id): {"id": app._normalize_feed_id(price_id), "fresh": True} for price_id in price_ids}
+
+    monkeypatch.setattr(app, "_fetch_latest_from_hermes", fetch)
+    monkeypatch.setattr(app, "_price_cache", {})
+    # Ambas entradas tienen más de PYTH_CACHE_TTL pero menos que PYTH_STREAM_STALE_AFTER
+    age = (app.PYTH_CACHE_TTL + app.PYTH_STREAM_STALE_AFTER) / 2
+    assert app.PYTH_CACHE_TTL < age < app.PYTH_STREAM_STALE_AFTER
+    for feed_key in (STREAMED, POLLED):
+        app._price_cache[feed_key] = (time.monotonic() - age, {"id": feed_key, "fresh": False})
+    return calls
+
+
+def test_fresh_stream_extends_ttl_only_for_subscribed_feeds(monkeypatch, fetched):
+    monkeypatch.setattr(app, "price_stream", FreshStream())
+
+    prices = app.get_latest_prices([f"0x{STREAMED}", f"0x{POLLED}"])
+
+    assert fetched == [[f"0x{POLLED}"]]
+    assert prices[f"0x{STREAMED}"]["fresh"] is False
+    assert prices[f"0x{POLLED}"]["fresh"] is True
+
+
+def test_without_stream_every_feed_uses_the_cache_ttl(monkeypatch, fetched):
+    monkeypatch.setattr(app, "price_stream", None)
+
+    app.get_latest_prices([STREAMED, POLLED])
+
+    assert fetched == [[STREAMED, POLLED]]
@@ -0,0 +1,32 @@
+"""
+🧪 Pruebas del límite de clientes del stream SSE /pyth/stream
+"""
+
+import app
+
+
+def test_unconsumed_response_does_not_hold_a_slot(monkeypatch):
+    broadcaster = app.PriceBroadcaster(1)
+    monkeypatch.setattr(app, "price_broadcaster", broadcaster)
+
+    with app.app.test_request_context("/pyth/stream?symbols=eth"):
+        response = app.stream_pyth_prices()
+
+    assert response.status_code == 200
+    assert broadcaster.client_count() == 0
+    response.close()
+    assert broadcaster.client_count() == 0
+
+
+def test_rejects_clients_over_the_limit(monkeypatch):
+    broadcaster = app.PriceBroadcaster(0)
+    monkeypatch.setattr(app, "price_broadcaster", broadcaster)
+
+    response = app.app.test_client().get("/pyth/stream?symbols=eth")
+    assert response.status_code == 503
+    assert response.get_json()["success"] is False
+
+
+def test_default_limit_leaves_threads_free():
+    if not app.ASYNC_SERVING:
+        assert app.PYTH_SSE_MAX_CLIENTS < app.WORKER_CONCURRENCY